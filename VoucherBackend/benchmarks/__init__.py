@@ -0,0 +1,3 @@
+"""
+Performance benchmarks, run them with `python -m benchmarks.<name>`
+"""
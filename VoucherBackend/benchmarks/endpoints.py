@@ -0,0 +1,424 @@
+"""
+Latency and throughput of every route of the API, on a seeded database.
+
+    $ python -m benchmarks.endpoints --rows 10000 --output results.json
+    $ python -m benchmarks.endpoints --engine postgresql \\
+        --database vouchers_benchmark --rows 1000000 \\
+        --wallet-latency 0.05 --baseline results.json
+
+The app is built with create_app and called in process, so the figures are
+the server side cost of each route. The wallet is a local stub answering
+after --wallet-latency seconds. The database is seeded and its rollups
+rebuilt, so it is never the one of environment.env: a temporary SQLite
+file by default, else --database, a SQLite file or a Postgres database
+whose name holds "benchmark". voucher_model is seeded with --rows
+throwaway vouchers (see query_plans.seed_vouchers), kept between runs of
+the same size on the same --database. With --baseline, the run fails if
+the p95 of a route regressed by more than --tolerance.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+ENGINES = {
+    'sqlite': 'SQLITE',
+    'postgresql': 'POSTGRESQL',
+}
+ROWS = 10000
+REQUESTS = 200
+WARMUP = 10
+CONCURRENCY = 1
+WALLET_LATENCY = 0.0
+TOLERANCE = 0.2
+PERCENTILES = (50, 95, 99)
+
+BENCHMARK_DRIVER_ID = 'benchmark-driver'
+BENCHMARK_PIN_PREFIX = 'BENCH'
+# In the name of the databases the benchmarks may seed
+BENCHMARK_DATABASE_MARK = 'benchmark'
+
+# `path` and `data` are either values or functions of the request number
+Route = namedtuple('Route', 'name method path data headers expected')
+
+
+def percentile(latencies, percent):
+    """
+    Nearest-rank percentile of sorted latencies
+    """
+    index = max(0, math.ceil(percent / 100 * len(latencies)) - 1)
+    return latencies[index]
+
+
+def is_benchmark_database(engine, database):
+    """
+    Whether the benchmarks may seed `database`, the name of a Postgres
+    database or the path of a SQLite file: it is named after them, or is a
+    temporary SQLite file
+    """
+    database = database or ''
+    if BENCHMARK_DATABASE_MARK in database:
+        return True
+    temporary = os.path.join(tempfile.gettempdir(), '')
+    return (engine == 'sqlite'
+            and os.path.abspath(database).startswith(temporary))
+
+
+def make_header(payload):
+    from voucher_backend import config
+    from voucher_backend.token_validation import encode_token
+
+    payload = dict(payload, exp=datetime.utcnow() + timedelta(days=1))
+    token = encode_token(payload, config.PRIVATE_KEY).decode('utf8')
+    return f'Bearer {token}'
+
+
+def prepare(db, number):
+    """
+    Create what the write routes consume: unused vouchers to buy and a
+    wallet operation. Returns the pins to buy and the operation id
+    """
+    from voucher_backend.models import VoucherModel, WalletOperationModel
+
+    pins = [f'{BENCHMARK_PIN_PREFIX}{uuid4().hex[:12]}' for _ in range(number)]
+    db.session.execute(VoucherModel.__table__.insert(), [
+        {
+            'driverId': BENCHMARK_DRIVER_ID,
+            'driverPhoneNumber': '08000000000',
+            'pin': pin,
+            'amountBought': 800,
+            'voucherWorth': 1000,
+            'status': 1,
+        }
+        for pin in pins
+    ])
+    voucher = VoucherModel.query.filter(VoucherModel.pin == pins[0]).one()
+    operation = WalletOperationModel(
+        idempotencyKey=str(uuid4()), operation='purchase_voucher',
+        voucherId=voucher.id, authId='benchmark', amount=800,
+        phoneNumber='08000000000', description='Benchmark',
+        status='succeeded', attempts=1)
+    db.session.add(operation)
+    db.session.commit()
+    return pins, operation.idempotencyKey
+
+
+def clean_up(db, operation_id):
+    from voucher_backend.models import VoucherModel, WalletOperationModel
+
+    VoucherModel.query.filter(
+        VoucherModel.driverId == BENCHMARK_DRIVER_ID).delete(
+            synchronize_session=False)
+    WalletOperationModel.query.filter(
+        WalletOperationModel.idempotencyKey == operation_id).delete(
+            synchronize_session=False)
+    db.session.commit()
+
+
+def ensure_seed(db, rows):
+    """
+    Seed `rows` vouchers, unless the previous run left as many
+    """
+    from voucher_backend.models import VoucherModel
+    from voucher_backend.query_plans import (SEED_DRIVER_ID,
+                                             remove_seed_vouchers,
+                                             seed_vouchers)
+    from voucher_backend.rollups import rebuild_rollups
+
+    seeded = VoucherModel.query.filter(
+        VoucherModel.driverId.like(f'{SEED_DRIVER_ID}-%')).count()
+    if seeded != rows:
+        print(f'Seeding {rows} vouchers', file=sys.stderr)
+        remove_seed_vouchers()
+        seed_vouchers(rows)
+        # The stats read the rollups of the seed
+        rebuild_rollups()
+
+
+def make_routes(pins, operation_id, discount_percent):
+    """
+    One case per route of api_namespace/api.py
+    """
+    from voucher_backend.models import VoucherModel
+    from voucher_backend.query_plans import SEED_DRIVER_ID
+
+    seed_driver_id = f'{SEED_DRIVER_ID}-0'
+    driver = {'Authorization': make_header(
+        {'id': BENCHMARK_DRIVER_ID, 'auth_id': BENCHMARK_DRIVER_ID})}
+    seed_driver = {'Authorization': make_header(
+        {'id': seed_driver_id, 'auth_id': seed_driver_id})}
+    admin = {'Authorization': make_header(
+        {'id': 'benchmark-admin', 'auth_id': 'benchmark-admin',
+         'admin': True})}
+
+    voucher = VoucherModel.query.filter(
+        VoucherModel.driverId == seed_driver_id).first()
+    today = datetime.utcnow()
+    ok = (200,)
+    return [
+        # Page 1 of 9, then page 1000 of 9: the route cannot express more
+        Route('list_offset_first_page', 'GET', '/api/vouchers/19', None,
+              driver, ok),
+        Route('list_offset_deep_page', 'GET', '/api/vouchers/10009', None,
+              driver, ok),
+        Route('list_cursor', 'GET', '/api/vouchers/list/?limit=100', None,
+              driver, ok),
+        Route('list_cursor_filtered', 'GET',
+              f'/api/vouchers/list/?limit=100&driverId={seed_driver_id}'
+              '&status=2', None, driver, ok),
+        Route('export_ndjson', 'GET',
+              f'/api/vouchers/export/?driverId={seed_driver_id}', None,
+              admin, ok),
+        Route('voucher_by_id', 'GET', f'/api/vouchers/{voucher.id}/', None,
+              driver, ok),
+        Route('voucher_by_pin', 'GET', f'/api/vouchers/pin/{voucher.pin}/',
+              None, driver, ok),
+        Route('me_streamed', 'GET', '/api/me/', None, seed_driver, ok),
+        Route('me_page', 'GET', '/api/me/?limit=100', None, seed_driver, ok),
+        Route('voucher_purchase', 'POST', '/api/vouchers/',
+              {'driverPhoneNumber': '08000000000', 'voucherWorth': 1000},
+              driver, (201, 202)),
+        Route('voucher_batch', 'POST', '/api/vouchers/batch/',
+              {'driverPhoneNumber': '08000000000', 'count': 10,
+               'voucherWorth': 1000}, driver, (201, 202)),
+        Route('voucher_buy', 'PUT',
+              lambda number: f'/api/vouchers/buy/{pins[number]}/',
+              {'userPhoneNumber': '08000000001'}, driver, (200, 202)),
+        Route('operation', 'GET', f'/api/operations/{operation_id}/', None,
+              driver, ok),
+        Route('discount_get', 'GET', '/api/discount/', None, driver, ok),
+        Route('discount_put', 'PUT', '/api/discount/',
+              # Never the current percent, even with concurrent requests
+              lambda number: {'discountPercent':
+                              discount_percent + (number + 1) / 10000},
+              driver, ok),
+        Route('stat_sum', 'GET', '/api/stat/sumquery/', None, driver, ok),
+        Route('stat_pin', 'GET', '/api/stat/pinquery/', None, driver, ok),
+        Route('stat_date', 'GET',
+              '/api/stat/datequery/?startdate={}&enddate={}'.format(
+                  (today - timedelta(days=30)).strftime('%d/%m/%Y'),
+                  today.strftime('%d/%m/%Y')), None, driver, ok),
+        Route('stat_month', 'GET', f'/api/stat/monthquery/?year={today.year}',
+              None, driver, ok),
+    ]
+
+
+def measure(app, route, requests, warmup, concurrency):
+    """
+    Send `warmup` then `requests` requests from `concurrency` threads.
+    Returns the latencies in seconds, the status codes, the unexpected
+    answers and the wall time
+    """
+    def send(client, number):
+        path = route.path(number) if callable(route.path) else route.path
+        data = route.data(number) if callable(route.data) else route.data
+        start = time.perf_counter()
+        response = client.open(path, method=route.method, data=data,
+                               headers=route.headers)
+        # Read the streamed bodies
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    client = app.test_client()
+    for number in range(warmup):
+        send(client, number)
+
+    latencies, codes = [], Counter()
+    numbers = itertools.count(warmup)
+    lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        while True:
+            number = next(numbers)
+            if number >= warmup + requests:
+                return
+            latency, code = send(client, number)
+            with lock:
+                latencies.append(latency)
+                codes[code] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    errors = sum(count for code, count in codes.items()
+                 if code not in route.expected)
+    return sorted(latencies), codes, errors, elapsed
+
+
+def summarise(latencies, codes, errors, elapsed):
+    result = {
+        'requests': len(latencies),
+        'errors': errors,
+        'statusCodes': {str(code): count for code, count in codes.items()},
+        'meanMs': sum(latencies) / len(latencies) * 1000,
+        'throughput': len(latencies) / elapsed,
+    }
+    for percent in PERCENTILES:
+        result[f'p{percent}Ms'] = percentile(latencies, percent) * 1000
+    return result
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Routes whose p95 grew by more than `tolerance` since the baseline
+    """
+    regressions = []
+    for name, route in results['routes'].items():
+        before = baseline['routes'].get(name)
+        if before and route['p95Ms'] > before['p95Ms'] * (1 + tolerance):
+            regressions.append((name, before['p95Ms'], route['p95Ms']))
+    return regressions
+
+
+def run(rows=ROWS, requests=REQUESTS, warmup=WARMUP,
+        concurrency=CONCURRENCY, wallet_latency=WALLET_LATENCY, routes=None):
+    """
+    Benchmark the routes, all of them by default. Returns the results
+    """
+    from voucher_backend.app import create_app
+    from voucher_backend.models import DiscountModel
+    from voucher_backend.wallet import CircuitBreaker, wallet_client
+    from voucher_backend.wallet_stub import WalletStub
+
+    app = create_app()
+    context = app.app_context()
+    context.push()
+    db = app.db
+    url = db.engine.url
+    if not is_benchmark_database(url.get_backend_name(), url.database):
+        context.pop()
+        raise RuntimeError(f'Not a benchmark database, not seeded: {url!r}')
+    db.create_all()
+    ensure_seed(db, rows)
+
+    discount = DiscountModel.query.get(1)
+    if discount is None:
+        discount = DiscountModel(id=1, discountPercent=0.2)
+        db.session.add(discount)
+        db.session.commit()
+    discount_percent = discount.discountPercent
+
+    stub = WalletStub(latency=wallet_latency).start()
+    base_url, breaker = wallet_client.base_url, wallet_client.breaker
+    wallet_client.base_url, wallet_client.breaker = stub.url, CircuitBreaker()
+    pins, operation_id = prepare(db, warmup + requests)
+
+    results = {
+        'date': datetime.utcnow().isoformat(),
+        'engine': db.engine.dialect.name,
+        'rows': rows,
+        'requests': requests,
+        'concurrency': concurrency,
+        'walletLatency': wallet_latency,
+        'routes': {},
+    }
+    try:
+        for route in make_routes(pins, operation_id, discount_percent):
+            if routes and route.name not in routes:
+                continue
+            result = summarise(*measure(app, route, requests, warmup,
+                                        concurrency))
+            results['routes'][route.name] = result
+            print(f'{route.name:>24}: p50 {result["p50Ms"]:8.2f} ms  '
+                  f'p95 {result["p95Ms"]:8.2f} ms  '
+                  f'p99 {result["p99Ms"]:8.2f} ms  '
+                  f'{result["throughput"]:8.1f} req/s  '
+                  f'{result["errors"]} errors', file=sys.stderr)
+    finally:
+        wallet_client.base_url, wallet_client.breaker = base_url, breaker
+        stub.stop()
+        db.session.rollback()
+        clean_up(db, operation_id)
+        discount = DiscountModel.query.get(1)
+        discount.discountPercent = discount_percent
+        db.session.commit()
+        context.pop()
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the routes of the API')
+    parser.add_argument('--engine', choices=ENGINES, default='sqlite')
+    parser.add_argument('--database',
+                        help='SQLite file, a temporary one by default, or '
+                             'Postgres database whose name holds '
+                             f'"{BENCHMARK_DATABASE_MARK}"')
+    parser.add_argument('--rows', type=int, default=ROWS,
+                        help='Vouchers to seed, e.g. 10000, 1000000, 10000000')
+    parser.add_argument('--requests', type=int, default=REQUESTS,
+                        help='Measured requests per route')
+    parser.add_argument('--warmup', type=int, default=WARMUP)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--wallet-latency', type=float,
+                        default=WALLET_LATENCY,
+                        help='Seconds the wallet stub takes to answer')
+    parser.add_argument('--route', action='append', dest='routes',
+                        help='Only benchmark this route, can be repeated')
+    parser.add_argument('--output', help='Write the results to this file')
+    parser.add_argument('--baseline',
+                        help='Fail on regressions since these results')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    temporary = None
+    if args.engine == 'sqlite' and args.database is None:
+        temporary = tempfile.mkdtemp(prefix='voucher-benchmark-')
+        args.database = os.path.join(temporary, 'db.sqlite3')
+    if not is_benchmark_database(args.engine, args.database):
+        parser.error('--database must be a temporary SQLite file or a '
+                     f'database whose name holds "{BENCHMARK_DATABASE_MARK}"'
+                     ', it is seeded')
+
+    # Read when the app is imported, environment.env does not override them
+    os.environ['DATABASE_ENGINE'] = ENGINES[args.engine]
+    os.environ['SQLITE_PATH' if args.engine == 'sqlite'
+               else 'POSTGRES_DB'] = args.database
+    # Nor is its replica read
+    os.environ['DATABASE_REPLICA_URI'] = ''
+    from voucher_backend.config import load_environment
+    load_environment()
+    try:
+        results = run(args.rows, args.requests, args.warmup,
+                      args.concurrency, args.wallet_latency, args.routes)
+    finally:
+        if temporary:
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as stream:
+            baseline = json.load(stream)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            print(f'{name}: p95 {before:.2f} ms -> {after:.2f} ms',
+                  file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
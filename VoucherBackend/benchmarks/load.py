@@ -0,0 +1,237 @@
+"""
+Throughput of voucher purchases as the wallet slows down, in the sync and
+gevent worker modes.
+
+    $ python -m benchmarks.load --latency 0.01 --latency 0.1 --latency 0.5
+    $ python -m benchmarks.load --concurrency 200 --output load.json
+
+The app runs in a server process per mode: a single threaded WSGI server
+for the sync mode, like uwsgi with processes=1, and the gevent server of
+cooperative.py for the gevent mode. The wallet is a local stub answering
+after each --latency, and --concurrency clients send purchases to the
+server. In the sync mode the throughput drops as the wallet slows down, in
+the gevent mode it holds until the server runs out of CPU.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import requests
+
+from benchmarks.endpoints import make_header, percentile
+
+MODES = ('sync', 'gevent')
+LATENCIES = (0.01, 0.05, 0.1, 0.2)
+REQUESTS = 200
+CONCURRENCY = 50
+# Purchases sent to a new server before the measures
+WARMUP = 5
+STARTUP_TIMEOUT = 30
+
+LOAD_DRIVER_ID = 'load-driver'
+
+# Run in the server process, with WORKER_MODE set
+SERVER = '''
+import sys
+
+from voucher_backend import cooperative
+
+cooperative.patch()
+
+from voucher_backend.app import create_app
+
+application = create_app()
+port = int(sys.argv[1])
+if cooperative.is_cooperative():
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(('127.0.0.1', port), application, log=None).serve_forever()
+else:
+    from wsgiref.simple_server import (WSGIRequestHandler, WSGIServer,
+                                       make_server)
+
+    class Server(WSGIServer):
+        # The listen queue of uwsgi
+        request_queue_size = 100
+
+    class Handler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    make_server('127.0.0.1', port, application, server_class=Server,
+                handler_class=Handler).serve_forever()
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, wallet_url):
+    """
+    Start the app in `mode`, returns the process and its url
+    """
+    port = free_port()
+    # All the purchases come from one driver, measured without shedding
+    env = dict(os.environ, WORKER_MODE=mode, WALLET_SERVICE=wallet_url,
+               WALLET_OUTBOX='0', ADMISSION_CONTROL='0')
+    process = subprocess.Popen([sys.executable, '-c', SERVER, str(port)],
+                               env=env)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'The {mode} server exited')
+        try:
+            requests.get(url + '/metrics', timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'The {mode} server did not start')
+
+
+def measure(url, requests_number, concurrency):
+    """
+    Send `requests_number` purchases from `concurrency` threads. Returns
+    the sorted latencies in seconds, the status codes and the wall time
+    """
+    headers = {'Authorization': make_header(
+        {'id': LOAD_DRIVER_ID, 'auth_id': LOAD_DRIVER_ID})}
+    data = {'driverPhoneNumber': '08000000000', 'voucherWorth': 1000}
+    remaining = iter(range(requests_number))
+    latencies, codes = [], Counter()
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                code = session.post(url + '/api/vouchers/', data=data,
+                                    headers=headers).status_code
+            except requests.RequestException:
+                code = 'error'
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                codes[code] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), codes, time.perf_counter() - start
+
+
+def summarise(latencies, codes, elapsed):
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50Ms': percentile(latencies, 50) * 1000,
+        'p95Ms': percentile(latencies, 95) * 1000,
+        'errors': sum(count for code, count in codes.items()
+                      if code != 201),
+        'statusCodes': {str(code): count for code, count in codes.items()},
+    }
+
+
+def run(modes=MODES, latencies=LATENCIES, requests_number=REQUESTS,
+        concurrency=CONCURRENCY):
+    """
+    Load every mode at every wallet latency. Returns the results
+    """
+    from voucher_backend.app import create_app
+    from voucher_backend.models import DiscountModel, VoucherModel
+    from voucher_backend.wallet_stub import WalletStub
+
+    app = create_app()
+    context = app.app_context()
+    context.push()
+    db = app.db
+    db.create_all()
+    if DiscountModel.query.get(1) is None:
+        db.session.add(DiscountModel(id=1, discountPercent=0.2))
+        db.session.commit()
+
+    stub = WalletStub().start()
+    results = {
+        'date': datetime.utcnow().isoformat(),
+        'engine': db.engine.dialect.name,
+        'requests': requests_number,
+        'concurrency': concurrency,
+        'modes': {},
+    }
+    try:
+        for mode in modes:
+            process, url = start_server(mode, stub.url)
+            try:
+                stub.latency = 0
+                measure(url, WARMUP, 1)
+                results['modes'][mode] = {}
+                for latency in latencies:
+                    stub.latency = latency
+                    result = summarise(*measure(url, requests_number,
+                                                concurrency))
+                    results['modes'][mode][str(latency)] = result
+                    print(f'{mode:>7} wallet {latency * 1000:6.0f} ms: '
+                          f'{result["throughput"]:8.1f} req/s  '
+                          f'p50 {result["p50Ms"]:8.1f} ms  '
+                          f'p95 {result["p95Ms"]:8.1f} ms  '
+                          f'{result["errors"]} errors', file=sys.stderr)
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        stub.stop()
+        VoucherModel.query.filter(
+            VoucherModel.driverId == LOAD_DRIVER_ID).delete(
+                synchronize_session=False)
+        db.session.commit()
+        context.pop()
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load the voucher purchases in each worker mode')
+    parser.add_argument('--mode', action='append', dest='modes',
+                        choices=MODES, help='Only this mode, can be repeated')
+    parser.add_argument('--latency', action='append', dest='latencies',
+                        type=float,
+                        help='Seconds the wallet takes to answer, can be '
+                             'repeated')
+    parser.add_argument('--requests', type=int, default=REQUESTS,
+                        help='Purchases per mode and latency')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--output', help='Write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = run(args.modes or MODES, args.latencies or LATENCIES,
+                  args.requests, args.concurrency)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
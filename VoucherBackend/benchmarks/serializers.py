@@ -0,0 +1,53 @@
+"""
+Per-row cost of serialising a page of 1000 vouchers.
+
+    $ python -m benchmarks.serializers
+"""
+import json
+import timeit
+from datetime import datetime
+
+from voucher_backend.api_namespace.api import (api, voucherModel,
+                                               voucher_serializer)
+from voucher_backend.models import VoucherModel
+
+PAGE_SIZE = 1000
+NUMBER = 20
+
+
+def make_page(page_size=PAGE_SIZE):
+    now = datetime.utcnow()
+    rows = [
+        (index, f'driver-{index % 10}', '08000000000', f'ab{index:04d}', 800,
+         1000, 200, None, 1, now)
+        for index in range(page_size)
+    ]
+    names = [column.name for column in voucher_serializer.columns]
+    vouchers = [VoucherModel(**dict(zip(names, row))) for row in rows]
+    return rows, vouchers
+
+
+def run(page_size=PAGE_SIZE, number=NUMBER):
+    rows, vouchers = make_page(page_size)
+    assert (json.dumps(api.marshal(vouchers, voucherModel))
+            == voucher_serializer.encode_list(rows))
+
+    cases = {
+        # The original path: marshal_with of ORM instances
+        'marshal_orm': lambda: json.dumps(api.marshal(vouchers,
+                                                      voucherModel)),
+        'compiled_dicts': lambda: json.dumps(
+            voucher_serializer.marshal_list(rows)),
+        'compiled_json': lambda: voucher_serializer.encode_list(rows),
+    }
+
+    results = {}
+    for name, case in cases.items():
+        seconds = timeit.timeit(case, number=number)
+        results[name] = seconds / number / page_size * 1e6
+        print(f'{name:>16}: {results[name]:9.2f} us/row')
+    return results
+
+
+if __name__ == '__main__':
+    run()
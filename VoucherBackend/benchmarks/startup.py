@@ -0,0 +1,180 @@
+"""
+Cold start of an app worker: the imports, create_app, and the warm up of
+startup.py, measured in fresh interpreters.
+
+    $ python -m benchmarks.startup --output startup.json
+    $ python -m benchmarks.startup --baseline startup.json
+
+The imports are timed with `python -X importtime`. The report lists the
+slowest top level imports and the packages taking the most import time.
+With --baseline, the run fails if a phase regressed by more than
+--tolerance.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+RUNS = 5
+TOP = 15
+TOLERANCE = 0.2
+PHASES = ('importMs', 'createAppMs', 'preloadMs', 'warmWorkerMs', 'totalMs')
+
+# Run in the measured interpreter, prints the time of each phase
+SCRIPT = '''
+import json
+import time
+
+start = time.perf_counter()
+from voucher_backend.app import create_app
+imported = time.perf_counter()
+application = create_app()
+created = time.perf_counter()
+
+from voucher_backend import startup
+startup.preload(application)
+preloaded = time.perf_counter()
+with application.app_context():
+    application.db.create_all()
+warm_start = time.perf_counter()
+startup.warm_worker(application)
+warmed = time.perf_counter()
+
+print(json.dumps({
+    'importMs': (imported - start) * 1000,
+    'createAppMs': (created - imported) * 1000,
+    'preloadMs': (preloaded - created) * 1000,
+    'warmWorkerMs': (warmed - warm_start) * 1000,
+    'totalMs': (preloaded - start + warmed - warm_start) * 1000,
+}))
+'''
+
+IMPORT_TIME = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+
+def parse_import_times(lines):
+    """
+    (module, self us, cumulative us, depth) of the `-X importtime` lines
+    """
+    imports = []
+    for line in lines:
+        match = IMPORT_TIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append((module, int(self_us), int(cumulative_us),
+                            len(indent) // 2))
+    return imports
+
+
+def summarise_imports(imports, top=TOP):
+    """
+    The slowest top level imports and the packages with the most import
+    time of their own, in milliseconds
+    """
+    modules = sorted(((module, cumulative) for module, _, cumulative, depth
+                      in imports if depth == 0),
+                     key=lambda item: item[1], reverse=True)
+    packages = defaultdict(int)
+    for module, self_us, _, _ in imports:
+        packages[module.split('.')[0]] += self_us
+    packages = sorted(packages.items(), key=lambda item: item[1],
+                      reverse=True)
+    return {
+        'modules': {module: us / 1000 for module, us in modules[:top]},
+        'packages': {package: us / 1000 for package, us in packages[:top]},
+        'importedModules': len(imports),
+    }
+
+
+def measure(engine='SQLITE'):
+    """
+    Time the start of the app in a new interpreter. Returns the phases and
+    the import times
+    """
+    env = dict(os.environ, DATABASE_ENGINE=engine)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SCRIPT],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+        universal_newlines=True)
+    if process.returncode:
+        errors = [line for line in process.stderr.splitlines()
+                  if not IMPORT_TIME.match(line)]
+        raise RuntimeError('The app did not start:\n' + '\n'.join(errors))
+    phases = json.loads(process.stdout.strip().splitlines()[-1])
+    return phases, parse_import_times(process.stderr.splitlines())
+
+
+def run(runs=RUNS, top=TOP, engine='SQLITE'):
+    """
+    Median of the phases over `runs` starts, and the import times of the
+    last one
+    """
+    samples = []
+    for _ in range(runs):
+        phases, imports = measure(engine)
+        samples.append(phases)
+
+    results = {
+        'date': datetime.utcnow().isoformat(),
+        'runs': runs,
+    }
+    for phase in PHASES:
+        results[phase] = statistics.median(sample[phase]
+                                           for sample in samples)
+    results.update(summarise_imports(imports, top))
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Phases that grew by more than `tolerance` since the baseline
+    """
+    return [(phase, baseline[phase], results[phase]) for phase in PHASES
+            if phase in baseline
+            and results[phase] > baseline[phase] * (1 + tolerance)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure the cold start of the app')
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--top', type=int, default=TOP,
+                        help='Imports and packages to list')
+    parser.add_argument('--engine', choices=('SQLITE', 'POSTGRESQL'),
+                        default='SQLITE')
+    parser.add_argument('--output', help='Write the results to this file')
+    parser.add_argument('--baseline',
+                        help='Fail on regressions since these results')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = run(args.runs, args.top, args.engine)
+    for phase in PHASES:
+        print(f'{phase:>14}: {results[phase]:8.1f}', file=sys.stderr)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as stream:
+            baseline = json.load(stream)
+        regressions = compare(results, baseline, args.tolerance)
+        for phase, before, after in regressions:
+            print(f'{phase}: {before:.1f} ms -> {after:.1f} ms',
+                  file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
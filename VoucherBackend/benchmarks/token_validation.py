@@ -0,0 +1,43 @@
+"""
+Per-request cost of validating the authentication header.
+
+    $ python -m benchmarks.token_validation
+"""
+import timeit
+
+import jwt
+
+from voucher_backend import config
+from voucher_backend.token_validation import (TokenCache,
+                                              generate_token_header,
+                                              validate_token_header)
+
+NUMBER = 2000
+
+
+def run(number=NUMBER):
+    header = generate_token_header({'id': 'benchmark'}, config.PRIVATE_KEY)
+    token = header.split(' ', 1)[1]
+    cache = TokenCache()
+
+    cases = {
+        # The original path: PEM parsed and signature verified every time
+        'pem_per_request': lambda: jwt.decode(token, config.PUBLIC_KEY,
+                                              algorithms=['RS256']),
+        'preparsed_key': lambda: validate_token_header(
+            header, config.PUBLIC_KEY, cache=None),
+        'cached_token': lambda: validate_token_header(
+            header, config.PUBLIC_KEY, cache=cache),
+    }
+
+    results = {}
+    for name, case in cases.items():
+        seconds = timeit.timeit(case, number=number)
+        results[name] = seconds / number * 1e6
+        print(f'{name:>16}: {results[name]:9.1f} us/request')
+    print(f'cache: {cache.stats()}')
+    return results
+
+
+if __name__ == '__main__':
+    run()
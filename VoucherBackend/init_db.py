@@ -1,4 +1,8 @@
-from voucher_backend.app import create_app
+from voucher_backend.config import load_environment
+
+load_environment()
+
+from voucher_backend.app import create_app  # noqa: E402
 
 if __name__ == '__main__':
     application = create_app()
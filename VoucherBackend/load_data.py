@@ -1,6 +1,10 @@
-from voucher_backend.app import create_app
-from voucher_backend.models import DiscountModel
-from datetime import datetime
+from voucher_backend.config import load_environment
+
+load_environment()
+
+from voucher_backend.app import create_app  # noqa: E402
+from voucher_backend.models import DiscountModel  # noqa: E402
+from datetime import datetime  # noqa: E402
 
 if __name__ == '__main__':
     application = create_app()
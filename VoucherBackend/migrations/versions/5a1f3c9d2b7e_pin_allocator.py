@@ -0,0 +1,72 @@
+"""pin allocator
+
+Revision ID: 5a1f3c9d2b7e
+Revises: 07f426ed2fe8
+Create Date: 2026-10-18 10:12:41.512304
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1f3c9d2b7e'
+down_revision = '07f426ed2fe8'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.env')
+
+
+def repin_duplicates():
+    """
+    Give new pins to the vouchers sharing their pin with another one, the
+    random pins of generate_pin could collide. An unused voucher keeps the
+    pin before a used one, then the oldest. The new pins end with the id of
+    the voucher, unlike those of the allocator
+    """
+    connection = op.get_bind()
+    duplicates = connection.execute(sa.text(
+        'SELECT id, pin, status FROM voucher_model WHERE pin IN '
+        '(SELECT pin FROM voucher_model GROUP BY pin HAVING count(*) > 1) '
+        'ORDER BY pin, CASE WHEN status = 1 THEN 0 ELSE 1 END, id'
+    )).fetchall()
+
+    kept = set()
+    for voucher_id, pin, status in duplicates:
+        if pin not in kept:
+            kept.add(pin)
+            continue
+        new_pin = f'{pin}-{voucher_id}'
+        connection.execute(
+            sa.text('UPDATE voucher_model SET pin = :new_pin WHERE id = :id'),
+            new_pin=new_pin, id=voucher_id)
+        logger.warning(f'Voucher {voucher_id} (status {status}) shared the '
+                       f'pin {pin}, its pin is now {new_pin}')
+    if duplicates:
+        logger.warning(f'Re-pinned {len(duplicates) - len(kept)} vouchers')
+
+
+def upgrade():
+    op.create_table('pin_allocator_model',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('nextIndex', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    repin_duplicates()
+    if op.get_bind().dialect.name != 'postgresql':
+        op.create_index(op.f('ix_voucher_model_pin'), 'voucher_model', ['pin'], unique=True)
+        return
+
+    # Built without locking the writes of voucher_model out, once the new
+    # pins are committed
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_voucher_model_pin'), 'voucher_model', ['pin'], unique=True,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_voucher_model_pin'), table_name='voucher_model')
+    op.drop_table('pin_allocator_model')
@@ -0,0 +1,57 @@
+"""voucher indexes
+
+Revision ID: 8c4e0b7a6d21
+Revises: 5a1f3c9d2b7e
+Create Date: 2026-10-18 11:03:17.208415
+
+"""
+from contextlib import contextmanager
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e0b7a6d21'
+down_revision = '5a1f3c9d2b7e'
+branch_labels = None
+depends_on = None
+
+
+@contextmanager
+def concurrently():
+    """
+    Outside of the transaction of the migration on Postgres, where the
+    indexes are built and dropped CONCURRENTLY: voucher_model keeps taking
+    writes meanwhile
+    """
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            yield
+    else:
+        yield
+
+
+def upgrade():
+    with concurrently():
+        op.create_index('ix_voucher_model_driverId_id', 'voucher_model', ['driverId', 'id'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_voucher_model_driverPhoneNumber_id', 'voucher_model', ['driverPhoneNumber', 'id'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_voucher_model_userPhoneNumber_id', 'voucher_model', ['userPhoneNumber', 'id'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_voucher_model_dateGenerated', 'voucher_model', ['dateGenerated'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_voucher_model_unused_id', 'voucher_model', ['id'], unique=False,
+                        postgresql_where=sa.text('status = 1'),
+                        sqlite_where=sa.text('status = 1'),
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with concurrently():
+        op.drop_index('ix_voucher_model_unused_id', table_name='voucher_model', postgresql_concurrently=True)
+        op.drop_index('ix_voucher_model_dateGenerated', table_name='voucher_model', postgresql_concurrently=True)
+        op.drop_index('ix_voucher_model_userPhoneNumber_id', table_name='voucher_model', postgresql_concurrently=True)
+        op.drop_index('ix_voucher_model_driverPhoneNumber_id', table_name='voucher_model', postgresql_concurrently=True)
+        op.drop_index('ix_voucher_model_driverId_id', table_name='voucher_model', postgresql_concurrently=True)
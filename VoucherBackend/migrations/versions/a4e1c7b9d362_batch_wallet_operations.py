@@ -0,0 +1,30 @@
+"""batch wallet operations
+
+Revision ID: a4e1c7b9d362
+Revises: f3b8d6a1c947
+Create Date: 2026-10-19 09:14:52.301846
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4e1c7b9d362'
+down_revision = 'f3b8d6a1c947'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('wallet_operation_model', sa.Column('voucherIds', sa.Text(), nullable=True))
+
+
+def downgrade():
+    # The partial index would lose its condition when SQLite copies the table
+    op.drop_index('ix_wallet_operation_model_pending_id', table_name='wallet_operation_model')
+    with op.batch_alter_table('wallet_operation_model') as batch_op:
+        batch_op.drop_column('voucherIds')
+    op.create_index('ix_wallet_operation_model_pending_id', 'wallet_operation_model', ['id'], unique=False,
+                    postgresql_where=sa.text("status = 'pending'"),
+                    sqlite_where=sa.text("status = 'pending'"))
@@ -0,0 +1,24 @@
+"""discount version
+
+Revision ID: b2d9f41c7e05
+Revises: 8c4e0b7a6d21
+Create Date: 2026-10-18 11:47:52.730164
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d9f41c7e05'
+down_revision = '8c4e0b7a6d21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('discount_model', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('discount_model', 'version')
@@ -0,0 +1,59 @@
+"""in flight wallet operations
+
+Revision ID: b6d0e3f8a215
+Revises: c8f2d5a0e6b4
+Create Date: 2026-10-20 15:26:48.730144
+
+"""
+from contextlib import contextmanager
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d0e3f8a215'
+down_revision = 'c8f2d5a0e6b4'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.env')
+
+
+@contextmanager
+def concurrently():
+    """
+    Outside of the transaction of the migration on Postgres, where the
+    index is built and dropped CONCURRENTLY
+    """
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            yield
+    else:
+        yield
+
+
+def report_reserved_vouchers():
+    # Their top-up was not recorded, only the wallet can tell whether the
+    # rider was topped up
+    reserved = op.get_bind().execute(sa.text(
+        'SELECT id FROM voucher_model WHERE status = 4 ORDER BY id')).fetchall()
+    if reserved:
+        logger.warning(f'{len(reserved)} vouchers reserved without a wallet operation, '
+                       f'to reconcile by hand: {[voucher_id for voucher_id, in reserved]}')
+
+
+def upgrade():
+    report_reserved_vouchers()
+    with concurrently():
+        op.create_index('ix_wallet_operation_model_in_flight_dateCreated', 'wallet_operation_model', ['dateCreated'], unique=False,
+                        postgresql_where=sa.text("status = 'in_flight'"),
+                        sqlite_where=sa.text("status = 'in_flight'"),
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with concurrently():
+        op.drop_index('ix_wallet_operation_model_in_flight_dateCreated', table_name='wallet_operation_model',
+                      postgresql_concurrently=True)
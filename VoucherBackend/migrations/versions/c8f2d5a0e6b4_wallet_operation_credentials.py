@@ -0,0 +1,78 @@
+"""wallet operation credentials
+
+Revision ID: c8f2d5a0e6b4
+Revises: a4e1c7b9d362
+Create Date: 2026-10-20 10:42:17.518203
+
+"""
+import base64
+import json
+import logging
+from contextlib import contextmanager
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8f2d5a0e6b4'
+down_revision = 'a4e1c7b9d362'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.env')
+
+
+def token_auth_id(authorization):
+    """
+    auth_id of the unverified bearer token `authorization`, None if it
+    cannot be read
+    """
+    try:
+        payload = authorization.split(' ')[-1].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get('auth_id')
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+
+@contextmanager
+def pending_index_dropped():
+    # The partial index would lose its condition when SQLite copies the table
+    op.drop_index('ix_wallet_operation_model_pending_id', table_name='wallet_operation_model')
+    yield
+    op.create_index('ix_wallet_operation_model_pending_id', 'wallet_operation_model', ['id'], unique=False,
+                    postgresql_where=sa.text("status = 'pending'"),
+                    sqlite_where=sa.text("status = 'pending'"))
+
+
+def upgrade():
+    op.add_column('wallet_operation_model', sa.Column('authId', sa.String(length=250), nullable=True))
+    op.add_column('wallet_operation_model', sa.Column('nextAttempt', sa.DateTime(), nullable=True))
+
+    connection = op.get_bind()
+    operations = connection.execute(sa.text(
+        'SELECT id, "authorization" FROM wallet_operation_model')).fetchall()
+    for operation_id, authorization in operations:
+        auth_id = token_auth_id(authorization)
+        if auth_id is None:
+            logger.warning(f'No auth_id in the token of wallet operation {operation_id}')
+            auth_id = ''
+        connection.execute(
+            sa.text('UPDATE wallet_operation_model SET "authId" = :auth_id WHERE id = :id'),
+            auth_id=auth_id, id=operation_id)
+
+    # The tokens of the drivers are no longer kept
+    with pending_index_dropped():
+        with op.batch_alter_table('wallet_operation_model') as batch_op:
+            batch_op.alter_column('authId', existing_type=sa.String(length=250), nullable=False)
+            batch_op.drop_column('authorization')
+
+
+def downgrade():
+    # The tokens are lost, the pending operations would be sent without one
+    with pending_index_dropped():
+        with op.batch_alter_table('wallet_operation_model') as batch_op:
+            batch_op.add_column(sa.Column('authorization', sa.Text(), nullable=False, server_default=''))
+            batch_op.drop_column('nextAttempt')
+            batch_op.drop_column('authId')
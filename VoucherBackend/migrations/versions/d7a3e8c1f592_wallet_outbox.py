@@ -0,0 +1,47 @@
+"""wallet outbox
+
+Revision ID: d7a3e8c1f592
+Revises: b2d9f41c7e05
+Create Date: 2026-10-18 12:31:05.944718
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a3e8c1f592'
+down_revision = 'b2d9f41c7e05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('wallet_operation_model',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('idempotencyKey', sa.String(length=36), nullable=False),
+    sa.Column('operation', sa.String(length=50), nullable=False),
+    sa.Column('voucherId', sa.Integer(), nullable=False),
+    sa.Column('authorization', sa.Text(), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=False),
+    sa.Column('phoneNumber', sa.String(length=250), nullable=True),
+    sa.Column('description', sa.String(length=250), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('responseStatus', sa.Integer(), nullable=True),
+    sa.Column('responseBody', sa.Text(), nullable=True),
+    sa.Column('dateCreated', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.Column('dateProcessed', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('idempotencyKey')
+    )
+    op.create_index(op.f('ix_wallet_operation_model_voucherId'), 'wallet_operation_model', ['voucherId'], unique=False)
+    op.create_index('ix_wallet_operation_model_pending_id', 'wallet_operation_model', ['id'], unique=False,
+                    postgresql_where=sa.text("status = 'pending'"),
+                    sqlite_where=sa.text("status = 'pending'"))
+
+
+def downgrade():
+    op.drop_index('ix_wallet_operation_model_pending_id', table_name='wallet_operation_model')
+    op.drop_index(op.f('ix_wallet_operation_model_voucherId'), table_name='wallet_operation_model')
+    op.drop_table('wallet_operation_model')
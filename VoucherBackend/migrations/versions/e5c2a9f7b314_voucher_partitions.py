@@ -0,0 +1,224 @@
+"""voucher partitions
+
+Revision ID: e5c2a9f7b314
+Revises: d7a3e8c1f592
+Create Date: 2026-10-18 15:20:43.108265
+
+"""
+from datetime import datetime
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5c2a9f7b314'
+down_revision = 'd7a3e8c1f592'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.env')
+
+# Monthly partitions created past the current month, then by the worker
+PARTITIONS_AHEAD = 3
+# Vouchers whose pin is registered per transaction
+PIN_BATCH_SIZE = 10000
+
+# Indexes of voucher_model kept as they are by the legacy partition
+LEGACY_INDEXES = ('ix_voucher_model_driverId_id', 'ix_voucher_model_driverPhoneNumber_id',
+                  'ix_voucher_model_userPhoneNumber_id', 'ix_voucher_model_dateGenerated',
+                  'ix_voucher_model_unused_id')
+
+VOUCHER_COLUMNS = ('id', 'driverId', 'driverPhoneNumber', 'pin',
+                   'amountBought', 'voucherWorth', 'discountAmount',
+                   'userPhoneNumber', 'status', 'dateGenerated', 'timeUsed')
+
+
+# Registers the pin of every voucher in voucher_pin, whose primary key keeps
+# them unique across the partitions. Archived vouchers leave it, their pin
+# may be issued again
+PIN_REGISTRY_FUNCTION = """
+CREATE FUNCTION voucher_pin_registry() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM voucher_pin WHERE pin = OLD.pin;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO voucher_pin (pin) VALUES (NEW.pin);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def create_voucher_indexes(unique_pin):
+    op.create_index(op.f('ix_voucher_model_pin'), 'voucher_model', ['pin'], unique=unique_pin)
+    op.create_index('ix_voucher_model_driverId_id', 'voucher_model', ['driverId', 'id'], unique=False)
+    op.create_index('ix_voucher_model_driverPhoneNumber_id', 'voucher_model', ['driverPhoneNumber', 'id'], unique=False)
+    op.create_index('ix_voucher_model_userPhoneNumber_id', 'voucher_model', ['userPhoneNumber', 'id'], unique=False)
+    op.create_index('ix_voucher_model_dateGenerated', 'voucher_model', ['dateGenerated'], unique=False)
+    op.create_index('ix_voucher_model_unused_id', 'voucher_model', ['id'], unique=False,
+                    postgresql_where=sa.text('status = 1'))
+
+
+def legacy_name(name):
+    return name.replace('voucher_model', 'voucher_model_legacy', 1)
+
+
+def create_pin_registry():
+    op.create_table('voucher_pin',
+    sa.Column('pin', sa.String(length=250), nullable=False),
+    sa.PrimaryKeyConstraint('pin')
+    )
+    op.execute(PIN_REGISTRY_FUNCTION)
+    # Cloned on every partition, also the ones created later
+    op.execute('CREATE TRIGGER voucher_model_pin '
+               'AFTER INSERT OR DELETE OR UPDATE OF pin ON voucher_model '
+               'FOR EACH ROW EXECUTE PROCEDURE voucher_pin_registry()')
+
+
+def fill_pin_registry():
+    """
+    Register the pins of the vouchers already there, PIN_BATCH_SIZE ids at
+    a time, each batch committed on its own. The new vouchers register
+    themselves
+    """
+    connection = op.get_bind()
+    last = connection.execute('SELECT max(id) FROM voucher_model_legacy').scalar() or 0
+    for low in range(0, last + 1, PIN_BATCH_SIZE):
+        connection.execute(
+            sa.text('INSERT INTO voucher_pin (pin) SELECT pin FROM voucher_model_legacy '
+                    'WHERE id >= :low AND id < :high ON CONFLICT DO NOTHING'),
+            low=low, high=low + PIN_BATCH_SIZE)
+    logger.info(f'Registered the pins of the vouchers up to {last}')
+
+
+def upgrade():
+    op.create_table('voucher_archive_model',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('driverId', sa.String(length=250), nullable=False),
+    sa.Column('driverPhoneNumber', sa.String(length=250), nullable=False),
+    sa.Column('pin', sa.String(length=250), nullable=False),
+    sa.Column('amountBought', sa.Integer(), nullable=False),
+    sa.Column('voucherWorth', sa.Integer(), nullable=False),
+    sa.Column('discountAmount', sa.Integer(), nullable=True),
+    sa.Column('userPhoneNumber', sa.String(length=250), nullable=True),
+    sa.Column('status', sa.Integer(), nullable=True),
+    sa.Column('dateGenerated', sa.DateTime(), nullable=False),
+    sa.Column('timeUsed', sa.DateTime(), nullable=True),
+    sa.Column('dateArchived', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    # Not unique: a pin issued again after its voucher was archived must not
+    # stop the archival
+    op.create_index(op.f('ix_voucher_archive_model_pin'), 'voucher_archive_model', ['pin'], unique=False)
+    op.create_index('ix_voucher_archive_model_driverId_id', 'voucher_archive_model', ['driverId', 'id'], unique=False)
+    op.create_index('ix_voucher_archive_model_dateGenerated', 'voucher_archive_model', ['dateGenerated'], unique=False)
+
+    op.execute('UPDATE voucher_model SET "dateGenerated" = '
+               'COALESCE("timeUsed", CURRENT_TIMESTAMP) '
+               'WHERE "dateGenerated" IS NULL')
+    if op.get_bind().dialect.name != 'postgresql':
+        # Not partitioned
+        return
+
+    # Partitioned by month of dateGenerated, which the primary key and the
+    # unique indexes have to hold. The unique pins are kept in voucher_pin
+    # instead, filled by a trigger in the transaction of the voucher.
+    # The vouchers are not copied: the table becomes voucher_model_legacy,
+    # the partition of the months up to the current one, whose missing
+    # indexes are built beforehand without locking the writes out
+    now = datetime.utcnow()
+    month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = add_months(month, 1)
+    with op.get_context().autocommit_block():
+        # Checked once without blocking the writes, the partition is then
+        # attached without a scan
+        op.execute('ALTER TABLE voucher_model ADD CONSTRAINT voucher_model_legacy_range '
+                   f'CHECK ("dateGenerated" IS NOT NULL AND "dateGenerated" < \'{end:%Y-%m-%d}\') NOT VALID')
+        op.execute('ALTER TABLE voucher_model VALIDATE CONSTRAINT voucher_model_legacy_range')
+        op.create_index('voucher_model_legacy_pkey', 'voucher_model', ['id', 'dateGenerated'], unique=True,
+                        postgresql_concurrently=True)
+        op.create_index('ix_voucher_model_legacy_pin', 'voucher_model', ['pin'], unique=False,
+                        postgresql_concurrently=True)
+
+    # Quick catalog changes, in one transaction. The validated check spares
+    # the scan of SET NOT NULL (Postgres 12) and of ATTACH PARTITION
+    op.execute('ALTER TABLE voucher_model ALTER COLUMN "dateGenerated" SET NOT NULL')
+    op.execute('ALTER TABLE voucher_model DROP CONSTRAINT voucher_model_pkey, '
+               'ADD CONSTRAINT voucher_model_legacy_pkey PRIMARY KEY USING INDEX voucher_model_legacy_pkey')
+    op.execute('ALTER INDEX ix_voucher_model_pin RENAME TO ix_voucher_model_legacy_pin_unique')
+    for name in LEGACY_INDEXES:
+        op.execute(f'ALTER INDEX "{name}" RENAME TO "{legacy_name(name)}"')
+    op.execute('ALTER TABLE voucher_model RENAME TO voucher_model_legacy')
+    op.execute('ALTER SEQUENCE voucher_model_id_seq OWNED BY NONE')
+    op.execute('CREATE TABLE voucher_model '
+               '(LIKE voucher_model_legacy INCLUDING DEFAULTS) '
+               'PARTITION BY RANGE ("dateGenerated")')
+    op.execute('ALTER SEQUENCE voucher_model_id_seq OWNED BY voucher_model.id')
+    op.execute('ALTER TABLE voucher_model ADD PRIMARY KEY (id, "dateGenerated")')
+    create_voucher_indexes(unique_pin=False)
+    # Its indexes match the ones of voucher_model and are attached to them,
+    # none is built
+    op.execute('ALTER TABLE voucher_model ATTACH PARTITION voucher_model_legacy '
+               f"FOR VALUES FROM (MINVALUE) TO ('{end:%Y-%m-%d}')")
+    op.execute('ALTER TABLE voucher_model_legacy DROP CONSTRAINT voucher_model_legacy_range')
+
+    last = add_months(month, PARTITIONS_AHEAD)
+    month = end
+    while month <= last:
+        following = add_months(month, 1)
+        op.execute(f'CREATE TABLE voucher_model_y{month:%Y}m{month:%m} '
+                   'PARTITION OF voucher_model '
+                   f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')")
+        month = following
+    op.execute('CREATE TABLE voucher_model_default PARTITION OF voucher_model DEFAULT')
+    create_pin_registry()
+
+    with op.get_context().autocommit_block():
+        fill_pin_registry()
+        # Until then it kept the pins of the new vouchers unique
+        op.drop_index('ix_voucher_model_legacy_pin_unique', table_name='voucher_model_legacy',
+                      postgresql_concurrently=True)
+
+
+def downgrade():
+    columns = ', '.join(f'"{column}"' for column in VOUCHER_COLUMNS)
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP TRIGGER voucher_model_pin ON voucher_model')
+        op.execute('DROP FUNCTION voucher_pin_registry()')
+        op.drop_table('voucher_pin')
+        op.execute('ALTER TABLE voucher_model RENAME TO voucher_model_partitioned')
+        op.execute('ALTER SEQUENCE voucher_model_id_seq OWNED BY NONE')
+        op.execute('CREATE TABLE voucher_model '
+                   '(LIKE voucher_model_partitioned INCLUDING DEFAULTS)')
+        op.execute('INSERT INTO voucher_model SELECT * FROM voucher_model_partitioned')
+        op.execute('DROP TABLE voucher_model_partitioned')
+        op.execute('ALTER SEQUENCE voucher_model_id_seq OWNED BY voucher_model.id')
+        op.execute('ALTER TABLE voucher_model ADD PRIMARY KEY (id)')
+        op.execute('ALTER TABLE voucher_model ALTER COLUMN "dateGenerated" DROP NOT NULL')
+        create_voucher_indexes(unique_pin=True)
+
+    # The archived vouchers go back with the others. Those whose pin was
+    # issued again are re-pinned, as in 5a1f3c9d2b7e
+    selected = ', '.join(
+        'CASE WHEN EXISTS (SELECT 1 FROM voucher_model WHERE voucher_model.pin = archive.pin) '
+        'OR EXISTS (SELECT 1 FROM voucher_archive_model other '
+        'WHERE other.pin = archive.pin AND other.id < archive.id) '
+        "THEN archive.pin || '-' || CAST(archive.id AS VARCHAR) ELSE archive.pin END"
+        if column == 'pin' else f'archive."{column}"'
+        for column in VOUCHER_COLUMNS)
+    op.execute(f'INSERT INTO voucher_model ({columns}) '
+               f'SELECT {selected} FROM voucher_archive_model archive')
+    op.drop_index('ix_voucher_archive_model_dateGenerated', table_name='voucher_archive_model')
+    op.drop_index('ix_voucher_archive_model_driverId_id', table_name='voucher_archive_model')
+    op.drop_index(op.f('ix_voucher_archive_model_pin'), table_name='voucher_archive_model')
+    op.drop_table('voucher_archive_model')
@@ -0,0 +1,65 @@
+"""voucher rollups
+
+Revision ID: f3b8d6a1c947
+Revises: e5c2a9f7b314
+Create Date: 2026-10-18 16:42:19.553920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d6a1c947'
+down_revision = 'e5c2a9f7b314'
+branch_labels = None
+depends_on = None
+
+
+def hour_of(column):
+    """
+    SQL of the UTC hour of a date column, stored as SQLAlchemy stores the
+    dates on SQLite, for the upserts of rollups.py to find the same rows
+    """
+    if op.get_bind().dialect.name == 'postgresql':
+        return f'date_trunc(\'hour\', "{column}")'
+    return f'strftime(\'%Y-%m-%d %H:00:00.000000\', "{column}")'
+
+
+def backfill_rollups():
+    """
+    Roll up the vouchers already there, live and archived, cancelled
+    purchases left out, as rollups.rebuild_rollups() does
+    """
+    generated, used = hour_of('dateGenerated'), hour_of('timeUsed')
+    hours = ' UNION ALL '.join(
+        f'SELECT {generated} AS hour, COUNT(*) AS issued, '
+        f'SUM("amountBought") AS "amountBought", SUM("voucherWorth") AS "voucherWorth", 0 AS redeemed '
+        f'FROM {table} WHERE "dateGenerated" IS NOT NULL AND (status IS NULL OR status != 3) '
+        f'GROUP BY {generated} '
+        f'UNION ALL '
+        f'SELECT {used}, 0, 0, 0, COUNT(*) '
+        f'FROM {table} WHERE status = 2 AND "timeUsed" IS NOT NULL GROUP BY {used}'
+        for table in ('voucher_model', 'voucher_archive_model'))
+    op.execute(
+        'INSERT INTO voucher_rollup_model '
+        '(hour, shard, issued, "amountBought", "voucherWorth", redeemed) '
+        'SELECT hour, 0, SUM(issued), SUM("amountBought"), SUM("voucherWorth"), SUM(redeemed) '
+        f'FROM ({hours}) AS hours GROUP BY hour')
+
+
+def upgrade():
+    op.create_table('voucher_rollup_model',
+    sa.Column('hour', sa.DateTime(), nullable=False),
+    sa.Column('shard', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('issued', sa.Integer(), nullable=False),
+    sa.Column('amountBought', sa.BigInteger(), nullable=False),
+    sa.Column('voucherWorth', sa.BigInteger(), nullable=False),
+    sa.Column('redeemed', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('hour', 'shard')
+    )
+    backfill_rollups()
+
+
+def downgrade():
+    op.drop_table('voucher_rollup_model')
@@ -1,15 +1,126 @@
-import pytest
-from area_backend.app import create_app
-
-
-@pytest.area
-def app():
-    application = create_app()
-
-    application.app_context().push()
-    # Initialise the DB
-    application.db.create_all()
-
-    return application
-
-# todo: add area for reviews
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+# The tests run on a SQLite database of their own, created for the session,
+# never on db.sqlite3 or the database of the environment. Set before the
+# app is imported, and inherited by the processes the tests start
+TEST_DATABASE_DIR = tempfile.mkdtemp(prefix='voucher-tests-')
+os.environ['DATABASE_ENGINE'] = 'SQLITE'
+os.environ['SQLITE_PATH'] = os.path.join(TEST_DATABASE_DIR, 'db.sqlite3')
+os.environ.pop('DATABASE_REPLICA_URI', None)
+
+from voucher_backend.app import create_app  # noqa: E402
+
+
+@pytest.fixture(scope='session', autouse=True)
+def test_database():
+    yield os.environ['SQLITE_PATH']
+    shutil.rmtree(TEST_DATABASE_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def app():
+    from voucher_backend.admission import driver_buckets
+    from voucher_backend.stats_cache import stats_cache
+    from voucher_backend.voucher_cache import voucher_cache
+
+    application = create_app()
+    # Vouchers changed straight in the database are not invalidated
+    voucher_cache.clear()
+    stats_cache.clear()
+    driver_buckets.clear()
+    # Fail the requests over their query budget
+    application.config['TESTING'] = True
+
+    application.app_context().push()
+    # Initialise the DB
+    application.db.create_all()
+
+    return application
+
+
+@pytest.fixture
+def discount(app):
+    from voucher_backend.models import DiscountModel
+
+    discount = DiscountModel.query.get(1)
+    if discount is None:
+        discount = DiscountModel(id=1, discountPercent=0.2)
+        app.db.session.add(discount)
+        app.db.session.commit()
+    return discount
+
+
+@pytest.fixture
+def driver_header(app):
+    from voucher_backend.models import VoucherModel, WalletOperationModel
+    from voucher_backend.rollups import rebuild_rollups
+    from voucher_backend.token_validation import encode_token
+    from .constants import PRIVATE_KEY
+
+    driver_id = 'test-driver'
+    payload = {
+        'id': driver_id,
+        'auth_id': driver_id,
+        'exp': datetime.utcnow() + timedelta(days=2),
+    }
+    token = encode_token(payload, PRIVATE_KEY).decode('utf8')
+    yield f'Bearer {token}'
+
+    # Remove the vouchers created by the test and their wallet operations,
+    # and roll up the vouchers left
+    VoucherModel.query.filter(VoucherModel.driverId == driver_id).delete()
+    WalletOperationModel.query.filter(
+        WalletOperationModel.authId == driver_id).delete()
+    app.db.session.commit()
+    rebuild_rollups()
+
+
+@pytest.fixture
+def admin_header(app):
+    from voucher_backend.token_validation import encode_token
+    from .constants import PRIVATE_KEY
+
+    payload = {
+        'id': 'test-admin',
+        'auth_id': 'test-admin',
+        'admin': True,
+        'exp': datetime.utcnow() + timedelta(days=2),
+    }
+    token = encode_token(payload, PRIVATE_KEY).decode('utf8')
+    return f'Bearer {token}'
+
+
+@pytest.fixture
+def wallet_stub():
+    from voucher_backend.wallet import CircuitBreaker, wallet_client
+    from voucher_backend.wallet_stub import WalletStub
+
+    stub = WalletStub().start()
+    base_url, breaker = wallet_client.base_url, wallet_client.breaker
+    service_authorization = wallet_client.service_authorization
+    wallet_client.base_url = stub.url
+    wallet_client.breaker = CircuitBreaker()
+    wallet_client.service_authorization = 'Bearer wallet-service'
+    yield stub
+
+    wallet_client.base_url, wallet_client.breaker = base_url, breaker
+    wallet_client.service_authorization = service_authorization
+    stub.stop()
+
+
+@pytest.fixture
+def slow_wallet(wallet_stub, monkeypatch):
+    from voucher_backend.wallet import wallet_client
+
+    # Answers after the read timeout
+    monkeypatch.setattr(wallet_client, 'timeout', (1, 0.05))
+    wallet_stub.latency = 0.2
+    yield wallet_stub
+    # The late answers must not reach the next test
+    time.sleep(0.2)
@@ -0,0 +1,20 @@
+"""
+Helpers shared by the tests
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def count_statements():
+    """
+    Record the SQL statements executed from now on. Returns the list of
+    statements and a function to stop recording
+    """
+    statements = []
+
+    def before_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', before_execute)
+    return statements, lambda: event.remove(Engine, 'before_cursor_execute',
+                                            before_execute)
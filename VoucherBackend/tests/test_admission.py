@@ -0,0 +1,140 @@
+"""
+Test the admission control of the write endpoints
+"""
+import http.client
+import threading
+import time
+
+import pytest
+
+from voucher_backend import admission
+from voucher_backend.admission import (PURCHASE, DriverBuckets, Gate,
+                                       LocalBucketStore)
+from voucher_backend.models import VoucherModel
+
+from .helpers import count_statements
+
+
+def buy_voucher(client, driver_header):
+    return client.post('/api/vouchers/',
+                       data={'driverPhoneNumber': '08012345678',
+                             'voucherWorth': 1000},
+                       headers={'Authorization': driver_header})
+
+
+@pytest.fixture
+def purchase_gate(monkeypatch):
+    gate = Gate(PURCHASE, limit=1, queue_size=1, timeout=0.2)
+    monkeypatch.setitem(admission.gates, PURCHASE, gate)
+    return gate
+
+
+def test_gate_queue():
+    gate = Gate('test', limit=1, queue_size=1, timeout=0.2)
+    assert gate.enter() is None
+
+    results = []
+    waiting = threading.Thread(target=lambda: results.append(gate.enter()))
+    waiting.start()
+    time.sleep(0.05)
+    assert 'queue_full' == gate.enter()
+    waiting.join()
+    assert ['timeout'] == results
+
+    # Admitted when a place frees up before the deadline
+    waiting = threading.Thread(target=lambda: results.append(gate.enter()))
+    waiting.start()
+    time.sleep(0.05)
+    gate.leave()
+    waiting.join()
+    assert [None] == results[1:]
+    assert 1 == gate.in_flight
+
+
+def test_gate_without_limit():
+    gate = Gate('test', limit=0, queue_size=0)
+    assert [None] * 3 == [gate.enter() for _ in range(3)]
+
+
+def test_driver_bucket():
+    buckets = DriverBuckets(LocalBucketStore(), rate=10, burst=2)
+    assert [0, 0] == [buckets.take('driver') for _ in range(2)]
+    assert 0.1 == pytest.approx(buckets.take('driver'), abs=0.01)
+    assert 0 == buckets.take('other-driver')
+
+    time.sleep(0.1)
+    assert 0 == buckets.take('driver')
+
+
+def test_local_buckets_are_bounded():
+    store = LocalBucketStore(maxsize=2)
+    for driver in ('first', 'second', 'third'):
+        store.take(driver, 1, 1)
+    # Forgotten, full again
+    assert 0 == store.take('first', 1, 1)
+    assert 0 < store.take('third', 1, 1)
+
+
+def test_driver_over_their_rate(client, discount, driver_header, wallet_stub,
+                                monkeypatch):
+    monkeypatch.setattr(admission, 'driver_buckets',
+                        DriverBuckets(LocalBucketStore(), rate=0.5, burst=1))
+    assert http.client.CREATED == buy_voucher(client,
+                                              driver_header).status_code
+
+    statements, stop = count_statements()
+    try:
+        response = buy_voucher(client, driver_header)
+    finally:
+        stop()
+    assert http.client.SERVICE_UNAVAILABLE == response.status_code
+    assert 'Driver Rate Exceeded' == response.json['message']
+    assert '2' == response.headers['Retry-After']
+    assert 0 == len(statements)
+
+
+def test_overloaded_writes_are_shed(app, client, discount, driver_header,
+                                    wallet_stub, purchase_gate):
+    voucher = VoucherModel(driverId='test-driver', driverPhoneNumber='0',
+                           pin='ad0001', amountBought=800, voucherWorth=1000,
+                           status=1)
+    app.db.session.add(voucher)
+    app.db.session.commit()
+
+    purchase_gate.enter()
+    response = buy_voucher(client, driver_header)
+    assert http.client.SERVICE_UNAVAILABLE == response.status_code
+    assert str(admission.ADMISSION_RETRY_AFTER) == \
+        response.headers['Retry-After']
+
+    # The reads and the other class of writes are still served
+    response = client.get('/api/vouchers/pin/ad0001/',
+                          headers={'Authorization': driver_header})
+    assert http.client.OK == response.status_code
+    response = client.put('/api/vouchers/buy/ad0001/',
+                          data={'userPhoneNumber': '08087654321'},
+                          headers={'Authorization': driver_header})
+    assert http.client.OK == response.status_code
+
+    purchase_gate.leave()
+    assert http.client.CREATED == buy_voucher(client,
+                                              driver_header).status_code
+    assert 0 == purchase_gate.in_flight
+
+
+def test_queued_write_is_served(client, discount, driver_header, wallet_stub,
+                                purchase_gate):
+    purchase_gate.enter()
+    threading.Timer(0.05, purchase_gate.leave).start()
+
+    assert http.client.CREATED == buy_voucher(client,
+                                              driver_header).status_code
+
+
+def test_invalid_token_is_refused(client, purchase_gate):
+    response = client.post('/api/vouchers/',
+                           data={'driverPhoneNumber': '08012345678',
+                                 'voucherWorth': 1000},
+                           headers={'Authorization': 'Bearer invalid'})
+    assert http.client.UNAUTHORIZED == response.status_code
+    assert 0 == purchase_gate.in_flight
@@ -0,0 +1,68 @@
+"""
+Smoke test of the endpoint benchmarks
+"""
+import json
+
+import pytest
+
+from benchmarks import endpoints, load, startup
+from voucher_backend.query_plans import remove_seed_vouchers
+
+
+def test_endpoint_benchmarks(app):
+    try:
+        results = endpoints.run(rows=200, requests=4, warmup=1,
+                                concurrency=2)
+    finally:
+        remove_seed_vouchers()
+
+    assert 'sqlite' == results['engine']
+    for name, route in results['routes'].items():
+        assert 4 == route['requests'], name
+        assert 0 == route['errors'], (name, route['statusCodes'])
+        assert route['p50Ms'] <= route['p95Ms'] <= route['p99Ms']
+
+    assert [] == endpoints.compare(results, results)
+    slower = {'routes': {name: dict(route, p95Ms=route['p95Ms'] * 2)
+                         for name, route in results['routes'].items()}}
+    assert len(results['routes']) == len(endpoints.compare(slower, results))
+
+
+def test_endpoint_benchmarks_refuse_other_databases():
+    assert endpoints.is_benchmark_database('postgresql', 'vouchers_benchmark')
+    assert not endpoints.is_benchmark_database('postgresql', 'vouchers')
+    assert not endpoints.is_benchmark_database('sqlite',
+                                               '/srv/vouchers/db.sqlite3')
+
+    with pytest.raises(SystemExit):
+        endpoints.main(['--engine', 'postgresql'])
+    with pytest.raises(SystemExit):
+        endpoints.main(['--engine', 'postgresql', '--database', 'vouchers'])
+
+
+def test_startup_benchmark():
+    results = startup.run(runs=1, top=5)
+
+    for phase in startup.PHASES:
+        assert results[phase] > 0, phase
+    assert 'voucher_backend.app' in results['modules']
+    assert 5 == len(results['packages'])
+
+    assert [] == startup.compare(results, results)
+    faster = {phase: results[phase] / 2 for phase in startup.PHASES}
+    assert len(startup.PHASES) == len(startup.compare(results, faster))
+
+
+def test_load_benchmark(app):
+    results = load.run(latencies=(0.2,), requests_number=10, concurrency=10)
+
+    # The throughputs depend on the machine, only the run is checked
+    assert {'date', 'engine', 'requests', 'concurrency', 'modes'} == \
+        set(results)
+    json.dumps(results)
+    for mode in load.MODES:
+        result = results['modes'][mode]['0.2']
+        assert 10 == result['requests'], mode
+        assert 0 == result['errors'], (mode, result['statusCodes'])
+        assert result['throughput'] > 0, mode
+        assert result['p50Ms'] <= result['p95Ms'], mode
@@ -0,0 +1,64 @@
+"""
+Test the cached discount
+"""
+import http.client
+
+from voucher_backend.discount_cache import DiscountCache, LocalVersionStore
+from voucher_backend.models import DiscountModel
+from .helpers import count_statements
+
+
+def test_discount_is_cached(app, discount):
+    cache = DiscountCache(check_interval=60)
+    assert discount.discountPercent == cache.get()['discountPercent']
+
+    statements, stop = count_statements()
+    cache.get()
+    stop()
+    assert [] == statements
+
+
+def test_unchanged_version_needs_no_query(app, discount):
+    store = LocalVersionStore()
+    store.set_version(discount.version)
+    cache = DiscountCache(store, check_interval=0)
+    cache.get()
+
+    statements, stop = count_statements()
+    cache.get()
+    stop()
+    assert [] == statements
+
+
+def test_new_version_reloads(app, discount):
+    store = LocalVersionStore()
+    store.set_version(discount.version)
+    worker = DiscountCache(store, check_interval=0)
+    other_worker = DiscountCache(store, check_interval=0)
+    worker.get()
+    old_percent = discount.discountPercent
+
+    discount.discountPercent = 0.5
+    discount.version = DiscountModel.version + 1
+    app.db.session.commit()
+    try:
+        other_worker.invalidate(discount.version)
+        assert 0.5 == worker.get()['discountPercent']
+    finally:
+        discount.discountPercent = old_percent
+        app.db.session.commit()
+
+
+def test_update_discount(client, discount, driver_header):
+    headers = {'Authorization': driver_header}
+    old_percent = discount.discountPercent
+    try:
+        response = client.put('/api/discount/', headers=headers,
+                              data={'discountPercent': 0.35})
+        assert http.client.OK == response.status_code
+
+        response = client.get('/api/discount/', headers=headers)
+        assert 0.35 == response.json['discountPercent']
+    finally:
+        client.put('/api/discount/', headers=headers,
+                   data={'discountPercent': old_percent})
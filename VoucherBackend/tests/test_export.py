@@ -0,0 +1,76 @@
+"""
+Test the bulk export of the vouchers
+"""
+import csv
+import http.client
+import io
+import json
+
+from voucher_backend.export import export_vouchers_command
+from voucher_backend.models import VoucherModel
+
+
+def add_vouchers(db, number):
+    for index in range(number):
+        voucher = VoucherModel(driverId='test-driver', driverPhoneNumber='0',
+                               pin=f'xe{index:04d}', amountBought=800,
+                               voucherWorth=1000, status=index % 2 + 1)
+        db.session.add(voucher)
+    db.session.commit()
+
+
+def export(app, admin_header, **params):
+    # The client fixture preserves the request context, which the streamed
+    # body pushes again
+    client = app.test_client()
+    params.setdefault('driverId', 'test-driver')
+    return client.get('/api/vouchers/export/', query_string=params,
+                      headers={'Authorization': admin_header})
+
+
+def test_export_ndjson(app, admin_header, driver_header):
+    add_vouchers(app.db, 2500)
+    response = export(app, admin_header, status=2)
+
+    assert http.client.OK == response.status_code
+    assert 'application/x-ndjson' == response.mimetype
+    vouchers = [json.loads(line)
+                for line in response.get_data(as_text=True).splitlines()]
+    assert 1250 == len(vouchers)
+    assert {2} == {voucher['status'] for voucher in vouchers}
+    assert sorted(voucher['id'] for voucher in vouchers) == [
+        voucher['id'] for voucher in vouchers]
+    assert 'xe0001' == vouchers[0]['pin']
+
+
+def test_export_csv(app, admin_header, driver_header):
+    add_vouchers(app.db, 10)
+    response = export(app, admin_header, format='csv')
+
+    assert http.client.OK == response.status_code
+    assert 'text/csv' == response.mimetype
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert 10 == len(rows)
+    assert 'xe0000' == rows[0]['pin']
+    assert '1000' == rows[0]['voucherWorth']
+
+
+def test_export_admin_only(app, driver_header):
+    response = export(app, driver_header)
+    assert http.client.FORBIDDEN == response.status_code
+
+
+def test_export_command(app, driver_header, tmpdir):
+    add_vouchers(app.db, 10)
+    output = tmpdir.join('vouchers.csv')
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(export_vouchers_command, [
+        '--format', 'csv', '--output', str(output),
+        '--driver-id', 'test-driver', '--status', '1',
+    ])
+
+    assert 0 == result.exit_code, result.output
+    rows = list(csv.DictReader(io.StringIO(output.read())))
+    assert 5 == len(rows)
+    assert {'1'} == {row['status'] for row in rows}
@@ -0,0 +1,54 @@
+"""
+Test the vouchers of the authenticated driver
+"""
+import http.client
+
+from voucher_backend.models import VoucherModel
+
+
+def add_vouchers(db, number):
+    for index in range(number):
+        voucher = VoucherModel(driverId='test-driver', driverPhoneNumber='0',
+                               pin=f'ww{index:04d}', amountBought=800,
+                               voucherWorth=1000, status=index % 2 + 1)
+        db.session.add(voucher)
+    db.session.commit()
+
+
+def test_me_streams_all_vouchers(app, driver_header):
+    add_vouchers(app.db, 1200)
+    # The client fixture preserves the request context, which the streamed
+    # body pushes again
+    client = app.test_client()
+    response = client.get('/api/me/', headers={'Authorization': driver_header})
+
+    assert http.client.OK == response.status_code
+    assert 'application/json' == response.mimetype
+    vouchers = response.json
+    assert 1200 == len(vouchers)
+    assert sorted(voucher['id'] for voucher in vouchers) == [
+        voucher['id'] for voucher in vouchers]
+
+
+def test_me_no_vouchers(client, driver_header):
+    response = client.get('/api/me/', headers={'Authorization': driver_header})
+    assert http.client.NOT_FOUND == response.status_code
+
+
+def test_me_pages_by_status(app, client, driver_header):
+    add_vouchers(app.db, 10)
+    headers = {'Authorization': driver_header}
+    params = {'status': 2, 'limit': 3}
+
+    vouchers = []
+    while True:
+        response = client.get('/api/me/', query_string=params,
+                              headers=headers)
+        assert http.client.OK == response.status_code
+        vouchers.extend(response.json['vouchers'])
+        if not response.json['nextCursor']:
+            break
+        params['cursor'] = response.json['nextCursor']
+
+    assert 5 == len(vouchers)
+    assert {2} == {voucher['status'] for voucher in vouchers}
@@ -0,0 +1,81 @@
+"""
+Test the /metrics endpoint
+"""
+import http.client
+import os
+import subprocess
+import sys
+
+import pytest
+from prometheus_client import REGISTRY
+from sqlalchemy.exc import OperationalError
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_request_metrics(client, driver_header):
+    route = {'method': 'GET', 'route': '/api/vouchers/pin/<string:voucherPin>/'}
+    requests = sample('http_request_duration_seconds_count', status='404',
+                      **route)
+    statements = sample('http_request_sql_statements_sum', **route)
+    hits = sample('token_cache_lookups_total', result='hit')
+
+    for _ in range(2):
+        response = client.get('/api/vouchers/pin/zz0000/',
+                              headers={'Authorization': driver_header})
+        assert http.client.NOT_FOUND == response.status_code
+
+    assert requests + 2 == sample('http_request_duration_seconds_count',
+                                  status='404', **route)
+    # The unknown pin is cached after the first lookup
+    assert statements + 1 == sample('http_request_sql_statements_sum',
+                                    **route)
+    assert hits + 1 <= sample('token_cache_lookups_total', result='hit')
+
+    response = client.get('/metrics')
+    assert http.client.OK == response.status_code
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert ('http_request_duration_seconds_count{method="GET",'
+            'route="/api/vouchers/pin/<string:voucherPin>/",status="404"}'
+            ) in text
+    assert 'wallet_request_duration_seconds' in text
+
+
+OBSERVE = '''
+from voucher_backend.wallet import wallet_latency
+wallet_latency.labels('topup_wallet', '201').observe(0.1)
+'''
+
+RENDER = '''
+from voucher_backend.metrics import render
+print(render().decode('utf8'))
+'''
+
+
+def test_workers_are_added_up(tmpdir):
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmpdir))
+
+    def python(code):
+        return subprocess.run([sys.executable, '-c', code], env=env,
+                              check=True, stdout=subprocess.PIPE,
+                              universal_newlines=True).stdout
+
+    # Two workers, and the one answering the scrape
+    python(OBSERVE)
+    python(OBSERVE)
+    text = python(RENDER)
+
+    assert ('wallet_request_duration_seconds_count{operation="topup_wallet",'
+            'status="201"} 2.0') in text
+
+
+def test_failed_statement_timing_is_dropped(app):
+    with app.db.engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute('SELECT * FROM no_such_table')
+        assert [] == connection.info.get('query_start')
+        connection.execute('SELECT 1')
+        assert [] == connection.info['query_start']
@@ -0,0 +1,237 @@
+"""
+Test the wallet outbox
+"""
+import http.client
+from datetime import datetime, timedelta
+
+import pytest
+
+from voucher_backend import outbox
+from voucher_backend.models import VoucherModel, WalletOperationModel
+from voucher_backend.wallet import wallet_client
+
+
+@pytest.fixture
+def outbox_mode(app, monkeypatch):
+    monkeypatch.setattr(outbox, 'WALLET_OUTBOX', True)
+    yield
+    WalletOperationModel.query.delete()
+    app.db.session.commit()
+
+
+@pytest.fixture
+def operations(app):
+    yield
+    WalletOperationModel.query.delete()
+    app.db.session.commit()
+
+
+def buy_voucher(client, driver_header):
+    data = {
+        'driverPhoneNumber': '08012345678',
+        'voucherWorth': 1000,
+    }
+    return client.post('/api/vouchers/', data=data,
+                       headers={'Authorization': driver_header})
+
+
+def test_purchase_is_sent_later(client, discount, driver_header, wallet_stub,
+                                outbox_mode):
+    response = buy_voucher(client, driver_header)
+
+    assert http.client.ACCEPTED == response.status_code
+    assert 0 == response.json['status']
+    assert [] == wallet_stub.requests
+    operation_id = response.json['operationId']
+
+    assert 1 == outbox.drain_outbox()
+    assert 1 == len(wallet_stub.requests)
+    headers = wallet_stub.headers[0]
+    assert operation_id == headers['Idempotency-Key']
+    # Sent on behalf of the driver, whose token is not kept
+    assert 'Bearer wallet-service' == headers['Authorization']
+    assert 'test-driver' == headers['X-On-Behalf-Of']
+    assert 1 == VoucherModel.query.get(response.json['id']).status
+
+    response = client.get(f'/api/operations/{operation_id}/',
+                          headers={'Authorization': driver_header})
+    assert 'succeeded' == response.json['status']
+    assert 201 == response.json['responseStatus']
+
+
+def test_operations_are_claimed_before_sent(app, client, discount,
+                                            driver_header, wallet_stub,
+                                            outbox_mode, monkeypatch):
+    buy_voucher(client, driver_header)
+    send, claimed = outbox._send, []
+
+    def spy(wallet_operation):
+        # Committed before the call, as seen from another connection
+        claimed.extend(app.db.engine.execute(
+            'SELECT status, attempts FROM wallet_operation_model'))
+        return send(wallet_operation)
+
+    monkeypatch.setattr(outbox, '_send', spy)
+    assert 1 == outbox.drain_outbox()
+    assert [('in_flight', 1)] == [tuple(row) for row in claimed]
+    operation = WalletOperationModel.query.one()
+    assert ('succeeded', 1) == (operation.status, operation.attempts)
+
+
+def test_claim_left_by_a_crash(app, client, discount, driver_header,
+                               wallet_stub, outbox_mode):
+    buy_voucher(client, driver_header)
+    WalletOperationModel.query.update(
+        {'dateCreated': datetime.utcnow() - timedelta(hours=1)})
+    outbox._claim(10, datetime.utcnow())
+
+    # The worker may still be sending it
+    assert 0 == outbox.reconcile_in_flight()
+    WalletOperationModel.query.update(
+        {'nextAttempt': datetime.utcnow() - timedelta(seconds=1)})
+    assert 1 == outbox.reconcile_in_flight()
+    assert 1 == outbox.drain_outbox()
+    operation = WalletOperationModel.query.one()
+    assert ('succeeded', 2) == (operation.status, operation.attempts)
+
+
+def test_refused_purchase_cancels_voucher(client, discount, driver_header,
+                                          wallet_stub, outbox_mode):
+    response = buy_voucher(client, driver_header)
+    wallet_stub.status = 400
+
+    outbox.drain_outbox()
+    assert 3 == VoucherModel.query.get(response.json['id']).status
+
+
+def test_refused_topup_frees_voucher(client, discount, driver_header,
+                                     wallet_stub, outbox_mode):
+    voucher = buy_voucher(client, driver_header).json
+    outbox.drain_outbox()
+
+    response = client.put(f'/api/vouchers/buy/{voucher["pin"]}/',
+                          data={'userPhoneNumber': '08087654321'},
+                          headers={'Authorization': driver_header})
+    assert http.client.ACCEPTED == response.status_code
+    assert 2 == response.json['status']
+
+    wallet_stub.status = 400
+    outbox.drain_outbox()
+    voucher = VoucherModel.query.get(voucher['id'])
+    assert 1 == voucher.status
+    assert None is voucher.userPhoneNumber
+
+
+def test_unavailable_wallet_keeps_operations(client, discount, driver_header,
+                                             wallet_stub, outbox_mode):
+    buy_voucher(client, driver_header)
+    wallet_stub.stop()
+
+    assert 0 == outbox.drain_outbox()
+    operation = WalletOperationModel.query.one()
+    assert 'pending' == operation.status
+    assert 0 == operation.attempts
+    assert None is operation.nextAttempt
+
+
+def test_failing_operation_is_sent_later(client, discount, driver_header,
+                                         wallet_stub, outbox_mode):
+    buy_voucher(client, driver_header)
+    wallet_stub.status = 500
+
+    assert 1 == outbox.drain_outbox()
+    operation = WalletOperationModel.query.one()
+    assert 'pending' == operation.status
+    assert operation.nextAttempt > datetime.utcnow()
+    # Not sent again before its next attempt
+    assert 0 == outbox.drain_outbox()
+
+    wallet_stub.status = 201
+    operation.nextAttempt = datetime.utcnow()
+    assert 1 == outbox.drain_outbox()
+    assert 'succeeded' == operation.status
+    assert 2 == len(wallet_stub.requests)
+
+
+def test_backoff(monkeypatch):
+    monkeypatch.setattr(outbox, 'OUTBOX_BACKOFF', 5)
+    monkeypatch.setattr(outbox, 'OUTBOX_MAX_BACKOFF', 60)
+    assert [5, 10, 20, 40, 60] == [outbox.backoff(attempts)
+                                   for attempts in range(1, 6)]
+
+
+def test_failing_operation_is_parked(client, discount, driver_header,
+                                     wallet_stub, outbox_mode, monkeypatch):
+    monkeypatch.setattr(outbox, 'OUTBOX_MAX_ATTEMPTS', 1)
+    voucher = buy_voucher(client, driver_header).json
+    wallet_stub.status = 503
+
+    assert 1 == outbox.drain_outbox()
+    operation = WalletOperationModel.query.one()
+    assert 'parked' == operation.status
+    assert 503 == operation.responseStatus
+    # The wallet may have been paid, the voucher is not cancelled
+    assert 0 == VoucherModel.query.get(voucher['id']).status
+    assert 0 == outbox.drain_outbox()
+
+
+def test_operations_need_the_service_authorization(client, discount,
+                                                   driver_header, wallet_stub,
+                                                   outbox_mode):
+    buy_voucher(client, driver_header)
+    wallet_client.service_authorization = None
+
+    assert 0 == outbox.drain_outbox()
+    assert [] == wallet_stub.requests
+    assert 'pending' == WalletOperationModel.query.one().status
+
+
+def test_unknown_purchase_outcome_is_settled_later(client, discount,
+                                                   driver_header, slow_wallet,
+                                                   operations):
+    response = buy_voucher(client, driver_header)
+
+    assert http.client.ACCEPTED == response.status_code
+    assert 0 == response.json['status']
+    operation_id = response.json['operationId']
+    assert operation_id == slow_wallet.headers[0]['Idempotency-Key']
+
+    slow_wallet.latency = 0
+    assert 1 == outbox.drain_outbox()
+    # Sent again with the same key, the wallet does not debit twice
+    assert operation_id == slow_wallet.headers[1]['Idempotency-Key']
+    assert 1 == VoucherModel.query.get(response.json['id']).status
+
+
+def test_purchase_failing_in_the_wallet(client, discount, driver_header,
+                                        wallet_stub, operations):
+    wallet_stub.status = 500
+    response = buy_voucher(client, driver_header)
+    assert http.client.ACCEPTED == response.status_code
+
+    wallet_stub.status = 400
+    outbox.drain_outbox()
+    assert 3 == VoucherModel.query.get(response.json['id']).status
+
+
+def test_unknown_batch_purchase_outcome(client, discount, driver_header,
+                                        wallet_stub, operations):
+    wallet_stub.status = 502
+    response = client.post('/api/vouchers/batch/',
+                           data={'driverPhoneNumber': '08012345678',
+                                 'count': 3, 'voucherWorth': 500},
+                           headers={'Authorization': driver_header})
+
+    assert http.client.ACCEPTED == response.status_code
+    assert [0, 0, 0] == [voucher['status'] for voucher in response.json]
+    operation_ids = {voucher['operationId'] for voucher in response.json}
+    assert 1 == len(operation_ids)
+
+    wallet_stub.status = 201
+    outbox.drain_outbox()
+    operation = WalletOperationModel.query.one()
+    assert operation_ids == {operation.idempotencyKey}
+    assert '1200' == wallet_stub.requests[1][1]['amount']
+    statuses = [VoucherModel.query.get(voucher['id']).status
+                for voucher in response.json]
+    assert [1, 1, 1] == statuses
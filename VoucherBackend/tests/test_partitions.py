@@ -0,0 +1,139 @@
+"""
+Test the voucher partitions helpers and the archival of the redeemed
+vouchers
+"""
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from voucher_backend import partitions
+from voucher_backend.models import VoucherArchiveModel, VoucherModel
+from voucher_backend.stats import count_vouchers
+
+NOW = datetime(2026, 10, 18, 12)
+LONG_AGO = NOW - timedelta(days=200)
+
+
+@pytest.fixture
+def vouchers(app, driver_header):
+    db = app.db
+    rows = [
+        # pin, status, generated, used
+        ('ar0001', 2, LONG_AGO, LONG_AGO),
+        ('ar0002', 2, LONG_AGO, LONG_AGO + timedelta(days=1)),
+        ('ar0003', 2, LONG_AGO, NOW - timedelta(days=1)),
+        ('ar0004', 1, LONG_AGO, None),
+        ('ar0005', 2, NOW, NOW),
+        # Redeemed before timeUsed was set
+        ('ar0006', 2, LONG_AGO, None),
+    ]
+    for pin, status, generated, used in rows:
+        db.session.add(VoucherModel(
+            driverId='test-driver', driverPhoneNumber='0', pin=pin,
+            amountBought=800, voucherWorth=1000, status=status,
+            dateGenerated=generated, timeUsed=used))
+    db.session.commit()
+    yield
+    VoucherArchiveModel.query.delete()
+    db.session.commit()
+
+
+def test_months():
+    month = partitions.month_start(NOW)
+    assert datetime(2026, 10, 1) == month
+    assert datetime(2027, 1, 1) == partitions.add_months(month, 3)
+    assert datetime(2025, 12, 1) == partitions.add_months(month, -10)
+    assert 'voucher_model_y2026m10' == partitions.partition_name(month)
+
+
+def test_no_partitions_on_sqlite(app):
+    assert [] == partitions.create_partitions(now=NOW)
+
+
+class RecordingConnection:
+    """
+    Records the statements, Postgres is not there to run them. The default
+    partition holds `default_rows` vouchers of every month
+    """
+    def __init__(self, default_rows):
+        self.default_rows = default_rows
+        self.statements = []
+
+    def execute(self, statement, *params):
+        self.statements.append(statement.split(' WHERE ')[0])
+        return SimpleNamespace(scalar=lambda: bool(self.default_rows),
+                               rowcount=self.default_rows)
+
+
+def test_create_partition():
+    connection = RecordingConnection(default_rows=0)
+    month = datetime(2026, 11, 1)
+
+    assert 'voucher_model_y2026m11' == partitions.create_partition(
+        connection, month)
+    assert ("CREATE TABLE voucher_model_y2026m11 PARTITION OF voucher_model "
+            "FOR VALUES FROM ('2026-11-01') TO ('2026-12-01')"
+            == connection.statements[-1])
+
+
+def test_create_partition_over_default_rows():
+    connection = RecordingConnection(default_rows=2)
+
+    partitions.create_partition(connection, datetime(2026, 11, 1))
+    # Moved out of the default partition before the partition is created,
+    # then in
+    assert [
+        'SELECT EXISTS (SELECT 1 FROM voucher_model_default',
+        'CREATE TEMPORARY TABLE voucher_model_moved AS SELECT * FROM '
+        'voucher_model_default',
+        'DELETE FROM voucher_model_default',
+        'CREATE TABLE voucher_model_y2026m11 PARTITION OF voucher_model '
+        "FOR VALUES FROM ('2026-11-01') TO ('2026-12-01')",
+        'INSERT INTO voucher_model SELECT * FROM voucher_model_moved',
+        'DROP TABLE voucher_model_moved',
+    ] == connection.statements
+
+
+def test_archive_vouchers(vouchers):
+    count = count_vouchers(LONG_AGO, NOW + timedelta(days=1), 'month')
+
+    assert 3 == partitions.archive_vouchers(after_days=90, batch_size=1,
+                                            now=NOW)
+
+    archived = VoucherArchiveModel.query.order_by(VoucherArchiveModel.id)
+    assert ['ar0001', 'ar0002', 'ar0006'] == [voucher.pin
+                                              for voucher in archived]
+    assert all(voucher.dateArchived is not None for voucher in archived)
+    pins = {voucher.pin for voucher in VoucherModel.query.filter(
+        VoucherModel.pin.like('ar%'))}
+    assert {'ar0003', 'ar0004', 'ar0005'} == pins
+    # The archived vouchers still count
+    assert count == count_vouchers(LONG_AGO, NOW + timedelta(days=1),
+                                   'month')
+
+    assert 0 == partitions.archive_vouchers(after_days=90, now=NOW)
+
+
+def test_archived_voucher_leaves_the_cache(client, driver_header, vouchers):
+    response = client.get('/api/vouchers/pin/ar0001/',
+                          headers={'Authorization': driver_header})
+    assert 200 == response.status_code
+
+    partitions.archive_vouchers(after_days=90, now=NOW)
+    response = client.get('/api/vouchers/pin/ar0001/',
+                          headers={'Authorization': driver_header})
+    assert 404 == response.status_code
+
+
+def test_archive_reissued_pin(app, vouchers):
+    # A legacy voucher archived before its pin was issued again
+    app.db.session.add(VoucherArchiveModel(
+        id=10 ** 9, driverId='test-driver', driverPhoneNumber='0',
+        pin='ar0001', amountBought=800, voucherWorth=1000, status=2,
+        dateGenerated=LONG_AGO, timeUsed=LONG_AGO))
+    app.db.session.commit()
+
+    assert 3 == partitions.archive_vouchers(after_days=90, now=NOW)
+    assert 2 == VoucherArchiveModel.query.filter(
+        VoucherArchiveModel.pin == 'ar0001').count()
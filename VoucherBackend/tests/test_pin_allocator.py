@@ -0,0 +1,84 @@
+"""
+Test the pin allocator
+"""
+import re
+from datetime import datetime
+
+from voucher_backend.models import (PinAllocatorModel, VoucherArchiveModel,
+                                    VoucherModel)
+from voucher_backend.pin_allocator import (KEYSPACE, PinAllocator, pin_at,
+                                           keyspace_usage)
+
+
+def test_permutation_covers_keyspace_without_duplicates():
+    # A sample of consecutive positions maps to distinct, well formed pins
+    pins = [pin_at(index) for index in range(0, KEYSPACE, 997)]
+    assert len(pins) == len(set(pins))
+    assert all(re.fullmatch(r'[a-z]{2}\d{4}', pin) for pin in pins)
+
+
+def test_allocators_never_collide(app):
+    # Two allocators stand for two workers sharing the database
+    first = PinAllocator(block_size=50)
+    second = PinAllocator(block_size=50)
+
+    pins = []
+    for _ in range(3):
+        pins.extend(first.allocate_many(40))
+        pins.extend(second.allocate_many(40))
+
+    assert 240 == len(pins)
+    assert 240 == len(set(pins))
+
+
+def test_allocator_skips_existing_pins(app):
+    allocator = PinAllocator(block_size=10)
+    next_index = PinAllocatorModel.query.get(1)
+    start = next_index.nextIndex if next_index else 0
+    taken = pin_at(start)
+
+    voucher = VoucherModel(driverId='test-driver', driverPhoneNumber='0',
+                           pin=taken, amountBought=1, voucherWorth=1)
+    app.db.session.add(voucher)
+    app.db.session.commit()
+    try:
+        pins = allocator.allocate_many(10)
+    finally:
+        app.db.session.delete(voucher)
+        app.db.session.commit()
+
+    assert taken not in pins
+    assert 10 == len(set(pins))
+
+
+def test_allocator_skips_archived_pins(app):
+    allocator = PinAllocator(block_size=10)
+    next_index = PinAllocatorModel.query.get(1)
+    start = next_index.nextIndex if next_index else 0
+    taken = pin_at(start + 1)
+
+    voucher = VoucherArchiveModel(id=-1, driverId='test-driver',
+                                  driverPhoneNumber='0', pin=taken,
+                                  amountBought=1, voucherWorth=1,
+                                  dateGenerated=datetime(2020, 1, 1))
+    app.db.session.add(voucher)
+    app.db.session.commit()
+    try:
+        pins = allocator.allocate_many(9)
+    finally:
+        app.db.session.delete(voucher)
+        app.db.session.commit()
+
+    assert taken not in pins
+    assert 9 == len(set(pins))
+
+
+def test_keyspace_usage(app):
+    allocator = PinAllocator(block_size=25)
+    before = keyspace_usage()['leased']
+    allocator.allocate()
+    usage = keyspace_usage()
+
+    assert KEYSPACE == usage['keyspace']
+    assert before + 25 == usage['leased']
+    assert usage['leased'] / KEYSPACE == usage['utilisation']
@@ -0,0 +1,27 @@
+"""
+Test that the hot queries use an index
+"""
+from voucher_backend.query_plans import (check_query_plans,
+                                         is_sequential_scan,
+                                         remove_seed_vouchers, seed_vouchers)
+
+
+def test_sequential_scan_detection():
+    assert is_sequential_scan(['SCAN voucher_model'])
+    assert is_sequential_scan(['Seq Scan on voucher_model  (cost=0.00..1)'])
+    assert not is_sequential_scan(
+        ['SEARCH voucher_model USING INDEX ix_voucher_model_pin (pin=?)'])
+    assert not is_sequential_scan(
+        ['SCAN voucher_model USING INDEX ix_voucher_model_unused_id'])
+
+
+def test_hot_queries_use_indexes(app):
+    seed_vouchers(20000)
+    try:
+        result = check_query_plans()
+    finally:
+        remove_seed_vouchers()
+
+    scans = {name: plan['plan'] for name, plan in result.items()
+             if plan['sequentialScan']}
+    assert {} == scans
@@ -0,0 +1,76 @@
+"""
+Test the slow query log, the repeated statements and the query budgets
+"""
+import http.client
+import logging
+
+from voucher_backend import query_profiler
+from voucher_backend.api_namespace.api import VoucherGetByPin
+
+
+def test_request_over_budget_fails(client, driver_header, monkeypatch):
+    monkeypatch.setattr(VoucherGetByPin.get, 'query_budget', 0)
+    response = client.get('/api/vouchers/pin/zz0000/',
+                          headers={'Authorization': driver_header})
+
+    assert http.client.INTERNAL_SERVER_ERROR == response.status_code
+    assert response.json == {
+        'status': 'error',
+        'message': 'GET /api/vouchers/pin/<string:voucherPin>/ ran 1 SQL '
+                   'statements, its budget is 0',
+    }
+
+
+def test_budget_is_only_logged_when_not_strict(app, client, driver_header,
+                                               monkeypatch):
+    monkeypatch.setattr(VoucherGetByPin.get, 'query_budget', 0)
+    monkeypatch.setitem(app.config, 'QUERY_BUDGET_STRICT', False)
+    response = client.get('/api/vouchers/pin/zz0000/',
+                          headers={'Authorization': driver_header})
+    assert http.client.NOT_FOUND == response.status_code
+
+
+def test_stats_run_one_query(client, driver_header):
+    response = client.get('/api/stat/datequery/',
+                          query_string={'startdate': '01/01/2020',
+                                        'enddate': '31/12/2020'},
+                          headers={'Authorization': driver_header})
+    assert http.client.OK == response.status_code
+
+
+def test_slow_query_log(client, driver_header, monkeypatch, caplog):
+    monkeypatch.setattr(query_profiler, 'SLOW_QUERY_THRESHOLD', 0)
+    with caplog.at_level(logging.WARNING, logger=query_profiler.__name__):
+        client.get('/api/vouchers/pin/zz0000/',
+                   headers={'Authorization': driver_header})
+
+    message = caplog.records[0].getMessage()
+    assert message.startswith('Slow query')
+    assert 'Parameters: ["str"]' in message
+    # SQLite plan of the lookup by pin
+    assert 'ix_voucher_model_pin' in message
+
+
+def test_repeated_statements(client, driver_header, monkeypatch, caplog):
+    monkeypatch.setattr(query_profiler, 'REPEATED_STATEMENT_THRESHOLD', 1)
+    with caplog.at_level(logging.WARNING, logger=query_profiler.__name__):
+        for pin in ('zz0000', 'zz0001'):
+            client.get(f'/api/vouchers/pin/{pin}/',
+                       headers={'Authorization': driver_header})
+    # One statement per request
+    assert [] == caplog.records
+
+    monkeypatch.setattr(query_profiler, 'REPEATED_STATEMENT_THRESHOLD', 0)
+    with caplog.at_level(logging.WARNING, logger=query_profiler.__name__):
+        # Not cached yet
+        client.get('/api/vouchers/pin/zz0002/',
+                   headers={'Authorization': driver_header})
+    assert 'ran 1 times' in caplog.records[0].getMessage()
+
+
+def test_bind_shape():
+    assert {'pin': 'str', 'limit': 'int'} == query_profiler.bind_shape(
+        {'pin': 'ab1234', 'limit': 10})
+    assert ['str', 'NoneType'] == query_profiler.bind_shape(('a', None))
+    assert [2, ['int']] == query_profiler.bind_shape([(1,), (2,)],
+                                                     executemany=True)
@@ -0,0 +1,183 @@
+"""
+Test the redemption of the vouchers
+"""
+import http.client
+import threading
+from datetime import datetime, timedelta
+
+from voucher_backend import admission, outbox
+from voucher_backend.models import VoucherModel, WalletOperationModel
+
+
+def add_voucher(db, pin, status=1):
+    voucher = VoucherModel(driverId='test-driver', driverPhoneNumber='0',
+                           pin=pin, amountBought=800, voucherWorth=1000,
+                           status=status)
+    db.session.add(voucher)
+    db.session.commit()
+    return voucher
+
+
+def test_sell_voucher(app, client, driver_header, wallet_stub):
+    voucher = add_voucher(app.db, 'xx0001')
+    response = client.put('/api/vouchers/buy/xx0001/',
+                          data={'userPhoneNumber': '08087654321'},
+                          headers={'Authorization': driver_header})
+
+    assert http.client.OK == response.status_code
+    assert 2 == response.json['status']
+    assert '08087654321' == response.json['userPhoneNumber']
+    app.db.session.refresh(voucher)
+    assert 2 == voucher.status
+    assert voucher.timeUsed is not None
+
+
+def test_sell_sold_voucher(app, client, driver_header, wallet_stub):
+    add_voucher(app.db, 'xx0002', status=2)
+    response = client.put('/api/vouchers/buy/xx0002/',
+                          headers={'Authorization': driver_header})
+
+    assert {'status': 'error', 'message': 'Voucher Sold'} == response.json
+    assert [] == wallet_stub.requests
+
+
+def test_sell_unknown_voucher(client, driver_header, wallet_stub):
+    response = client.put('/api/vouchers/buy/xx9999/',
+                          headers={'Authorization': driver_header})
+    assert http.client.NOT_FOUND == response.status_code
+
+
+def test_refused_topup_releases_voucher(app, client, driver_header,
+                                        wallet_stub):
+    voucher = add_voucher(app.db, 'xx0003')
+    wallet_stub.status = 400
+    response = client.put('/api/vouchers/buy/xx0003/',
+                          data={'userPhoneNumber': '08087654321'},
+                          headers={'Authorization': driver_header})
+
+    assert http.client.BAD_REQUEST == response.status_code
+    app.db.session.refresh(voucher)
+    assert 1 == voucher.status
+    assert None is voucher.userPhoneNumber
+
+
+def test_unreachable_wallet_releases_voucher(app, client, driver_header,
+                                            wallet_stub):
+    voucher = add_voucher(app.db, 'xx0004')
+    wallet_stub.stop()
+    response = client.put('/api/vouchers/buy/xx0004/',
+                          data={'userPhoneNumber': '08087654321'},
+                          headers={'Authorization': driver_header})
+
+    assert http.client.SERVICE_UNAVAILABLE == response.status_code
+    app.db.session.refresh(voucher)
+    assert 1 == voucher.status
+    operation = WalletOperationModel.query.filter_by(
+        voucherId=voucher.id).one()
+    assert 'failed' == operation.status
+
+
+def test_unknown_topup_outcome_keeps_voucher_reserved(app, client,
+                                                      driver_header,
+                                                      slow_wallet):
+    voucher = add_voucher(app.db, 'xx0005')
+    response = client.put('/api/vouchers/buy/xx0005/',
+                          data={'userPhoneNumber': '08087654321'},
+                          headers={'Authorization': driver_header})
+
+    # The rider may have been topped up, the voucher cannot be sold again
+    assert http.client.ACCEPTED == response.status_code
+    assert 4 == response.json['status']
+    operation_id = response.json['operationId']
+    assert operation_id == slow_wallet.headers[0]['Idempotency-Key']
+    response = client.put('/api/vouchers/buy/xx0005/',
+                          data={'userPhoneNumber': '08087654321'},
+                          headers={'Authorization': driver_header})
+    assert {'status': 'error', 'message': 'Voucher Not Available'} == \
+        response.json
+
+    operation = WalletOperationModel.query.filter_by(
+        idempotencyKey=operation_id).one()
+    assert 'pending' == operation.status
+    operation.nextAttempt = None
+    slow_wallet.latency = 0
+    assert 1 == outbox.drain_outbox()
+    assert operation_id == slow_wallet.headers[-1]['Idempotency-Key']
+    app.db.session.refresh(voucher)
+    assert 2 == voucher.status
+
+
+def test_failing_topup_keeps_voucher_reserved(app, client, driver_header,
+                                              wallet_stub):
+    voucher = add_voucher(app.db, 'xx0006')
+    wallet_stub.status = 502
+    response = client.put('/api/vouchers/buy/xx0006/',
+                          data={'userPhoneNumber': '08087654321'},
+                          headers={'Authorization': driver_header})
+    assert http.client.ACCEPTED == response.status_code
+
+    # Refused when sent again, the voucher can be used again
+    wallet_stub.status = 400
+    WalletOperationModel.query.filter_by(voucherId=voucher.id).update(
+        {'nextAttempt': None})
+    outbox.drain_outbox()
+    app.db.session.refresh(voucher)
+    assert 1 == voucher.status
+    assert None is voucher.userPhoneNumber
+
+
+def test_reservations_left_by_a_crash(app, client, driver_header,
+                                      wallet_stub):
+    long_ago = datetime.utcnow() - timedelta(hours=1)
+    voucher = add_voucher(app.db, 'xx0007', status=4)
+    voucher.timeUsed = long_ago
+    operation = outbox.add_operation(
+        outbox.TOPUP_WALLET, voucher, 'test-driver', 1000, '08087654321',
+        'Voucher Purchase By Rider', status='in_flight')
+    operation.dateCreated = long_ago
+    recent = outbox.add_operation(
+        outbox.TOPUP_WALLET, add_voucher(app.db, 'xx0008', status=4),
+        'test-driver', 1000, '08087654321', 'Voucher Purchase By Rider',
+        status='in_flight')
+    app.db.session.commit()
+
+    # The other one may still be sent by the API
+    assert 1 == outbox.reconcile_in_flight()
+    assert 'in_flight' == recent.status
+    assert 1 == outbox.drain_outbox()
+    app.db.session.refresh(voucher)
+    assert 2 == voucher.status
+
+
+def test_concurrent_redemption_has_one_winner(app, driver_header,
+                                              wallet_stub, monkeypatch):
+    # 40 redemptions at once are over the rate of a driver
+    monkeypatch.setattr(admission.driver_buckets, 'rate', 0)
+    pins = [f'xx1{number:03d}' for number in range(5)]
+    for pin in pins:
+        add_voucher(app.db, pin)
+    # Keep the winner inside the wallet call while the others try
+    wallet_stub.latency = 0.05
+
+    results = []
+
+    def redeem(pin):
+        client = app.test_client()
+        response = client.put(f'/api/vouchers/buy/{pin}/',
+                              data={'userPhoneNumber': '08087654321'},
+                              headers={'Authorization': driver_header})
+        results.append((pin, response.status_code, response.json))
+
+    threads = [threading.Thread(target=redeem, args=(pin,))
+               for pin in pins for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert {http.client.OK} == {result[1] for result in results}
+    for pin in pins:
+        winners = [result for result in results
+                   if result[0] == pin and result[2].get('status') == 2]
+        assert 1 == len(winners)
+    assert len(pins) == len(wallet_stub.requests)
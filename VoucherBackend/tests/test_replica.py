@@ -0,0 +1,113 @@
+"""
+Test the routing of the reads to the replica, with a second SQLite database
+as the replica
+"""
+import http.client
+import time
+
+import pytest
+
+from voucher_backend import replica
+from voucher_backend.models import VoucherModel
+from voucher_backend.replica import LocalStickyStore, replica_router
+from voucher_backend.voucher_cache import voucher_cache
+
+REPLICA_PIN = 'REPLICA0001'
+
+
+@pytest.fixture
+def replica_engine(app, tmp_path, monkeypatch):
+    app.config['SQLALCHEMY_BINDS'] = {
+        replica.REPLICA_BIND: f'sqlite:///{tmp_path}/replica.sqlite3',
+    }
+    engine = app.db.get_engine(app, bind=replica.REPLICA_BIND)
+    app.db.Model.metadata.create_all(bind=engine)
+    monkeypatch.setattr(replica_router, 'store', LocalStickyStore())
+    replica_router.reset()
+    yield engine
+    replica_router.reset()
+
+
+def add_voucher(engine, pin, driver_id='test-driver'):
+    engine.execute(VoucherModel.__table__.insert().values(
+        driverId=driver_id, driverPhoneNumber='08012345678', pin=pin,
+        amountBought=800, voucherWorth=1000, status=1))
+
+
+def get_voucher(client, driver_header, pin):
+    return client.get(f'/api/vouchers/pin/{pin}/',
+                      headers={'Authorization': driver_header})
+
+
+def test_reads_go_to_the_replica(client, driver_header, replica_engine):
+    # Only in the replica
+    add_voucher(replica_engine, REPLICA_PIN)
+    try:
+        response = get_voucher(client, driver_header, REPLICA_PIN)
+        assert http.client.OK == response.status_code
+    finally:
+        replica_engine.execute(VoucherModel.__table__.delete())
+
+
+def test_writes_go_to_the_primary(client, discount, driver_header,
+                                  wallet_stub, replica_engine):
+    response = client.post('/api/vouchers/',
+                           data={'driverPhoneNumber': '08012345678',
+                                 'voucherWorth': 1000},
+                           headers={'Authorization': driver_header})
+    assert http.client.CREATED == response.status_code
+    assert 0 == replica_engine.execute(
+        VoucherModel.__table__.count()).scalar()
+
+
+def test_client_reads_its_writes(client, discount, driver_header,
+                                 wallet_stub, replica_engine):
+    replica_router.store.seconds = 0.2
+    response = client.post('/api/vouchers/',
+                           data={'driverPhoneNumber': '08012345678',
+                                 'voucherWorth': 1000},
+                           headers={'Authorization': driver_header})
+    pin = response.json['pin']
+
+    # Not replicated yet, read from the primary
+    response = get_voucher(client, driver_header, pin)
+    assert http.client.OK == response.status_code
+
+    time.sleep(0.2)
+    voucher_cache.clear()
+    response = get_voucher(client, driver_header, pin)
+    assert http.client.NOT_FOUND == response.status_code
+
+
+def test_lagging_replica(client, driver_header, replica_engine, monkeypatch):
+    monkeypatch.setattr(replica, 'replica_lag', lambda engine: 60)
+    add_voucher(replica_engine, REPLICA_PIN)
+    try:
+        response = get_voucher(client, driver_header, REPLICA_PIN)
+        assert http.client.NOT_FOUND == response.status_code
+    finally:
+        replica_engine.execute(VoucherModel.__table__.delete())
+
+
+def test_failed_replica_falls_back(app, client, driver_header,
+                                   replica_engine):
+    add_voucher(app.db.engine, REPLICA_PIN)
+    app.db.Model.metadata.drop_all(bind=replica_engine)
+    try:
+        response = get_voucher(client, driver_header, REPLICA_PIN)
+        assert http.client.OK == response.status_code
+
+        # Not tried again until the retry interval
+        assert not replica_router.is_usable(replica_engine)
+    finally:
+        app.db.engine.execute(VoucherModel.__table__.delete().where(
+            VoucherModel.pin == REPLICA_PIN))
+
+
+def test_sticky_store():
+    store = LocalStickyStore(seconds=0.05)
+    store.mark('driver')
+    assert store.is_sticky('driver')
+    assert not store.is_sticky('other-driver')
+    time.sleep(0.05)
+    assert not store.is_sticky('driver')
@@ -0,0 +1,147 @@
+"""
+Test the hourly rollups of the vouchers
+"""
+import http.client
+
+import pytest
+from sqlalchemy import func
+
+from voucher_backend import outbox
+from voucher_backend.models import VoucherRollupModel, WalletOperationModel
+from voucher_backend.rollups import rebuild_rollups
+
+
+def totals(db):
+    """
+    The rollups of every hour, summed over their shards
+    """
+    rollup = VoucherRollupModel
+    rows = (
+        db.session.query(rollup.hour, func.sum(rollup.issued),
+                         func.sum(rollup.amountBought),
+                         func.sum(rollup.voucherWorth),
+                         func.sum(rollup.redeemed))
+        .group_by(rollup.hour)
+        .having(func.sum(rollup.issued) + func.sum(rollup.redeemed) > 0)
+        .all()
+    )
+    return {hour: tuple(values) for hour, *values in rows}
+
+
+def summed(db):
+    """
+    The rollups summed over all the hours, a test may cross one
+    """
+    return tuple(map(sum, zip(*totals(db).values()))) or (0, 0, 0, 0)
+
+
+def buy_voucher(client, driver_header):
+    response = client.post('/api/vouchers/',
+                           data={'driverPhoneNumber': '08012345678',
+                                 'voucherWorth': 1000},
+                           headers={'Authorization': driver_header})
+    return response.json
+
+
+def sell_voucher(client, driver_header, pin):
+    return client.put(f'/api/vouchers/buy/{pin}/',
+                      data={'userPhoneNumber': '08087654321'},
+                      headers={'Authorization': driver_header})
+
+
+def test_issuance_and_sale(app, client, discount, driver_header,
+                           wallet_stub):
+    voucher = buy_voucher(client, driver_header)
+    client.post('/api/vouchers/batch/',
+                data={'driverPhoneNumber': '08012345678', 'count': 3,
+                      'voucherWorth': 500},
+                headers={'Authorization': driver_header})
+    assert http.client.OK == sell_voucher(client, driver_header,
+                                          voucher['pin']).status_code
+
+    wallet_stub.status = 400
+    refused = buy_voucher(client, driver_header)
+    wallet_stub.status = 201
+    other = buy_voucher(client, driver_header)
+    wallet_stub.status = 400
+    sell_voucher(client, driver_header, other['pin'])
+
+    assert 'pin' not in refused
+    assert (5, 2800, 3500, 1) == summed(app.db)
+
+    # Counted as the rebuild counts them
+    rolled_up = totals(app.db)
+    rebuild_rollups()
+    assert rolled_up == totals(app.db)
+
+
+def test_refused_topup_in_outbox_mode(app, client, discount, driver_header,
+                                      wallet_stub, monkeypatch):
+    monkeypatch.setattr(outbox, 'WALLET_OUTBOX', True)
+    try:
+        voucher = buy_voucher(client, driver_header)
+        outbox.drain_outbox()
+        sell_voucher(client, driver_header, voucher['pin'])
+        assert 1 == summed(app.db)[3]
+
+        wallet_stub.status = 400
+        outbox.drain_outbox()
+        assert 0 == summed(app.db)[3]
+    finally:
+        WalletOperationModel.query.delete()
+        app.db.session.commit()
+
+
+def test_cancelled_purchase_in_outbox_mode(app, client, discount,
+                                           driver_header, wallet_stub,
+                                           monkeypatch):
+    monkeypatch.setattr(outbox, 'WALLET_OUTBOX', True)
+    try:
+        buy_voucher(client, driver_header)
+        client.post('/api/vouchers/batch/',
+                    data={'driverPhoneNumber': '08012345678', 'count': 2,
+                          'voucherWorth': 500},
+                    headers={'Authorization': driver_header})
+        assert 3 == summed(app.db)[0]
+
+        wallet_stub.status = 400
+        outbox.drain_outbox()
+        # The batch was paid at once
+        assert (2, 800, 1000, 0) == summed(app.db)
+
+        # Cancelled once
+        outbox.drain_outbox()
+        rolled_up = totals(app.db)
+        rebuild_rollups()
+        assert rolled_up == totals(app.db)
+    finally:
+        WalletOperationModel.query.delete()
+        app.db.session.commit()
+
+
+def test_rebuild_command(app, client, discount, driver_header, wallet_stub):
+    buy_voucher(client, driver_header)
+    VoucherRollupModel.query.delete()
+    app.db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['rebuild-rollups'])
+    assert 0 == result.exit_code, result.output
+    assert (1, 800, 1000, 0) == summed(app.db)
+
+
+@pytest.mark.parametrize('granularity', ['hour', 'day'])
+def test_stats_read_the_rollups(app, client, discount, driver_header,
+                                wallet_stub, granularity):
+    buy_voucher(client, driver_header)
+    hour, = totals(app.db)
+    VoucherRollupModel.query.update({'issued': 7})
+    app.db.session.commit()
+
+    params = {
+        'startdate': hour.strftime('%d/%m/%Y'),
+        'enddate': hour.strftime('%d/%m/%Y'),
+        'granularity': granularity,
+    }
+    response = client.get('/api/stat/datequery/', data=params,
+                          headers={'Authorization': driver_header})
+    assert 7 == sum(response.json.values())
@@ -0,0 +1,84 @@
+"""
+Test that the compiled serializers write the JSON of api.marshal
+"""
+import http.client
+import json
+from datetime import datetime
+
+from voucher_backend.api_namespace.api import (api, discount_serializer,
+                                               discountModel, voucherModel,
+                                               voucher_serializer)
+from voucher_backend.models import DiscountModel, VoucherModel
+
+
+def add_voucher(db, **values):
+    voucher = VoucherModel(driverId='test-driver', driverPhoneNumber='08000',
+                           amountBought=800, voucherWorth=1000, **values)
+    db.session.add(voucher)
+    db.session.commit()
+    return voucher
+
+
+def fetch_row(db, voucher):
+    table = VoucherModel.__table__
+    select = db.select(voucher_serializer.columns).where(
+        table.c.id == voucher.id)
+    return db.session.execute(select).first()
+
+
+def test_voucher_json_is_identical(app, driver_header):
+    vouchers = [
+        add_voucher(app.db, pin='sa0001', status=1),
+        # Escaped characters, and values of every type
+        add_voucher(app.db, pin='sa0002', status=0, discountAmount=200,
+                    userPhoneNumber='Adébáyọ̀ "08" \\  ',
+                    timeUsed=datetime(2020, 1, 2, 3, 4, 5, 6)),
+    ]
+
+    for voucher in vouchers:
+        row = fetch_row(app.db, voucher)
+        expected = json.dumps(api.marshal(voucher, voucherModel))
+        assert expected == voucher_serializer.encode(row)
+        assert json.loads(expected) == voucher_serializer.marshal(row)
+
+    rows = [fetch_row(app.db, voucher) for voucher in vouchers]
+    assert (json.dumps(api.marshal(vouchers, voucherModel))
+            == voucher_serializer.encode_list(rows))
+    assert '[]' == voucher_serializer.encode_list([])
+
+
+def test_discount_json_is_identical(app):
+    discount = DiscountModel(discountPercent=0.1 + 0.2,
+                             timestamp=datetime(2020, 1, 2),
+                             updateTimeStamp=None)
+    values = {column.name: getattr(discount, column.name)
+              for column in DiscountModel.__table__.columns}
+    row = discount_serializer.values(values)
+
+    assert (json.dumps(api.marshal(discount, discountModel))
+            == discount_serializer.encode(row))
+
+
+def test_voucher_response_is_identical(app, client, driver_header):
+    voucher = add_voucher(app.db, pin='sa0003', status=1)
+    response = client.get(f'/api/vouchers/pin/{voucher.pin}/',
+                          headers={'Authorization': driver_header})
+
+    assert http.client.OK == response.status_code
+    assert 'application/json' == response.headers['Content-Type']
+    expected = json.dumps(api.marshal(voucher, voucherModel)) + '\n'
+    assert expected == response.get_data(as_text=True)
+
+
+def test_debug_response_is_indented(app, client, driver_header):
+    voucher = add_voucher(app.db, pin='sa0004', status=1)
+    app.debug = True
+    try:
+        response = client.get(f'/api/vouchers/{voucher.id}/',
+                              headers={'Authorization': driver_header})
+    finally:
+        app.debug = False
+
+    assert http.client.OK == response.status_code
+    expected = json.dumps(api.marshal(voucher, voucherModel), indent=4) + '\n'
+    assert expected == response.get_data(as_text=True)
@@ -0,0 +1,69 @@
+import json
+import os
+import subprocess
+import sys
+
+from voucher_backend import startup
+from voucher_backend.discount_cache import discount_cache
+
+
+def test_cached_swagger(app):
+    startup.cache_swagger(app, path=None)
+    client = app.test_client()
+
+    response = client.get('/swagger.json')
+    assert 200 == response.status_code
+    assert 'application/json' == response.mimetype
+    assert 'paths' in response.json
+    etag = response.headers['ETag']
+
+    response = client.get('/swagger.json', headers={'If-None-Match': etag})
+    assert 304 == response.status_code
+
+
+def test_swagger_file(app, tmp_path):
+    path = tmp_path / 'swagger.json'
+    result = app.test_cli_runner().invoke(args=['swagger', '--output',
+                                                str(path)])
+    assert 0 == result.exit_code, result.output
+    schema = json.loads(path.read_text())
+    assert 'Voucher Service' == schema['info']['title']
+
+    startup.cache_swagger(app, path=str(path))
+    response = app.test_client().get('/swagger.json')
+    assert path.read_bytes() == response.data
+
+
+def test_warm_worker(app, discount):
+    discount_cache.invalidate(discount.version)
+
+    startup.warm_worker(app)
+    assert discount.id == discount_cache._discount['id']
+
+
+def test_lazy_imports():
+    script = ('import sys\n'
+              'from voucher_backend.app import create_app\n'
+              'create_app()\n'
+              'print(" ".join(sorted(sys.modules)))\n')
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     universal_newlines=True)
+    modules = output.split()
+    assert 'voucher_backend.api_namespace.api' in modules
+    assert 'alembic' not in modules
+    assert 'redis' not in modules
+
+
+def test_migrate_commands(app):
+    result = app.test_cli_runner().invoke(args=['db', '--help'])
+    assert 0 == result.exit_code, result.output
+    assert 'upgrade' in result.output
+
+
+def test_flask_migrate_plugin():
+    # The `flask` command runs the `db` group of the Flask-Migrate plugin
+    env = dict(os.environ, FLASK_APP='voucher_backend.app:create_app()')
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'flask', 'db', 'heads'], env=env,
+        universal_newlines=True)
+    assert '(head)' in output
@@ -0,0 +1,107 @@
+"""
+Test the voucher statistics
+"""
+import http.client
+from datetime import datetime
+
+from voucher_backend.models import VoucherModel
+from voucher_backend.rollups import rebuild_rollups
+from .helpers import count_statements
+
+GENERATED = [
+    datetime(2031, 1, 1, 10),
+    datetime(2031, 1, 1, 23, 30),
+    datetime(2031, 1, 3, 9),
+    datetime(2031, 3, 15, 12),
+]
+
+
+def add_vouchers(db):
+    for number, generated in enumerate(GENERATED):
+        voucher = VoucherModel(driverId='test-driver', driverPhoneNumber='0',
+                               pin=f'zz{number:04d}', amountBought=800,
+                               voucherWorth=1000, status=1,
+                               dateGenerated=generated)
+        db.session.add(voucher)
+    db.session.commit()
+    # Added behind the back of the rollups
+    rebuild_rollups()
+
+
+def test_date_query(app, client, driver_header):
+    add_vouchers(app.db)
+    statements, stop = count_statements()
+    params = {'startdate': '01/01/2031', 'enddate': '31/12/2031'}
+    response = client.get('/api/stat/datequery/', data=params,
+                          headers={'Authorization': driver_header})
+    stop()
+
+    assert http.client.OK == response.status_code
+    assert 365 == len(response.json)
+    assert 2 == response.json['01/01/2031']
+    assert 0 == response.json['02/01/2031']
+    assert 1 == response.json['03/01/2031']
+    assert 1 == len(statements)
+
+
+def test_date_query_timezone(app, client, driver_header):
+    add_vouchers(app.db)
+    params = {
+        'startdate': '01/01/2031',
+        'enddate': '02/01/2031',
+        'timezone': 'Africa/Lagos',
+    }
+    response = client.get('/api/stat/datequery/', data=params,
+                          headers={'Authorization': driver_header})
+
+    # 23:30 UTC is already the next day in Lagos
+    assert {'01/01/2031': 1, '02/01/2031': 1} == response.json
+
+
+def test_date_query_half_hour_timezone(app, client, driver_header):
+    add_vouchers(app.db)
+    params = {
+        'startdate': '01/01/2031',
+        'enddate': '02/01/2031',
+        'timezone': 'Asia/Kolkata',
+    }
+    response = client.get('/api/stat/datequery/', data=params,
+                          headers={'Authorization': driver_header})
+
+    # Counted from the vouchers, 23:30 UTC is 05:00 the next day in Kolkata
+    assert {'01/01/2031': 1, '02/01/2031': 1} == response.json
+
+
+def test_sum_query(app, client, driver_header):
+    add_vouchers(app.db)
+    response = client.get('/api/stat/sumquery/',
+                          headers={'Authorization': driver_header})
+    assert len(GENERATED) <= response.json
+
+
+def test_date_query_bad_range(client, driver_header):
+    params = {'startdate': '02/01/2031', 'enddate': '01/01/2031'}
+    response = client.get('/api/stat/datequery/', data=params,
+                          headers={'Authorization': driver_header})
+    assert http.client.BAD_REQUEST == response.status_code
+
+
+def test_month_query(app, client, driver_header):
+    add_vouchers(app.db)
+    response = client.get('/api/stat/monthquery/', data={'year': '2031'},
+                          headers={'Authorization': driver_header})
+
+    expected = {str(month): 0 for month in range(1, 13)}
+    expected.update({'1': 3, '3': 1})
+    assert expected == response.json
+
+
+def test_month_query_weekly(app, client, driver_header):
+    add_vouchers(app.db)
+    params = {'year': '2031', 'granularity': 'week'}
+    response = client.get('/api/stat/monthquery/', data=params,
+                          headers={'Authorization': driver_header})
+
+    # 1st of January 2031 is a Wednesday
+    assert 3 == response.json['30/12/2030']
+    assert 1 == response.json['10/03/2031']
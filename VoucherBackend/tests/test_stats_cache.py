@@ -0,0 +1,153 @@
+"""
+Test the cache of the stats results
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from voucher_backend import stats_cache as cache_module
+from voucher_backend.models import VoucherRollupModel
+from voucher_backend.rollups import rebuild_rollups
+from voucher_backend.stats_cache import (LocalStatsStore, StatsCache,
+                                         make_key, stats_ttl)
+
+from .helpers import count_statements
+from .test_stats import add_vouchers
+
+PARAMS = {'startdate': '01/01/2031', 'enddate': '31/01/2031'}
+
+
+def date_query(client, driver_header, **params):
+    return client.get('/api/stat/datequery/', data=dict(PARAMS, **params),
+                      headers={'Authorization': driver_header})
+
+
+def test_results_are_cached(app, client, driver_header):
+    add_vouchers(app.db)
+    first = date_query(client, driver_header, timezone='UTC')
+
+    statements, stop = count_statements()
+    try:
+        # The same parameters, once normalised
+        cached = date_query(client, driver_header, timezone='utc')
+    finally:
+        stop()
+
+    assert first.json == cached.json
+    assert 0 == len(statements)
+
+
+def test_rebuild_clears_the_cache(app, client, driver_header):
+    add_vouchers(app.db)
+    assert 2 == date_query(client, driver_header).json['01/01/2031']
+
+    VoucherRollupModel.query.delete()
+    app.db.session.commit()
+    assert 2 == date_query(client, driver_header).json['01/01/2031']
+
+    rebuild_rollups()
+    assert 2 == date_query(client, driver_header).json['01/01/2031']
+    assert 3 == client.get('/api/stat/monthquery/',
+                           data={'year': 2031, 'granularity': 'month'},
+                           headers={'Authorization': driver_header}
+                           ).json['1']
+
+
+def test_ttls():
+    now = datetime.utcnow()
+    assert cache_module.STATS_CLOSED_TTL == stats_ttl(
+        'hour', now - timedelta(hours=2), pytz.utc)
+    assert cache_module.STATS_TTLS['day'] == stats_ttl(
+        'day', now + timedelta(days=1), pytz.utc)
+    # Ended an hour ago in UTC, still open two hours west of it
+    assert cache_module.STATS_TTLS['hour'] == stats_ttl(
+        'hour', now - timedelta(hours=1), pytz.timezone('Etc/GMT+2'))
+
+
+def test_make_key():
+    assert 'date:2031-01-01T00:00:00:day:UTC' == make_key(
+        'date', datetime(2031, 1, 1), 'day', 'UTC')
+
+
+def slow_compute(calls, result=None):
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return result or {'count': 1}
+    return compute
+
+
+@pytest.mark.parametrize('store', [None, LocalStatsStore()])
+def test_concurrent_requests_compute_once(store):
+    cache = StatsCache(store)
+    calls, results = [], []
+    compute = slow_compute(calls)
+
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            cache.get('key', 60, compute)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 1 == len(calls)
+    assert [{'count': 1}] * 5 == results
+
+
+def test_workers_share_the_results():
+    store = LocalStatsStore()
+    workers = [StatsCache(store), StatsCache(store)]
+    calls, results = [], []
+
+    threads = [
+        threading.Thread(target=lambda worker=worker: results.append(
+            worker.get('key', 60, slow_compute(calls))))
+        for worker in workers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # One computed it, the other waited for it
+    assert 1 == len(calls)
+    assert [{'count': 1}] * 2 == results
+
+
+def test_failure_reaches_the_waiting_requests():
+    cache = StatsCache()
+    errors = []
+
+    def compute():
+        time.sleep(0.1)
+        raise ValueError('broken')
+
+    def request():
+        try:
+            cache.get('key', 60, compute)
+        except ValueError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=request) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 3 == len(errors)
+    # Not cached
+    assert {'count': 2} == cache.get('key', 60, lambda: {'count': 2})
+
+
+def test_local_copy_expires():
+    store = LocalStatsStore()
+    cache = StatsCache(store, local_ttl=0)
+    cache.get('key', 60, lambda: {'count': 1})
+    store.clear()
+    assert {'count': 2} == cache.get('key', 60, lambda: {'count': 2})
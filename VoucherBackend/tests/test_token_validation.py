@@ -1,6 +1,10 @@
+import http.client
+from datetime import datetime, timedelta
+
 import delorean
+import jwt
 from freezegun import freeze_time
-from area_backend import token as token_validation
+from voucher_backend import token_validation
 from .constants import PRIVATE_KEY, PUBLIC_KEY
 
 INVALID_PUBLIC_KEY = '''
@@ -81,6 +85,42 @@ def test_invalid_token_header_no_user_id():
     assert None is result
 
 
+def test_invalid_token_header_wrong_algorithm():
+    payload = {
+        'id': 1,
+        'exp': datetime.utcnow() + timedelta(days=1),
+    }
+    token = jwt.encode(payload, 'secret', algorithm='HS256').decode('utf8')
+    header = f'Bearer {token}'
+    result = token_validation.validate_token_header(header, PUBLIC_KEY)
+    assert None is result
+
+
+def test_invalid_token_header_not_valid_yet():
+    payload = {
+        'id': 1,
+        'exp': datetime.utcnow() + timedelta(days=1),
+        'nbf': datetime.utcnow() + timedelta(hours=1),
+    }
+    token = token_validation.encode_token(payload, PRIVATE_KEY)
+    token = token.decode('utf8')
+    header = f'Bearer {token}'
+    result = token_validation.validate_token_header(header, PUBLIC_KEY)
+    assert None is result
+
+
+def test_invalid_token_is_unauthorized(client):
+    payload = {
+        'id': 1,
+        'auth_id': 1,
+        'exp': datetime.utcnow() + timedelta(days=1),
+    }
+    token = jwt.encode(payload, 'secret', algorithm='HS256').decode('utf8')
+    response = client.get('/api/me/',
+                          headers={'Authorization': f'Bearer {token}'})
+    assert http.client.UNAUTHORIZED == response.status_code
+
+
 def test_valid_token_header_invalid_key():
     payload = {
         'id': 1
@@ -97,3 +137,56 @@ def test_valid_token_header():
     header = token_validation.generate_token_header(payload, PRIVATE_KEY)
     result = token_validation.validate_token_header(header, PUBLIC_KEY)
     assert payload['id'] == result['id']
+
+
+def test_valid_token_header_is_cached():
+    cache = token_validation.TokenCache()
+    payload = {
+        'id': 1
+    }
+    header = token_validation.generate_token_header(payload, PRIVATE_KEY)
+    first = token_validation.validate_token_header(header, PUBLIC_KEY, cache)
+    second = token_validation.validate_token_header(header, PUBLIC_KEY, cache)
+    assert first == second
+    assert 1 == cache.hits
+    assert 1 == cache.misses
+
+
+def test_cached_token_header_invalid_key():
+    cache = token_validation.TokenCache()
+    payload = {
+        'id': 1
+    }
+    header = token_validation.generate_token_header(payload, PRIVATE_KEY)
+    token_validation.validate_token_header(header, PUBLIC_KEY, cache)
+    result = token_validation.validate_token_header(header, INVALID_PUBLIC_KEY,
+                                                    cache)
+    assert None is result
+
+
+def test_cached_token_header_expired():
+    cache = token_validation.TokenCache()
+    payload = {
+        'id': 2,
+        'exp': delorean.parse('2018-05-17 13:47:40').datetime,
+    }
+    token = token_validation.encode_token(payload, PRIVATE_KEY)
+    header = f'Bearer {token.decode("utf8")}'
+    with freeze_time('2018-05-17 13:47:34'):
+        result = token_validation.validate_token_header(header, PUBLIC_KEY,
+                                                        cache)
+        assert 2 == result['id']
+    with freeze_time('2018-05-17 13:47:41'):
+        result = token_validation.validate_token_header(header, PUBLIC_KEY,
+                                                        cache)
+        assert None is result
+    assert 0 == cache.stats()['size']
+
+
+def test_token_cache_is_bounded():
+    cache = token_validation.TokenCache(maxsize=2)
+    for user_id in range(3):
+        header = token_validation.generate_token_header({'id': user_id},
+                                                        PRIVATE_KEY)
+        token_validation.validate_token_header(header, PUBLIC_KEY, cache)
+    assert 2 == cache.stats()['size']
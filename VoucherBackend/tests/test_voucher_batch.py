@@ -0,0 +1,85 @@
+"""
+Test the batch voucher issuance
+"""
+import http.client
+
+from voucher_backend.models import VoucherModel
+
+
+def test_batch_with_count(client, discount, driver_header, wallet_stub):
+    data = {
+        'driverPhoneNumber': '08012345678',
+        'count': 5,
+        'voucherWorth': 1000,
+    }
+    response = client.post('/api/vouchers/batch/', data=data,
+                           headers={'Authorization': driver_header})
+
+    assert http.client.CREATED == response.status_code
+    result = response.json
+    assert 5 == len(result)
+    assert 5 == len({voucher['pin'] for voucher in result})
+
+    # The wallet is charged once for the whole batch
+    expected = 5 * int((1 - discount.discountPercent) * 1000)
+    assert 1 == len(wallet_stub.requests)
+    path, form = wallet_stub.requests[0]
+    assert '/api/purchaseVoucher/' == path
+    assert str(expected) == form['amount']
+
+    pins = [voucher['pin'] for voucher in result]
+    stored = VoucherModel.query.filter(VoucherModel.pin.in_(pins)).count()
+    assert 5 == stored
+
+
+def test_batch_with_worth_list(client, discount, driver_header, wallet_stub):
+    data = {
+        'driverPhoneNumber': '08012345678',
+        'voucherWorths': [500, 1000, 2000],
+    }
+    response = client.post('/api/vouchers/batch/', json=data,
+                           headers={'Authorization': driver_header})
+
+    assert http.client.CREATED == response.status_code
+    worths = sorted(voucher['voucherWorth'] for voucher in response.json)
+    assert [500, 1000, 2000] == worths
+
+
+def test_batch_wallet_failure_creates_nothing(client, discount, driver_header,
+                                              wallet_stub):
+    wallet_stub.status = 400
+    wallet_stub.body = {'message': 'Insufficient funds'}
+    data = {
+        'driverPhoneNumber': '08012345678',
+        'count': 3,
+        'voucherWorth': 1000,
+    }
+    response = client.post('/api/vouchers/batch/', data=data,
+                           headers={'Authorization': driver_header})
+
+    assert http.client.BAD_REQUEST == response.status_code
+    query = VoucherModel.query.filter(VoucherModel.driverId == 'test-driver')
+    assert 0 == query.count()
+
+
+def test_batch_needs_worth(client, discount, driver_header):
+    data = {
+        'driverPhoneNumber': '08012345678',
+        'count': 3,
+    }
+    response = client.post('/api/vouchers/batch/', data=data,
+                           headers={'Authorization': driver_header})
+    assert http.client.BAD_REQUEST == response.status_code
+
+
+def test_batch_size_is_checked(client, discount, driver_header, wallet_stub):
+    for data in ({'count': -1, 'voucherWorth': 1000},
+                 {'count': 0, 'voucherWorth': 1000},
+                 {'count': 10 ** 9, 'voucherWorth': 1000},
+                 {'count': 3, 'voucherWorth': 0},
+                 {'voucherWorths': [1000] * 101}):
+        data['driverPhoneNumber'] = '08012345678'
+        response = client.post('/api/vouchers/batch/', json=data,
+                               headers={'Authorization': driver_header})
+        assert http.client.BAD_REQUEST == response.status_code, data
+    assert [] == wallet_stub.requests
@@ -0,0 +1,130 @@
+"""
+Test the read-through cache of the voucher lookups by pin and by id
+"""
+import http.client
+import time
+from datetime import datetime
+
+import pytest
+
+from voucher_backend.models import VoucherModel
+from voucher_backend.pin_allocator import pin_allocator
+from voucher_backend.voucher_cache import (LocalVoucherStore, VoucherCache,
+                                           decode_row, encode_row,
+                                           voucher_cache)
+
+from .helpers import count_statements
+
+
+@pytest.fixture
+def voucher(app, driver_header):
+    voucher = VoucherModel(driverId='test-driver', driverPhoneNumber='0',
+                           pin='cc0001', amountBought=800, voucherWorth=1000,
+                           status=1)
+    app.db.session.add(voucher)
+    app.db.session.commit()
+    return voucher
+
+
+def get(client, driver_header, path):
+    return client.get(path, headers={'Authorization': driver_header})
+
+
+def test_lookups_are_cached(client, driver_header, voucher):
+    voucher_id = voucher.id
+    response = get(client, driver_header, '/api/vouchers/pin/cc0001/')
+    assert http.client.OK == response.status_code
+
+    statements, stop = count_statements()
+    try:
+        cached = get(client, driver_header, '/api/vouchers/pin/cc0001/')
+        # Cached under the id too
+        by_id = get(client, driver_header, f'/api/vouchers/{voucher_id}/')
+    finally:
+        stop()
+    assert [] == statements
+    assert response.json == cached.json == by_id.json
+
+
+def test_sale_invalidates(client, driver_header, voucher, wallet_stub):
+    response = get(client, driver_header, f'/api/vouchers/{voucher.id}/')
+    assert 1 == response.json['status']
+
+    response = client.put('/api/vouchers/buy/cc0001/',
+                          data={'userPhoneNumber': '08087654321'},
+                          headers={'Authorization': driver_header})
+    assert http.client.OK == response.status_code
+
+    for path in ('/api/vouchers/pin/cc0001/', f'/api/vouchers/{voucher.id}/'):
+        response = get(client, driver_header, path)
+        assert 2 == response.json['status']
+        assert '08087654321' == response.json['userPhoneNumber']
+
+
+def test_issuance_invalidates(client, discount, driver_header, wallet_stub,
+                              monkeypatch):
+    monkeypatch.setattr(voucher_cache, 'negative_ttl', 60)
+    monkeypatch.setattr(pin_allocator, 'allocate', lambda: 'cc0002')
+
+    response = get(client, driver_header, '/api/vouchers/pin/cc0002/')
+    assert http.client.NOT_FOUND == response.status_code
+
+    response = client.post('/api/vouchers/',
+                           data={'driverPhoneNumber': '08012345678',
+                                 'voucherWorth': 1000},
+                           headers={'Authorization': driver_header})
+    assert http.client.CREATED == response.status_code
+
+    response = get(client, driver_header, '/api/vouchers/pin/cc0002/')
+    assert http.client.OK == response.status_code
+
+
+def test_unknown_pins_are_cached_briefly(app, client, driver_header,
+                                         monkeypatch):
+    monkeypatch.setattr(voucher_cache, 'negative_ttl', 0.1)
+    response = get(client, driver_header, '/api/vouchers/pin/cc0003/')
+    assert http.client.NOT_FOUND == response.status_code
+
+    # Added behind the back of the cache
+    app.db.session.add(VoucherModel(
+        driverId='test-driver', driverPhoneNumber='0', pin='cc0003',
+        amountBought=800, voucherWorth=1000, status=1))
+    app.db.session.commit()
+    response = get(client, driver_header, '/api/vouchers/pin/cc0003/')
+    assert http.client.NOT_FOUND == response.status_code
+
+    time.sleep(0.1)
+    response = get(client, driver_header, '/api/vouchers/pin/cc0003/')
+    assert http.client.OK == response.status_code
+
+
+def test_shared_store(app):
+    store = LocalVoucherStore()
+    row = (1, 'cc0004', datetime(2020, 1, 2, 3, 4, 5), None, 1000.0)
+    assert row == decode_row(encode_row(row))
+    row = (1, 'cc0004', datetime(2020, 1, 2, 3, 4, 5, 6789), None, 1000.0)
+    assert row == decode_row(encode_row(row))
+
+    loads = []
+
+    def load():
+        loads.append(1)
+        return None
+
+    worker, other_worker = VoucherCache(store), VoucherCache(store)
+    assert worker.get_by_pin('cc0004', load) is None
+    # Negative entries are shared too
+    assert other_worker.get_by_pin('cc0004', load) is None
+    assert 1 == len(loads)
+
+    worker.invalidate(pins=['cc0004'])
+    assert store.get('voucher:cache:pin:cc0004') is None
+    other_worker.clear()
+    assert other_worker.get_by_pin('cc0004', load) is None
+    assert 2 == len(loads)
+
+    # Dropped again on commit
+    worker.invalidate(pins=['cc0004'])
+    store.set('voucher:cache:pin:cc0004', encode_row(row), 60)
+    app.db.session.commit()
+    assert store.get('voucher:cache:pin:cc0004') is None
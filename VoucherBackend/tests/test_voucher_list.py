@@ -0,0 +1,77 @@
+"""
+Test the cursor pagination of the vouchers
+"""
+import http.client
+
+from voucher_backend.models import VoucherModel
+
+
+def add_vouchers(db, number):
+    for index in range(number):
+        voucher = VoucherModel(driverId='test-driver', driverPhoneNumber='0',
+                               pin=f'yy{index:04d}', amountBought=800,
+                               voucherWorth=1000 * (index % 2 + 1), status=1)
+        db.session.add(voucher)
+    db.session.commit()
+
+
+def test_cursor_pages(app, client, driver_header):
+    add_vouchers(app.db, 7)
+    headers = {'Authorization': driver_header}
+    params = {'driverId': 'test-driver', 'limit': 3}
+
+    ids = []
+    pages = 0
+    while True:
+        response = client.get('/api/vouchers/list/', query_string=params,
+                              headers=headers)
+        assert http.client.OK == response.status_code
+        pages += 1
+        ids.extend(voucher['id'] for voucher in response.json['vouchers'])
+        if not response.json['nextCursor']:
+            break
+        params['cursor'] = response.json['nextCursor']
+
+    assert 3 == pages
+    assert 7 == len(ids)
+    assert sorted(ids) == ids
+
+
+def test_cursor_keeps_filters(app, client, driver_header):
+    add_vouchers(app.db, 6)
+    params = {
+        'driverId': 'test-driver',
+        'minvoucherWorth': 2000,
+        'limit': 2,
+    }
+    response = client.get('/api/vouchers/list/', query_string=params,
+                          headers={'Authorization': driver_header})
+    first = response.json['vouchers']
+
+    params['afterId'] = first[-1]['id']
+    response = client.get('/api/vouchers/list/', query_string=params,
+                          headers={'Authorization': driver_header})
+    second = response.json['vouchers']
+
+    worths = {voucher['voucherWorth'] for voucher in first + second}
+    assert {2000} == worths
+    assert 3 == len(first + second)
+    assert None is response.json['nextCursor']
+
+
+def test_invalid_cursor(client, driver_header):
+    params = {'cursor': 'not a cursor'}
+    response = client.get('/api/vouchers/list/', query_string=params,
+                          headers={'Authorization': driver_header})
+    assert http.client.BAD_REQUEST == response.status_code
+
+
+def test_invalid_limit(client, driver_header):
+    for limit in (0, -1, 1001):
+        response = client.get('/api/vouchers/list/',
+                              query_string={'limit': limit},
+                              headers={'Authorization': driver_header})
+        assert http.client.BAD_REQUEST == response.status_code
+    response = client.get('/api/me/', query_string={'limit': 0},
+                          headers={'Authorization': driver_header})
+    assert http.client.BAD_REQUEST == response.status_code
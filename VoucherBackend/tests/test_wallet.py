@@ -0,0 +1,75 @@
+"""
+Test the wallet service client
+"""
+import pytest
+from prometheus_client import REGISTRY
+
+from voucher_backend.wallet import (CircuitBreaker, WalletClient,
+                                    WalletOutcomeUnknown, WalletUnavailable)
+from voucher_backend.wallet_stub import WalletStub
+
+
+@pytest.fixture
+def stub():
+    stub = WalletStub().start()
+    yield stub
+    stub.stop()
+
+
+def test_purchase_voucher(stub):
+    client = WalletClient(stub.url)
+    response = client.purchase_voucher('Bearer token', 800, '080')
+
+    assert 201 == response.status_code
+    assert [('/api/purchaseVoucher/',
+             {'amount': '800', 'phoneNo': '080',
+              'desc': 'Voucher Purchase By Driver'})] == stub.requests
+    count = REGISTRY.get_sample_value(
+        'wallet_request_duration_seconds_count',
+        {'operation': 'purchase_voucher', 'status': '201'})
+    assert count >= 1
+
+
+def test_connection_is_reused(stub):
+    client = WalletClient(stub.url)
+    client.topup_wallet('Bearer token', 1000, '080')
+    session = client.session
+    client.topup_wallet('Bearer token', 1000, '080')
+    assert session is client.session
+    assert 2 == len(stub.requests)
+
+
+def test_read_timeout(stub):
+    stub.latency = 0.5
+    client = WalletClient(stub.url, read_timeout=0.1)
+    # Sent, the wallet may have applied it
+    with pytest.raises(WalletOutcomeUnknown):
+        client.topup_wallet('Bearer token', 1000, '080')
+    # Posts are not retried once sent
+    assert 1 == len(stub.requests)
+
+
+def test_circuit_opens_and_recovers(stub):
+    stub.status = 503
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    client = WalletClient(stub.url, breaker=breaker)
+    client.topup_wallet('Bearer token', 1000, '080')
+    client.topup_wallet('Bearer token', 1000, '080')
+
+    assert 'open' == breaker.state
+    with pytest.raises(WalletUnavailable):
+        client.topup_wallet('Bearer token', 1000, '080')
+    assert 2 == len(stub.requests)
+
+    stub.status = 201
+    breaker.opened_at -= 0.2
+    assert 'half-open' == breaker.state
+    client.topup_wallet('Bearer token', 1000, '080')
+    assert 'closed' == breaker.state
+
+
+def test_unreachable_wallet():
+    client = WalletClient('http://127.0.0.1:9/', connect_timeout=0.2,
+                          retries=1)
+    with pytest.raises(WalletUnavailable):
+        client.purchase_voucher('Bearer token', 800, '080')
@@ -0,0 +1,294 @@
+"""
+Admission control of the write endpoints.
+
+During spikes, purchases and redemptions wait on the wallet and the
+database while holding the greenlets of their worker. Past a point they
+take them all, and the cheap reads wait behind them. The write endpoints
+are admitted through two checks, before any query:
+
+- every driver, the `auth_id` of their token, has a token bucket of
+  DRIVER_BURST requests refilled at DRIVER_RATE per second, shared by the
+  workers through Redis when REDIS_URL is set. A driver over their rate is
+  answered 503 Service Unavailable
+- every class of endpoint has a gate of ADMISSION_LIMIT requests at once
+  per worker. Up to ADMISSION_QUEUE_SIZE more wait for a place, at most
+  ADMISSION_QUEUE_TIMEOUT seconds. The others are answered 503 Service
+  Unavailable
+
+Both answers tell the client when to retry with Retry-After, the time
+their bucket refills for a throttled driver.
+
+The gates matter in the gevent mode, where a worker serves GEVENT_CORES
+requests at once: the writes running and waiting take at most 60% of
+them by default, the rest is left to the reads. A sync worker serves one
+request at a time, its gates are open by default.
+"""
+import functools
+import http.client
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+
+from voucher_backend import config
+from voucher_backend.cooperative import GEVENT_CORES, is_cooperative
+from voucher_backend.metrics import Counter, Gauge
+from voucher_backend.token_validation import validate_token_header
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.environ.get('REDIS_URL')
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', '1') == '1'
+# Requests of each class of endpoint served at once by a worker, 0 for no
+# limit
+ADMISSION_LIMIT = int(os.environ.get(
+    'ADMISSION_LIMIT', GEVENT_CORES // 5 if is_cooperative() else 0))
+ADMISSION_QUEUE_SIZE = int(os.environ.get(
+    'ADMISSION_QUEUE_SIZE', GEVENT_CORES // 10))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 1))
+# Seconds, when the gate of an endpoint is full
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+# Requests per second of a driver to the write endpoints, 0 for no limit
+DRIVER_RATE = float(os.environ.get('DRIVER_RATE', 5))
+DRIVER_BURST = float(os.environ.get('DRIVER_BURST', 20))
+DRIVER_BUCKETS_SIZE = int(os.environ.get('DRIVER_BUCKETS_SIZE', 10000))
+BUCKET_KEY = 'voucher:admission:driver:{}'
+
+PURCHASE = 'purchase'
+REDEMPTION = 'redemption'
+
+admission_requests = Counter(
+    'admission_requests',
+    'Requests to the write endpoints, per class and admission result',
+    labelnames=('endpoint', 'result'),
+)
+admission_in_flight = Gauge(
+    'admission_in_flight',
+    'Requests admitted and not answered yet, per class of endpoint',
+    labelnames=('endpoint',),
+    multiprocess_mode='livesum',
+)
+
+# Takes a token from the bucket in KEYS[1], with ARGV the rate and the
+# burst. Returns the seconds until a token is available, 0 when one was
+# taken. The clock is the one of Redis, shared by all the nodes whatever
+# the skew of theirs. Redis before 5 must be told to replicate the writes
+# of a script reading it
+TAKE_TOKEN = '''
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated',
+           tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(wait)
+'''
+
+
+class RedisBucketStore:
+    """
+    Share the buckets of the drivers between workers and nodes
+    """
+
+    def __init__(self, url):
+        # Only imported when configured, it slows the start of the workers
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.errors = redis.RedisError
+        self._take = self.client.register_script(TAKE_TOKEN)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[BUCKET_KEY.format(key)],
+                                args=[rate, burst]))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(BUCKET_KEY.format('*')))
+        if keys:
+            self.client.delete(*keys)
+
+
+class LocalBucketStore:
+    """
+    In-process stand-in for RedisBucketStore, each worker then has its own
+    buckets
+    """
+    errors = ()
+
+    def __init__(self, maxsize=DRIVER_BUCKETS_SIZE):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            # The least recently seen drivers have a full bucket anyway
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class DriverBuckets:
+    """
+    Rate of the requests of each driver
+    """
+
+    def __init__(self, store, rate=DRIVER_RATE, burst=DRIVER_BURST):
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+
+    def take(self, auth_id):
+        """
+        Seconds until the driver `auth_id` may send a request, 0 if they
+        may now
+        """
+        if not self.rate or auth_id is None:
+            return 0
+        try:
+            return self.store.take(auth_id, self.rate, self.burst)
+        except self.store.errors:
+            # Better no limit than no writes
+            logger.warning('Cannot read the bucket of a driver, admitting')
+            return 0
+
+    def clear(self):
+        try:
+            self.store.clear()
+        except self.store.errors:
+            logger.error('Cannot clear the buckets of the drivers')
+
+
+class Gate:
+    """
+    Requests of a class of endpoint served at once by this worker, with a
+    bounded queue of the ones waiting for a place
+    """
+
+    def __init__(self, name, limit=ADMISSION_LIMIT,
+                 queue_size=ADMISSION_QUEUE_SIZE,
+                 timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def enter(self):
+        """
+        Take a place, waiting for one if needed. Returns the reason it was
+        not admitted, None if it was
+        """
+        with self._condition:
+            if not self.limit or self.in_flight < self.limit:
+                self.in_flight += 1
+                return None
+            if self.waiting >= self.queue_size:
+                return 'queue_full'
+
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.timeout
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return 'timeout'
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            return None
+
+    def leave(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+
+gates = {
+    PURCHASE: Gate(PURCHASE),
+    REDEMPTION: Gate(REDEMPTION),
+}
+driver_buckets = DriverBuckets(
+    RedisBucketStore(REDIS_URL) if REDIS_URL else LocalBucketStore())
+
+
+def rejected_response(status, message, retry_after):
+    response = {
+        "status": "error",
+        "message": message,
+    }
+    return response, status, {'Retry-After': str(retry_after)}
+
+
+def admission_control(endpoint):
+    """
+    Admit the requests of a resource method of the class `endpoint`
+    through the bucket of their driver and the gate of the class
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ADMISSION_CONTROL:
+                return function(*args, **kwargs)
+
+            # Cached, the method validates the token again. An invalid one
+            # is refused there, before any work
+            payload = validate_token_header(
+                request.headers.get('Authorization'), config.PUBLIC_KEY)
+            wait = driver_buckets.take(payload and payload.get('auth_id'))
+            if wait:
+                admission_requests.labels(endpoint, 'throttled').inc()
+                return rejected_response(http.client.SERVICE_UNAVAILABLE,
+                                         'Driver Rate Exceeded',
+                                         math.ceil(wait))
+
+            gate = gates[endpoint]
+            reason = gate.enter()
+            if reason is not None:
+                admission_requests.labels(endpoint, reason).inc()
+                logger.warning(f'Shed a {endpoint} request: {reason}')
+                return rejected_response(http.client.SERVICE_UNAVAILABLE,
+                                         'Service Overloaded',
+                                         ADMISSION_RETRY_AFTER)
+
+            admission_requests.labels(endpoint, 'admitted').inc()
+            admission_in_flight.labels(endpoint).inc()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                admission_in_flight.labels(endpoint).dec()
+                gate.leave()
+        return wrapper
+    return decorator
@@ -1,23 +1,48 @@
+import base64
 import http.client
+import json
 import os
 from datetime import datetime, timedelta
 from uuid import uuid4
-import random
-import string
 
 
-from flask import abort
+from flask import Response, abort, g, stream_with_context
 from flask_restplus import Namespace, Resource, fields
-import requests
-from sqlalchemy import func
 
-from voucher_backend import config
+from voucher_backend import config, export, outbox, redemption, rollups
+from voucher_backend.admission import PURCHASE, REDEMPTION, admission_control
 from voucher_backend.db import db
-from voucher_backend.models import VoucherModel, DiscountModel
+from voucher_backend.discount_cache import discount_cache
+from voucher_backend.models import (VoucherModel, DiscountModel,
+                                    WalletOperationModel)
+from voucher_backend.pin_allocator import keyspace_usage, pin_allocator
+from voucher_backend.query_profiler import query_budget
+from voucher_backend.redemption import (claim_voucher, confirm_voucher,
+                                        release_voucher)
+from voucher_backend.replica import read_only
+from voucher_backend.serializers import Serializer, json_response
+from voucher_backend.stats import (GRANULARITIES, count_vouchers, get_timezone,
+                                   total_vouchers)
+from voucher_backend.stats_cache import (STATS_TOTAL_TTL, make_key,
+                                         stats_cache, stats_ttl)
 from voucher_backend.token_validation import validate_token_header
-
-
-WALLET_SERVICE = os.environ.get("WALLET_SERVICE")
+from voucher_backend.voucher_cache import voucher_cache
+from voucher_backend.wallet import (WalletOutcomeUnknown, WalletUnavailable,
+                                    wallet_client)
+
+
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 100))
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+# Keys of the stats results for each granularity
+BUCKET_LABELS = {
+    'hour': '%d/%m/%Y %H:00',
+    'day': '%d/%m/%Y',
+    'week': '%d/%m/%Y',
+    'month': '%m/%Y',
+}
 
 api = Namespace('api', description='General API operations')
 
@@ -26,11 +51,12 @@ def authentication_header_parser(value):
     payload = validate_token_header(value, config.PUBLIC_KEY)
     if payload is None:
         abort(401)
+    # Routes the reads of the client after its writes, see replica.py
+    g.auth_id = payload.get('auth_id')
     return payload
 
 
-def check_admin_return_payload(parser):
-    args = parser.parse_args()
+def check_admin_return_payload(args):
     tokenPayload = authentication_header_parser(args['Authorization'])
 
     # check if user is an admin
@@ -39,16 +65,201 @@ def check_admin_return_payload(parser):
 
     return tokenPayload
 
-def generate_pin():
-    pin = ''
-    for j in range(2):
-        pin += random.choice(string.ascii_lowercase)
-    for i in range(4):
-        pin += str(random.randint(0,9))
-    anypin = VoucherModel.query.filter(VoucherModel.pin==pin).first()
-    if anypin:
-        generate_pin()
-    return pin
+
+def wallet_unavailable_response():
+    response = {
+        "status": "error",
+        "message": "Wallet service unavailable"
+    }
+    return response, http.client.SERVICE_UNAVAILABLE
+
+
+def paid_for(response):
+    """
+    Whether the wallet answer to a purchase shows the driver paid, None if
+    it does not tell: its errors may come after the debit
+    """
+    if response.status_code >= 500:
+        return None
+    return response.status_code == 201
+
+
+def voucher_not_claimed_response(pin):
+    """
+    Explain why the voucher with `pin` could not be claimed
+    """
+    status = (
+        db.session.query(VoucherModel.status)
+        .filter(VoucherModel.pin == pin)
+        .scalar()
+    )
+    if status is None:
+        # The voucher does not exist
+        return ({"status": "error", "message": "Not Found"},
+                http.client.NOT_FOUND)
+    if status == redemption.USED:
+        return {"status": "error", "message": "Voucher Sold"}, http.client.OK
+    return ({"status": "error", "message": "Voucher Not Available"},
+            http.client.OK)
+
+
+def encode_cursor(voucher_id):
+    data = json.dumps({'id': voucher_id}).encode('utf8')
+    return base64.urlsafe_b64encode(data).decode('utf8')
+
+
+def decode_cursor(cursor):
+    """
+    Return the voucher id stored in a cursor, or None if it is not valid
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('utf8')))
+        return int(data['id'])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def paginate_vouchers(query, args):
+    """
+    Return the page of a voucher query that follows the cursor (or afterId)
+    in args, with the cursor of the next page
+    """
+    limit = args['limit']
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(http.client.BAD_REQUEST,
+              f'The limit must be between 1 and {MAX_PAGE_SIZE}')
+
+    after_id = args['afterId']
+    if args['cursor']:
+        after_id = decode_cursor(args['cursor'])
+        if after_id is None:
+            abort(http.client.BAD_REQUEST)
+
+    if after_id is not None:
+        query = query.filter(VoucherModel.id > after_id)
+
+    # Fetch one more row to know if there is a next page
+    query = query.order_by(VoucherModel.id).limit(limit + 1)
+    vouchers = db.session.execute(query.statement).fetchall()
+    next_cursor = None
+    if len(vouchers) > limit:
+        vouchers = vouchers[:limit]
+        next_cursor = encode_cursor(vouchers[-1].id)
+
+    return {
+        'vouchers': vouchers,
+        'nextCursor': next_cursor,
+    }
+
+
+def stream_vouchers(query):
+    """
+    Stream the vouchers of a voucher_query as a JSON array. They are fetched
+    in batches from a server side cursor and serialised batch by batch, so
+    memory stays flat whatever the number of vouchers
+    """
+    statement = query.order_by(VoucherModel.id).statement.execution_options(
+        stream_results=True)
+
+    def generate():
+        result = db.session.execute(statement)
+        yield '['
+        separator = ''
+        while True:
+            vouchers = result.fetchmany(STREAM_BATCH_SIZE)
+            if not vouchers:
+                break
+            yield separator + ', '.join(
+                [voucher_serializer.encode(voucher) for voucher in vouchers])
+            separator = ', '
+        yield ']\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def voucher_query():
+    """
+    Query of the columns of voucherModel, its rows are serialised by
+    voucher_serializer
+    """
+    return db.session.query(*voucher_serializer.columns)
+
+
+def voucher_response(voucher):
+    return json_response(lambda: voucher_serializer.encode(voucher),
+                         lambda: voucher_serializer.marshal(voucher))
+
+
+def voucher_list_response(vouchers):
+    return json_response(lambda: voucher_serializer.encode_list(vouchers),
+                         lambda: voucher_serializer.marshal_list(vouchers))
+
+
+def voucher_page_response(page):
+    def encode():
+        return '{"vouchers": %s, "nextCursor": %s}' % (
+            voucher_serializer.encode_list(page['vouchers']),
+            json.dumps(page['nextCursor']),
+        )
+
+    def marshal():
+        return {
+            'vouchers': voucher_serializer.marshal_list(page['vouchers']),
+            'nextCursor': page['nextCursor'],
+        }
+
+    return json_response(encode, marshal)
+
+
+def filter_vouchers(query, args):
+    """
+    Apply the filters of filterParser to a voucher query
+    """
+    if args['id']:
+        query = (
+            query.filter(VoucherModel.id == args['id'])
+        )
+    if args['driverId']:
+        query = (
+            query.filter(VoucherModel.driverId == args['driverId'])
+        )
+    if args['driverPhoneNumber']:
+        query = (
+            query.filter(
+                VoucherModel.driverPhoneNumber == args['driverPhoneNumber'])
+        )
+    if args['userPhoneNumber']:
+        query = (
+            query.filter(
+                VoucherModel.userPhoneNumber == args['userPhoneNumber'])
+        )
+    if args['mindiscountAmount']:
+        query = (
+            query.filter(
+                VoucherModel.discountAmount >= args['mindiscountAmount'])
+        )
+    if args['maxidiscountAmount']:
+        query = (
+            query.filter(
+                VoucherModel.discountAmount <= args['maxidiscountAmount'])
+        )
+    if args['minvoucherWorth']:
+        query = (
+            query.filter(VoucherModel.voucherWorth >= args['minvoucherWorth'])
+        )
+    if args['maxivoucherWorth']:
+        query = (
+            query.filter(VoucherModel.voucherWorth <= args['maxivoucherWorth'])
+        )
+    if args['status'] is not None:
+        query = (
+            query.filter(VoucherModel.status == args['status'])
+            )
+
+    return query
 
 
 # Output formats
@@ -66,6 +277,7 @@ modelvoucher = {
     'dateUsed': fields.DateTime(),
 }
 voucherModel = api.model('Voucher', modelvoucher)
+voucher_serializer = Serializer(modelvoucher, VoucherModel.__table__)
 
 modeldiscount = {
     'id': fields.Integer(),
@@ -75,6 +287,26 @@ modeldiscount = {
     'updateTimeStamp': fields.DateTime(),
 }
 discountModel = api.model('Discount', modeldiscount)
+discount_serializer = Serializer(modeldiscount, DiscountModel.__table__)
+
+modelwalletoperation = {
+    'operationId': fields.String(attribute='idempotencyKey'),
+    'operation': fields.String(),
+    'voucherId': fields.Integer(),
+    'status': fields.String(),
+    'attempts': fields.Integer(),
+    'responseStatus': fields.Integer(),
+    'responseBody': fields.String(),
+    'dateCreated': fields.DateTime(),
+    'dateProcessed': fields.DateTime(),
+}
+walletOperationModel = api.model('WalletOperation', modelwalletoperation)
+
+modelvoucherpage = {
+    'vouchers': fields.List(fields.Nested(voucherModel)),
+    'nextCursor': fields.String(),
+}
+voucherPageModel = api.model('VoucherPage', modelvoucherpage)
 
 # Input formats
 authenticationParser = api.parser()
@@ -172,9 +404,10 @@ filterParser.add_argument(
 filterParser.add_argument(
     'status',
     type=int,
-    choices=(1, 2),
+    choices=(0, 1, 2, 3, 4),
     location='args',
-    help='Filter by status of the voucher, 1-> Not Used, 2-> Used'
+    help='Filter by status of the voucher, 0-> Pending Payment, '
+         '1-> Not Used, 2-> Used, 3-> Cancelled, 4-> Reserved'
 )
 filterParser.add_argument(
     'userPhoneNumber',
@@ -183,6 +416,64 @@ filterParser.add_argument(
     help='Filter by phone number of the user'
 )
 
+cursorFilterParser = filterParser.copy()
+cursorFilterParser.add_argument(
+    'cursor',
+    type=str,
+    location='args',
+    help='The nextCursor returned with the previous page'
+)
+cursorFilterParser.add_argument(
+    'afterId',
+    type=int,
+    location='args',
+    help='Return the vouchers with an id greater than this one'
+)
+cursorFilterParser.add_argument(
+    'limit',
+    type=int,
+    location='args',
+    default=DEFAULT_PAGE_SIZE,
+    help=f'The number of vouchers per page, {MAX_PAGE_SIZE} at most'
+)
+exportParser = filterParser.copy()
+exportParser.add_argument(
+    'format',
+    type=str,
+    choices=export.EXPORT_FORMATS,
+    default=export.NDJSON,
+    location='args',
+    help='Format of the export'
+)
+
+meParser = authenticationParser.copy()
+meParser.add_argument(
+    'status',
+    type=int,
+    choices=(0, 1, 2, 3, 4),
+    location='args',
+    help='Filter by status of the voucher'
+)
+meParser.add_argument(
+    'cursor',
+    type=str,
+    location='args',
+    help='The nextCursor returned with the previous page'
+)
+meParser.add_argument(
+    'afterId',
+    type=int,
+    location='args',
+    help='Return the vouchers with an id greater than this one'
+)
+meParser.add_argument(
+    'limit',
+    type=int,
+    location='args',
+    help=f'The number of vouchers per page, {MAX_PAGE_SIZE} at most. '
+         'Without limit nor cursor, all the vouchers are streamed'
+)
+
 
 dateQuery_parser = authenticationParser.copy()
 dateQuery_parser.add_argument(
@@ -197,6 +488,46 @@ dateQuery_parser.add_argument(
     required=True,
     help="The end date format '%d/%m/%Y'"
 )
+dateQuery_parser.add_argument(
+    'granularity',
+    type=str,
+    choices=GRANULARITIES,
+    default='day',
+    help='The size of each bucket: hour, day, week or month'
+)
+dateQuery_parser.add_argument(
+    'timezone',
+    type=str,
+    default='UTC',
+    help='The timezone of the dates, e.g. Africa/Lagos'
+)
+
+batchVoucherParser = authenticationParser.copy()
+batchVoucherParser.add_argument(
+    'driverPhoneNumber',
+    type=str,
+    required=True,
+    help='The Drivers Phone Number'
+)
+batchVoucherParser.add_argument(
+    'count',
+    type=int,
+    required=False,
+    help='The number of vouchers of voucherWorth to issue'
+)
+batchVoucherParser.add_argument(
+    'voucherWorth',
+    type=int,
+    required=False,
+    help='The worth of every voucher in the batch, used with count'
+)
+batchVoucherParser.add_argument(
+    'voucherWorths',
+    type=int,
+    action='append',
+    required=False,
+    help='The worth of each voucher, one voucher per value'
+)
 
 monthQuery_parser = authenticationParser.copy()
 monthQuery_parser.add_argument(
@@ -205,14 +536,29 @@ monthQuery_parser.add_argument(
     required=True,
     help='The year'
 )
+monthQuery_parser.add_argument(
+    'granularity',
+    type=str,
+    choices=GRANULARITIES,
+    default='month',
+    help='The size of each bucket: hour, day, week or month'
+)
+monthQuery_parser.add_argument(
+    'timezone',
+    type=str,
+    default='UTC',
+    help='The timezone of the year, e.g. Africa/Lagos'
+)
 
 
 @api.route('/vouchers/<int:pageNumber><int:noPerPage>')
 class VehicleList(Resource):
     @api.doc('list_vouchers')
-    @api.marshal_with(voucherModel, as_list=True)
+    @api.response(http.client.OK, 'Success', [voucherModel])
     @api.expect(filterParser)
-    def get(self, pageNumber:int, noPerPage:int):
+    @query_budget(1)
+    @read_only
+    def get(self, pageNumber: int, noPerPage: int):
         """
         Retrieve all vouchers
         """
@@ -220,56 +566,43 @@ class VehicleList(Resource):
         args = filterParser.parse_args()
         authentication_header_parser(args['Authorization'])
 
-        query = VoucherModel.query
+        query = filter_vouchers(voucher_query(), args)
 
-        # filtering
-        if args['id']:
-            query = (
-                query.filter(VoucherModel.id == args['id'])
-            )
-        if args['driverId']:
-            query = (
-                query.filter(VoucherModel.driverId == args['driverId'])
-            )
-        if args['driverPhoneNumber']:
-            query = (
-                query.filter(VoucherModel.driverPhoneNumber == args['driverPhoneNumber'])
-            )
-        if args['userPhoneNumber']:
-            query = (
-                query.filter(VoucherModel.userPhoneNumber == args['userPhoneNumber'])
-            )
-        if args['mindiscountAmount']:
-            query = (
-                query.filter(VoucherModel.discountAmount >= args['mindiscountAmount'])
-            )
-        if args['maxidiscountAmount']:
-            query = (
-                query.filter(VoucherModel.discountAmount <= args['maxidiscountAmount'])
-            )
-        if args['minvoucherWorth']:
-            query = (
-                query.filter(VoucherModel.voucherWorth >= args['minvoucherWorth'])
-            )
-        if args['maxivoucherWorth']:
-            query = (
-                query.filter(VoucherModel.voucherWorth <= args['maxivoucherWorth'])
-            )
-        if args['status']:
-            query = (
-                query.filter(VoucherModel.status == args['status'])
-                )
-
-        offset = (pageNumber - 1) * noPerPage 
+        offset = (pageNumber - 1) * noPerPage
         query = query.order_by('id')
-        vouchers = query.offset(offset).limit(noPerPage)
+        query = query.offset(offset).limit(noPerPage)
+        vouchers = db.session.execute(query.statement).fetchall()
+
+        return voucher_list_response(vouchers)
+
+
+@api.route('/vouchers/list/')
+class VoucherCursorList(Resource):
+    @api.doc('list_vouchers_by_cursor')
+    @api.response(http.client.OK, 'Success', voucherPageModel)
+    @api.expect(cursorFilterParser)
+    @query_budget(1)
+    @read_only
+    def get(self):
+        """
+        Retrieve vouchers page by page, following nextCursor
+        """
+        # authenticate bearer token
+        args = cursorFilterParser.parse_args()
+        authentication_header_parser(args['Authorization'])
+
+        query = filter_vouchers(voucher_query(), args)
+        return voucher_page_response(paginate_vouchers(query, args))
 
-        return list(vouchers), http.client.OK
 
 @api.route('/vouchers/')
 class VoucherPost(Resource):
     @api.doc('add_voucher')
     @api.expect(voucherParser)
+    # A worker's first voucher also loads the discount and leases a block
+    # of pins, a pending voucher adds its wallet operation
+    @query_budget(10)
+    @admission_control(PURCHASE)
     def post(self):
         """
         Add voucher.
@@ -279,52 +612,250 @@ class VoucherPost(Resource):
         args = voucherParser.parse_args()
         tokenPayload = authentication_header_parser(args['Authorization'])
         auth_id = tokenPayload['auth_id']
-        
-        pin = generate_pin()
-        
-        discount = DiscountModel.query.get(1).discountPercent
-        
+
+        discount = discount_cache.get()
+        if not discount:
+            response = {
+                "status": "error",
+                "message": "No Discount"
+            }
+            return response, http.client.NOT_FOUND
+        discount = discount['discountPercent']
+
+        pin = pin_allocator.allocate()
+
         if not args["amountBought"]:
-            amountBought = int( (1- discount) * args["voucherWorth"])
+            amountBought = int((1 - discount) * args["voucherWorth"])
         else:
             amountBought = args["amountBought"]
-            
-        headers = {
-            "Authorization": args["Authorization"]
-        }
-            
-        data = {
-            "amount": amountBought,
-            "phoneNo": args["driverPhoneNumber"],
-            "desc": "Voucher Purchase By Driver"
-        }
-        url = WALLET_SERVICE + "api/purchaseVoucher/"
-        print(url)
-        res = requests.post(headers=headers, data=data, url=url)
-        
-        if res.status_code != 201:
+
+        if outbox.WALLET_OUTBOX:
+            # Paid for by the wallet worker, pending until then
+            voucher = VoucherModel(
+                driverId=auth_id,
+                driverPhoneNumber=args['driverPhoneNumber'],
+                pin=pin,
+                amountBought=amountBought,
+                voucherWorth=args['voucherWorth'],
+                status=0,
+                dateGenerated=datetime.utcnow()
+            )
+            db.session.add(voucher)
+            rollups.record_issued(voucher.dateGenerated, [amountBought],
+                                  [args['voucherWorth']])
+            operation = outbox.add_operation(
+                outbox.PURCHASE_VOUCHER, voucher, auth_id,
+                amountBought, args["driverPhoneNumber"],
+                "Voucher Purchase By Driver")
+            db.session.commit()
+
+            result = api.marshal(voucher, voucherModel)
+            # Unknown until now, the pin may be negatively cached
+            voucher_cache.invalidate(pins=[pin], ids=[voucher.id])
+            result['operationId'] = operation.idempotencyKey
+            return result, http.client.ACCEPTED
+
+        # Sent again with the same key if the outcome of the call is unknown
+        idempotency_key = str(uuid4())
+        # Hold no connection while waiting on the wallet
+        db.session.close()
+        try:
+            res = wallet_client.purchase_voucher(
+                args["Authorization"], amountBought,
+                args["driverPhoneNumber"], idempotency_key=idempotency_key)
+            paid = paid_for(res)
+        except WalletUnavailable:
+            return wallet_unavailable_response()
+        except WalletOutcomeUnknown:
+            paid = None
+
+        if paid is False:
             return res.json(), res.status_code
-        
+
         voucher = VoucherModel(
             driverId=auth_id,
             driverPhoneNumber=args['driverPhoneNumber'],
             pin=pin,
             amountBought=amountBought,
             voucherWorth=args['voucherWorth'],
-            status=1
+            # Pending until the wallet worker knows if the driver paid
+            status=1 if paid else 0,
+            dateGenerated=datetime.utcnow()
         )
-   
+
         db.session.add(voucher)
+        rollups.record_issued(voucher.dateGenerated, [amountBought],
+                              [args['voucherWorth']])
+        if not paid:
+            operation = outbox.add_operation(
+                outbox.PURCHASE_VOUCHER, voucher, auth_id,
+                amountBought, args["driverPhoneNumber"],
+                "Voucher Purchase By Driver", idempotency_key)
         db.session.commit()
 
         result = api.marshal(voucher, voucherModel)
+        # Unknown until now, the pin may be negatively cached
+        voucher_cache.invalidate(pins=[pin], ids=[voucher.id])
+        if not paid:
+            result['operationId'] = operation.idempotencyKey
+            return result, http.client.ACCEPTED
+        return result, http.client.CREATED
+
+
+@api.route('/vouchers/batch/')
+class VoucherBatchPost(Resource):
+    @api.doc('add_voucher_batch')
+    @api.expect(batchVoucherParser)
+    @query_budget(10)
+    @admission_control(PURCHASE)
+    def post(self):
+        """
+        Add a batch of vouchers, paid with a single wallet debit.
+        """
+
+        # authenticate bearer token
+        args = batchVoucherParser.parse_args()
+        tokenPayload = authentication_header_parser(args['Authorization'])
+        auth_id = tokenPayload['auth_id']
+
+        if args['voucherWorths']:
+            worths = args['voucherWorths']
+            size = len(worths)
+        elif args['count'] is not None and args['voucherWorth'] is not None:
+            # Checked before the list is built
+            worths = None
+            size = args['count']
+        else:
+            response = {
+                "status": "error",
+                "message": "Provide count and voucherWorth, or voucherWorths"
+            }
+            return response, http.client.BAD_REQUEST
+
+        if not 0 < size <= MAX_BATCH_SIZE:
+            response = {
+                "status": "error",
+                "message": f"A batch holds 1 to {MAX_BATCH_SIZE} vouchers"
+            }
+            return response, http.client.BAD_REQUEST
+        if worths is None:
+            worths = [args['voucherWorth']] * size
+        if min(worths) <= 0:
+            response = {
+                "status": "error",
+                "message": "The vouchers must have a positive worth"
+            }
+            return response, http.client.BAD_REQUEST
+
+        discount = discount_cache.get()
+        if not discount:
+            response = {
+                "status": "error",
+                "message": "No Discount"
+            }
+            return response, http.client.NOT_FOUND
+        discount = discount['discountPercent']
+
+        pins = pin_allocator.allocate_many(len(worths))
+        amounts = [int((1 - discount) * worth) for worth in worths]
+
+        # Sent again with the same key if the outcome of the call is unknown
+        idempotency_key = str(uuid4())
+        description = "Batch Voucher Purchase By Driver"
+        # Hold no connection while waiting on the wallet
+        db.session.close()
+        try:
+            res = wallet_client.purchase_voucher(
+                args["Authorization"], sum(amounts),
+                args["driverPhoneNumber"], description,
+                idempotency_key=idempotency_key)
+            paid = paid_for(res)
+        except WalletUnavailable:
+            return wallet_unavailable_response()
+        except WalletOutcomeUnknown:
+            paid = None
+
+        if paid is False:
+            return res.json(), res.status_code
+
+        now = datetime.utcnow()
+        rows = [
+            {
+                'driverId': auth_id,
+                'driverPhoneNumber': args['driverPhoneNumber'],
+                'pin': pin,
+                'amountBought': amountBought,
+                'voucherWorth': worth,
+                # Pending until the wallet worker knows if the driver paid
+                'status': 1 if paid else 0,
+                'dateGenerated': now,
+            }
+            for pin, amountBought, worth in zip(pins, amounts, worths)
+        ]
+        # A single multi-row INSERT for the whole batch
+        db.session.execute(VoucherModel.__table__.insert().values(rows))
+        rollups.record_issued(now, amounts, worths)
+        if not paid:
+            pending = (
+                VoucherModel.query.filter(VoucherModel.pin.in_(pins))
+                .order_by(VoucherModel.id)
+                .all()
+            )
+            operation = outbox.add_operation(
+                outbox.PURCHASE_VOUCHER, pending[0], auth_id,
+                sum(amounts), args["driverPhoneNumber"], description,
+                idempotency_key,
+                voucher_ids=[voucher.id for voucher in pending])
+        db.session.commit()
+
+        vouchers = (
+            VoucherModel.query.filter(VoucherModel.pin.in_(pins))
+            .order_by(VoucherModel.id)
+            .all()
+        )
+        voucher_cache.invalidate(pins=pins,
+                                 ids=[voucher.id for voucher in vouchers])
+        result = api.marshal(vouchers, voucherModel)
+        if not paid:
+            for voucher in result:
+                voucher['operationId'] = operation.idempotencyKey
+            return result, http.client.ACCEPTED
         return result, http.client.CREATED
 
+
+@api.route('/vouchers/export/')
+class VoucherExport(Resource):
+    @api.doc('export_vouchers')
+    @api.expect(exportParser)
+    @query_budget(0)
+    def get(self):
+        """
+        Stream all the vouchers matching the filters, as NDJSON or CSV
+        (admin only)
+        """
+        args = exportParser.parse_args()
+        check_admin_return_payload(args)
+
+        query = filter_vouchers(export.export_query(), args)
+        export_format = args['format']
+        headers = {
+            'Content-Disposition':
+                f'attachment; filename=vouchers.{export_format}',
+        }
+        return Response(
+            stream_with_context(export.export_vouchers(query, export_format)),
+            mimetype=export.MIMETYPES[export_format],
+            headers=headers,
+        )
+
+
 @api.route('/vouchers/<int:voucherId>/')
 class VoucherGetById(Resource):
     @api.doc('retrieve voucher with id')
-    @api.marshal_with(voucherModel)
+    @api.response(http.client.OK, 'Success', voucherModel)
     @api.expect(authenticationParser)
+    @query_budget(1)
+    @read_only
     def get(self, voucherId: int):
         """
         Retrieve a specific voucher using pin
@@ -332,17 +863,23 @@ class VoucherGetById(Resource):
         args = authenticationParser.parse_args()
         authentication_header_parser(args['Authorization'])
 
-        voucher = VoucherModel.query.get(voucherId)
+        query = voucher_query().filter(VoucherModel.id == voucherId)
+        voucher = voucher_cache.get_by_id(
+            voucherId, lambda: db.session.execute(query.statement).first())
         if not voucher:
             # The voucher does not exist
             return '', http.client.NOT_FOUND
 
-        return voucher
+        return voucher_response(voucher)
+
 
 @api.route('/vouchers/buy/<string:voucherPin>/')
 class VoucherSell(Resource):
     @api.doc('update_voucher')
     @api.expect(updateVoucherParser)
+    # The top-up is recorded before it is sent and updated with its outcome
+    @query_budget(7)
+    @admission_control(REDEMPTION)
     def put(self, voucherPin: str):
         """
         Sell Voucher to Riders
@@ -351,75 +888,143 @@ class VoucherSell(Resource):
         # authenticate bearer token
 
         args = updateVoucherParser.parse_args()
-        
-        auth_id = authentication_header_parser(args['Authorization'])['auth_id']
 
-        # todo: ask if only creators can update voucher
+        auth_id = authentication_header_parser(
+            args['Authorization'])['auth_id']
 
-        voucher = VoucherModel.query.filter(VoucherModel.pin==voucherPin).first()
+        # todo: ask if only creators can update voucher
 
+        if outbox.WALLET_OUTBOX:
+            # The rider is topped up by the wallet worker
+            voucher = claim_voucher(voucherPin, args['userPhoneNumber'],
+                                    status=redemption.USED)
+            if not voucher:
+                return voucher_not_claimed_response(voucherPin)
+
+            operation = outbox.add_operation(
+                outbox.TOPUP_WALLET, voucher, auth_id,
+                voucher.voucherWorth, args['userPhoneNumber'],
+                "Voucher Purchase By Rider")
+            db.session.commit()
+
+            result = api.marshal(voucher, voucherModel)
+            result['operationId'] = operation.idempotencyKey
+            return result, http.client.ACCEPTED
+
+        # Reserve the voucher, only one concurrent request can win it. The
+        # top-up is recorded with it, a voucher left reserved by a crash is
+        # settled from its outcome
+        voucher = claim_voucher(voucherPin, args['userPhoneNumber'])
         if not voucher:
-            # The voucher does not exist
-            return {"status" :"error", "message": "Not Found"}, http.client.NOT_FOUND
-
-        
-        if voucher.status == 2:
-            return {"status" :"error", "message": "Voucher Sold"}, http.client.OK
+            return voucher_not_claimed_response(voucherPin)
+        operation = outbox.add_operation(
+            outbox.TOPUP_WALLET, voucher, auth_id,
+            voucher.voucherWorth, args['userPhoneNumber'],
+            "Voucher Purchase By Rider", status='in_flight')
+        idempotency_key = operation.idempotencyKey
+        db.session.commit()
 
-        # add voucher
-        
-        headers = {
-            "Authorization": args["Authorization"]
-        }
-            
-        data = {
-            "amount": voucher.voucherWorth,
-            "phoneNo": args['userPhoneNumber'],
-            "desc": "Voucher Purchase By Rider"
-        }
-        url = WALLET_SERVICE + "api/topupwallet/"
-        res = requests.post(headers=headers, data=data, url=url)
-        
-        if res.status_code != 201:
+        try:
+            res = wallet_client.topup_wallet(args["Authorization"],
+                                             voucher.voucherWorth,
+                                             args['userPhoneNumber'],
+                                             idempotency_key=idempotency_key)
+        except WalletUnavailable:
+            # Never reached the wallet, the voucher can be used again
+            release_voucher(voucher)
+            operation.status = 'failed'
+            operation.dateProcessed = datetime.utcnow()
+            db.session.commit()
+            return wallet_unavailable_response()
+        except WalletOutcomeUnknown:
+            res = None
+
+        succeeded = outbox.record_attempt(operation, res)
+        if succeeded is None:
+            # The rider may have been topped up, the voucher stays reserved
+            # until the wallet worker sends the top-up again
+            db.session.commit()
+            result = api.marshal(voucher, voucherModel)
+            result['status'] = redemption.RESERVED
+            result['operationId'] = idempotency_key
+            return result, http.client.ACCEPTED
+
+        if not succeeded:
+            release_voucher(voucher)
+            db.session.commit()
             return res.json(), res.status_code
-        
-       
-        voucher.status = 2
-        voucher.userPhoneNumber = args['userPhoneNumber'] or voucher.userPhoneNumber
-        voucher.dateUsed = datetime.now() or voucher.dateUsed
 
-        db.session.add(voucher)
+        confirm_voucher(voucher)
         db.session.commit()
 
         result = api.marshal(voucher, voucherModel)
+        result['status'] = redemption.USED
         return result, http.client.OK
 
 
+@api.route('/operations/<string:operationId>/')
+class WalletOperationGet(Resource):
+    @api.doc('retrieve wallet operation')
+    @api.marshal_with(walletOperationModel)
+    @api.expect(authenticationParser)
+    @query_budget(1)
+    def get(self, operationId: str):
+        """
+        Retrieve the status of a wallet operation
+        """
+        args = authenticationParser.parse_args()
+        authentication_header_parser(args['Authorization'])
+
+        operation = (
+            WalletOperationModel.query
+            .filter(WalletOperationModel.idempotencyKey == operationId)
+            .first()
+        )
+        if not operation:
+            # The operation does not exist
+            return '', http.client.NOT_FOUND
+
+        return operation
+
+
 @api.route('/me/')
 class VoucherGetByAuth(Resource):
     @api.doc('retrieve voucher with auth id')
-    @api.marshal_with(voucherModel)
-    @api.expect(authenticationParser)
+    @api.response(http.client.OK, 'Success', [voucherModel])
+    @api.expect(meParser)
+    @query_budget(1)
+    @read_only
     def get(self):
         """
-        Retrieve a specific voucher using auth id
+        Retrieve the vouchers of the authenticated driver, page by page
+        or streamed all at once
         """
-        args = authenticationParser.parse_args()
-        auth_id = authentication_header_parser(args['Authorization'])['auth_id']
+        args = meParser.parse_args()
+        auth_id = authentication_header_parser(
+            args['Authorization'])['auth_id']
 
-        vouchers = VoucherModel.query.filter(VoucherModel.driverId==auth_id).all()
-        if not vouchers:
+        query = voucher_query().filter(VoucherModel.driverId == auth_id)
+        if args['status'] is not None:
+            query = query.filter(VoucherModel.status == args['status'])
+
+        if (args['limit'] is not None or args['cursor']
+                or args['afterId'] is not None):
+            return voucher_page_response(paginate_vouchers(query, args))
+
+        if not query.first():
             # The voucher does not exist
             return '', http.client.NOT_FOUND
 
-        return list(vouchers)
+        return stream_vouchers(query)
 
 
 @api.route('/vouchers/pin/<string:voucherPin>/')
 class VoucherGetByPin(Resource):
     @api.doc('retrieve voucher with pin')
-    @api.marshal_with(voucherModel)
+    @api.response(http.client.OK, 'Success', voucherModel)
     @api.expect(authenticationParser)
+    @query_budget(1)
+    @read_only
     def get(self, voucherPin: str):
         """
         Retrieve a specific voucher using pin
@@ -427,19 +1032,22 @@ class VoucherGetByPin(Resource):
         args = authenticationParser.parse_args()
         authentication_header_parser(args['Authorization'])
 
-        voucher = VoucherModel.query.filter(VoucherModel.pin==voucherPin).first()
+        query = voucher_query().filter(VoucherModel.pin == voucherPin)
+        voucher = voucher_cache.get_by_pin(
+            voucherPin, lambda: db.session.execute(query.statement).first())
         if not voucher:
             # The voucher does not exist
             return '', http.client.NOT_FOUND
 
-        return voucher
+        return voucher_response(voucher)
 
 
 @api.route('/discount/')
 class DiscountGet(Resource):
     @api.doc('retrieve discount')
-    #@api.marshal_with(discountModel)
+    # @api.marshal_with(discountModel)
     @api.expect(authenticationParser)
+    @query_budget(1)
     def get(self):
         """
         Retrieve the discount
@@ -447,28 +1055,30 @@ class DiscountGet(Resource):
         args = authenticationParser.parse_args()
         authentication_header_parser(args['Authorization'])
 
-        discount = DiscountModel.query.get(1)
+        discount = discount_cache.get()
         if not discount:
             response = {
-                "status":"error",
-                "message":"No Discount"
+                "status": "error",
+                "message": "No Discount"
             }
             # The discount does not exist
             return response, http.client.NOT_FOUND
 
-        result = api.marshal(discount, discountModel)
-        return result, http.client.OK
+        discount = discount_serializer.values(discount)
+        return json_response(lambda: discount_serializer.encode(discount),
+                             lambda: discount_serializer.marshal(discount))
 
     @api.doc('update discount')
     @api.expect(updateDiscountParser)
     @api.marshal_with(discountModel, code=http.client.OK)
+    @query_budget(3)
     def put(self):
         """
         Update discount.
         """
         # authenticate bearer token
         args = updateDiscountParser.parse_args()
-        payload = authentication_header_parser(args['Authorization'])    
+        payload = authentication_header_parser(args['Authorization'])
         auth_id = payload['auth_id']
 
         # todo: ask if only creators can update voucher
@@ -479,35 +1089,37 @@ class DiscountGet(Resource):
             # The discount does not exist
             return '', http.client.NOT_FOUND
 
-   
         # to check if discount percent has changed
 
         oldDiscountPercent = discount.discountPercent
 
         if oldDiscountPercent == args['discountPercent']:
             response = {
-                "status":"error",
-                "message":"new discount is the same with previous"
+                "status": "error",
+                "message": "new discount is the same with previous"
             }
             return response, http.client.BAD_REQUEST
 
         # update discount
-       
+
         discount.authId = auth_id
         discount.discountPercent = args['discountPercent']
+        discount.version = DiscountModel.version + 1
 
         db.session.add(discount)
         db.session.commit()
+        discount_cache.invalidate(discount.version)
 
         result = api.marshal(discount, discountModel)
         return result, http.client.OK
 
-    
 
 @api.route('/stat/sumquery/')
 class VoucherSummaryQuery(Resource):
     @api.doc('query count in db: total count')
     @api.expect(authenticationParser)
+    @query_budget(1)
+    @read_only
     def get(self):
         """
         Help find total count of vouchers in the database
@@ -515,14 +1127,32 @@ class VoucherSummaryQuery(Resource):
         args = authenticationParser.parse_args()
         authentication_header_parser(args['Authorization'])
 
-        count = (VoucherModel.query.count())
-        return count
+        return stats_cache.get(make_key('sum'), STATS_TOTAL_TTL,
+                               total_vouchers)
+
+
+@api.route('/stat/pinquery/')
+class VoucherPinQuery(Resource):
+    @api.doc('query pin keyspace usage')
+    @api.expect(authenticationParser)
+    @query_budget(1)
+    @read_only
+    def get(self):
+        """
+        Help find how much of the pin keyspace has been used
+        """
+        args = authenticationParser.parse_args()
+        authentication_header_parser(args['Authorization'])
+
+        return keyspace_usage()
 
 
 @api.route('/stat/datequery/')
 class VoucherDateQuery(Resource):
     @api.doc('query count in db: daily')
     @api.expect(dateQuery_parser)
+    @query_budget(1)
+    @read_only
     def get(self):
         """
         Help find the daily count of vouchers created within a range of dates
@@ -533,33 +1163,38 @@ class VoucherDateQuery(Resource):
         start_date_str = args['startdate']
         end_date_str = args['enddate']
 
-        start_date = datetime.strptime(start_date_str, "%d/%m/%Y").date()
-        end_date = datetime.strptime(end_date_str, "%d/%m/%Y").date()
-
-        result = {}
+        try:
+            start_date = datetime.strptime(start_date_str, "%d/%m/%Y")
+            end_date = datetime.strptime(end_date_str, "%d/%m/%Y")
+        except ValueError:
+            return '', http.client.BAD_REQUEST
 
-        if start_date > end_date:
+        timezone = get_timezone(args['timezone'])
+        if start_date > end_date or timezone is None:
             return '', http.client.BAD_REQUEST
 
-        while start_date <= end_date:
-            vouchers = (
-                db.session.query(
-                    func.count(VoucherModel.id)).filter(
-                        func.date(VoucherModel.timestamp) == start_date
-                    ).all()
-            )
-            date = start_date.strftime("%d/%m/%Y")
-            result[date] = vouchers[0][0]
+        granularity = args['granularity']
+        end = end_date + timedelta(days=1)
 
-            start_date = start_date + timedelta(days=1)
+        def compute():
+            counts = count_vouchers(start_date, end, granularity, timezone)
+            label = BUCKET_LABELS[granularity]
+            return {
+                date.strftime(label): count
+                for date, count in counts.items()
+            }
 
-        return result
+        key = make_key('date', start_date, end, granularity, timezone.zone)
+        return stats_cache.get(key, stats_ttl(granularity, end, timezone),
+                               compute)
 
 
 @api.route('/stat/monthquery/')
 class VoucherModelMonthQuery(Resource):
     @api.doc('query count in db: monthly')
     @api.expect(monthQuery_parser)
+    @query_budget(1)
+    @read_only
     def get(self):
         """
         Help find the daily count of vouchers created within a range of month
@@ -573,19 +1208,26 @@ class VoucherModelMonthQuery(Resource):
         except ValueError:
             return '', http.client.BAD_REQUEST
 
-        result = {}
-
-        if year < 2020:
+        timezone = get_timezone(args['timezone'])
+        if year < 2020 or timezone is None:
             return '', http.client.BAD_REQUEST
 
-        for month in range(1, 13):
-            vouchers = (
-                db.session.query(func.count(VoucherModel.id)).filter(
-                    func.extract('year', VoucherModel.timestamp) == year).filter(
-                        func.extract('month', VoucherModel.timestamp) == month
-                    ).all()
-            )
-
-            result[f'{month}'] = vouchers[0][0]
+        granularity = args['granularity']
+        start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+
+        def compute():
+            counts = count_vouchers(start, end, granularity, timezone)
+            if granularity == 'month':
+                return {
+                    f'{date.month}': count
+                    for date, count in counts.items()
+                }
+            label = BUCKET_LABELS[granularity]
+            return {
+                date.strftime(label): count
+                for date, count in counts.items()
+            }
 
-        return result
+        key = make_key('month', start, end, granularity, timezone.zone)
+        return stats_cache.get(key, stats_ttl(granularity, end, timezone),
+                               compute)
@@ -1,12 +1,46 @@
 import os
+
+import click
 from flask import Flask
 from flask_restplus import Api
-from flask_migrate import Migrate, MigrateCommand
 from flask_cors import CORS
 
 PKG_NAME = os.path.dirname(os.path.realpath(__file__)).split("/")[-1]
 
-migrate = Migrate()
+
+class LazyMigrate:
+    """
+    Stands for the Flask-Migrate extension until a `db` command uses it:
+    alembic takes longer to import than the rest of the app, and the
+    workers never use it
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def __getattr__(self, name):
+        from flask_migrate import Migrate
+
+        # Replaces this stand-in in the extensions of the app
+        Migrate(self.application, self.application.db)
+        return getattr(self.application.extensions['migrate'], name)
+
+
+class MigrateCommands(click.MultiCommand):
+    """
+    The `db` commands of Flask-Migrate, imported when they run. The `flask`
+    command finds them through the plugin of Flask-Migrate
+    """
+
+    def _group(self, ctx):
+        from flask_migrate.cli import db as migrate_group
+        return migrate_group
+
+    def list_commands(self, ctx):
+        return self._group(ctx).list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._group(ctx).get_command(ctx, name)
 
 
 def create_app(app_name=PKG_NAME, **kwargs):
@@ -20,6 +54,7 @@ def create_app(app_name=PKG_NAME, **kwargs):
         title='Voucher Service',
         description='Voucher Service API'
     )
+    application.api = api
 
     from voucher_backend.db import db, db_config
     application.config['RESTPLUS_MASK_SWAGGER'] = False
@@ -27,8 +62,25 @@ def create_app(app_name=PKG_NAME, **kwargs):
     db.init_app(application)
     application.db = db
 
-    migrate.init_app(application, db=db)
-    application.cli.add_command(MigrateCommand, name="db")
+    from voucher_backend import instrumentation, replica
+    instrumentation.init_app(application, db)
+    replica.init_app(application)
+
+    application.extensions['migrate'] = LazyMigrate(application)
+    application.cli.add_command(
+        MigrateCommands('db', help='Perform database migrations.'))
+
+    from voucher_backend.export import export_vouchers_command
+    application.cli.add_command(export_vouchers_command)
+
+    from voucher_backend.query_plans import query_plans_command
+    application.cli.add_command(query_plans_command)
+
+    from voucher_backend.rollups import rebuild_rollups_command
+    application.cli.add_command(rebuild_rollups_command)
+
+    from voucher_backend.startup import swagger_command
+    application.cli.add_command(swagger_command)
 
     api.add_namespace(apiNamespace)
 
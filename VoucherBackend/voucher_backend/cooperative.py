@@ -0,0 +1,51 @@
+"""
+Cooperative worker mode.
+
+With WORKER_MODE=gevent, every uwsgi process serves GEVENT_CORES requests
+at once as greenlets (see docker/app/start_server.sh). A request waiting on
+the wallet then only holds its greenlet, so hundreds of purchases and
+redemptions in flight share a few processes.
+
+patch() runs first in wsgi.py, before anything else is imported: it makes
+the sockets, locks and queues of the standard library cooperative, and
+psycopg2 through psycogreen. The QueuePool of SQLAlchemy waits on those
+locks, so the greenlets queue for the connections of the pool instead of
+blocking their process. The requests hold no connection while they wait on
+the wallet, so the pool stays small (DB_GREEN_POOL_SIZE, see pool.py).
+"""
+import os
+
+SYNC = 'sync'
+GEVENT = 'gevent'
+WORKER_MODE = os.environ.get('WORKER_MODE', SYNC)
+# Requests served at once by each process in the gevent mode
+GEVENT_CORES = int(os.environ.get('GEVENT_CORES', 100))
+
+
+def is_cooperative():
+    return WORKER_MODE == GEVENT
+
+
+def patch():
+    """
+    Make the blocking calls cooperative in the gevent mode. Returns whether
+    they were patched
+    """
+    if not is_cooperative():
+        return False
+
+    from gevent import monkey
+    from psycogreen.gevent import patch_psycopg
+
+    monkey.patch_all()
+    patch_psycopg()
+    return True
+
+
+def reinit():
+    """
+    Reset the gevent hub in a worker forked by the uwsgi master
+    """
+    if is_cooperative():
+        import gevent
+        gevent.reinit()
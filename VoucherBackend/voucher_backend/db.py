@@ -1,32 +1,9 @@
 import os
 from pathlib import Path
-from flask_sqlalchemy import SQLAlchemy
-
-from dotenv import load_dotenv
-
-work_path = Path.cwd()
-
-print(work_path)
-
-env_path = work_path / 'environment.env'
-
-load_dotenv(env_path)
-
-db_params = {
-        'host': os.environ['POSTGRES_HOST'],
-        'database': os.environ['POSTGRES_DB'],
-        'user': os.environ['POSTGRES_USER'],
-        'pwd': os.environ['POSTGRES_PASSWORD'],
-        'port': os.environ['POSTGRES_PORT'],
-    }
-print(db_params)
-DB_URI = 'postgresql://{user}:{pwd}@{host}:{port}/{database}'
-db_config = {
-    'SQLALCHEMY_DATABASE_URI': DB_URI.format(**db_params),
-    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
-}
-print(db_config)
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
 
+from voucher_backend import pool, replica
 
 DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'SQLITE')
 
@@ -34,8 +11,9 @@ if DATABASE_ENGINE == 'SQLITE':
     dir_path = Path(os.path.dirname(os.path.realpath(__file__)))
     path = dir_path / '..'
 
-    # Database initialisation
-    FILE_PATH = f'{path}/db.sqlite3'
+    # Database initialisation, next to the package unless SQLITE_PATH says
+    # otherwise
+    FILE_PATH = os.environ.get('SQLITE_PATH', f'{path}/db.sqlite3')
     DB_URI = 'sqlite+pysqlite:///{file_path}'
     db_config = {
         'SQLALCHEMY_DATABASE_URI': DB_URI.format(file_path=FILE_PATH),
@@ -59,4 +37,39 @@ elif DATABASE_ENGINE == 'POSTGRESQL':
 else:
     raise Exception('Incorrect DATABASE_ENGINE')
 
-db = SQLAlchemy()
+# Read replica of the database, for the read-only requests, see replica.py
+DATABASE_REPLICA_URI = os.environ.get('DATABASE_REPLICA_URI')
+if DATABASE_REPLICA_URI:
+    db_config['SQLALCHEMY_BINDS'] = {replica.REPLICA_BIND:
+                                     DATABASE_REPLICA_URI}
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends the statements of the read-only requests to the replica
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing:
+            engine = replica.replica_router.read_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class ManagedSQLAlchemy(SQLAlchemy):
+    """
+    Postgres engines get the managed pool, see pool.py, and reads may go
+    to the replica
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        if info.drivername.startswith('postgresql'):
+            options.update(pool.engine_options())
+
+
+db = ManagedSQLAlchemy()
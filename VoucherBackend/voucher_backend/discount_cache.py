@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+import time
+
+from voucher_backend.models import DiscountModel
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.environ.get('REDIS_URL')
+# Seconds a worker trusts its cached discount before revalidating it
+DISCOUNT_CHECK_INTERVAL = float(os.environ.get('DISCOUNT_CHECK_INTERVAL', 5))
+# Seconds after which the discount is re-read whatever its version says
+DISCOUNT_MAX_AGE = float(os.environ.get('DISCOUNT_MAX_AGE', 300))
+DISCOUNT_VERSION_KEY = 'voucher:discount:version'
+
+DISCOUNT_FIELDS = ('id', 'discountPercent', 'timestamp', 'updateTimeStamp',
+                   'version')
+
+
+class RedisVersionStore:
+    """
+    Share the current discount version between workers and nodes
+    """
+
+    def __init__(self, url, key=DISCOUNT_VERSION_KEY):
+        # Only imported when configured, it slows the start of the workers
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.key = key
+        self.errors = redis.RedisError
+
+    def get_version(self):
+        version = self.client.get(self.key)
+        return int(version) if version is not None else None
+
+    def set_version(self, version):
+        self.client.set(self.key, version)
+
+
+class LocalVersionStore:
+    """
+    In-process stand-in for RedisVersionStore, for tests and development
+    """
+    errors = ()
+
+    def __init__(self):
+        self.version = None
+
+    def get_version(self):
+        return self.version
+
+    def set_version(self, version):
+        self.version = version
+
+
+class DiscountCache:
+    """
+    Per-worker copy of the discount row.
+
+    The copy is trusted for `check_interval` seconds. After that, it is
+    revalidated against the version in the shared store, which costs no
+    database query, and only re-read from the database when the version
+    changed. Without a store, the row is simply re-read every interval.
+    """
+
+    def __init__(self, store=None, check_interval=DISCOUNT_CHECK_INTERVAL,
+                 max_age=DISCOUNT_MAX_AGE):
+        self.store = store
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self._discount = None
+        self._checked_at = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the discount as a dict of its fields, or None if there is no
+        discount
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._is_fresh(now):
+                return self._discount
+
+            self._discount = self._load()
+            self._checked_at = self._loaded_at = now
+            return self._discount
+
+    def _is_fresh(self, now):
+        # A missing discount is not cached, it is created by hand
+        if self._discount is None:
+            return False
+        if now - self._checked_at < self.check_interval:
+            return True
+        if self.store is None:
+            return False
+        # Covers a version that could not be published
+        if now - self._loaded_at >= self.max_age:
+            return False
+
+        try:
+            version = self.store.get_version()
+        except self.store.errors:
+            logger.warning('Cannot read the discount version, reloading')
+            return False
+        if version == self._discount['version']:
+            self._checked_at = now
+            return True
+        return False
+
+    def _load(self):
+        discount = DiscountModel.query.get(1)
+        if discount is None:
+            return None
+        return {field: getattr(discount, field) for field in DISCOUNT_FIELDS}
+
+    def invalidate(self, version):
+        """
+        Publish a new discount version, after the row has been updated
+        """
+        with self._lock:
+            self._discount = None
+            self._checked_at = self._loaded_at = None
+        if self.store is not None:
+            try:
+                self.store.set_version(version)
+            except self.store.errors:
+                logger.error('Cannot publish the discount version, other '
+                             'workers will reload it on their next check')
+
+
+discount_cache = DiscountCache(RedisVersionStore(REDIS_URL)
+                               if REDIS_URL else None)
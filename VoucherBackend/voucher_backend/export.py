@@ -0,0 +1,202 @@
+"""
+Bulk export of the vouchers, for the daily reconciliation files.
+
+The rows are streamed: with a server side cursor, or with COPY TO on
+Postgres for CSV, so an export of millions of vouchers runs in constant
+memory.
+"""
+import csv
+import io
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+
+from voucher_backend import cooperative
+from voucher_backend.db import db
+from voucher_backend.models import VoucherModel
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+# Chunks of COPY output buffered between the database and the client
+EXPORT_QUEUE_SIZE = int(os.environ.get('EXPORT_QUEUE_SIZE', 64))
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+EXPORT_FORMATS = (NDJSON, CSV)
+MIMETYPES = {
+    NDJSON: 'application/x-ndjson',
+    CSV: 'text/csv',
+}
+
+COLUMNS = tuple(VoucherModel.__table__.columns)
+COLUMN_NAMES = tuple(column.name for column in COLUMNS)
+
+_DONE = object()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def export_query():
+    """
+    Query of the exported columns, to be filtered like the voucher list
+    """
+    return db.session.query(*COLUMNS).order_by(VoucherModel.id)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{value!r} is not JSON serializable')
+
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(COLUMN_NAMES, row)),
+                         default=_json_default) + '\n'
+
+
+def _csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(COLUMN_NAMES)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def stream_rows(query, export_format, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Stream the rows of the query from a server side cursor, in chunks of
+    `batch_size` encoded lines
+    """
+    lines = {
+        NDJSON: _ndjson_lines,
+        CSV: _csv_lines,
+    }[export_format](query.yield_per(batch_size))
+
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= batch_size:
+            yield ''.join(chunk).encode('utf8')
+            chunk = []
+    if chunk:
+        yield ''.join(chunk).encode('utf8')
+
+
+class _QueueWriter:
+    """
+    File object handed to COPY TO, passing its output to the consumer
+    """
+
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+
+    def write(self, data):
+        while True:
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self.chunks.put(data, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+
+def copy_csv(query):
+    """
+    Stream the rows of the query as CSV with Postgres COPY TO. The copy runs
+    on its own connection in a thread, which waits while the consumer is
+    behind
+    """
+    engine = db.engine
+    compiled = query.statement.compile(dialect=engine.dialect)
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+    cancelled = threading.Event()
+    writer = _QueueWriter(chunks, cancelled)
+
+    def copy():
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            # The copy of a large export outlasts the statement timeout
+            cursor.execute('SET LOCAL statement_timeout = 0')
+            select = cursor.mogrify(str(compiled), compiled.params)
+            cursor.copy_expert(
+                b'COPY (' + select + b') TO STDOUT WITH CSV HEADER', writer)
+            writer.write(_DONE)
+        except ExportCancelled:
+            pass
+        except Exception as error:
+            logger.exception('Voucher export failed')
+            try:
+                writer.write(error)
+            except ExportCancelled:
+                pass
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _DONE:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # Also stops the copy when the client goes away
+        cancelled.set()
+        thread.join()
+
+
+def export_vouchers(query, export_format):
+    """
+    Stream the rows of an export_query as chunks of bytes
+    """
+    # psycopg2 cannot COPY with the wait callback of the gevent mode
+    if export_format == CSV and db.engine.dialect.name == 'postgresql' \
+            and not cooperative.is_cooperative():
+        return copy_csv(query)
+    return stream_rows(query, export_format)
+
+
+@click.command('export-vouchers')
+@click.option('--format', 'export_format', type=click.Choice(EXPORT_FORMATS),
+              default=NDJSON)
+@click.option('--output', type=click.Path(dir_okay=False, writable=True),
+              default='-', help='File to write, standard output by default')
+@click.option('--id', 'id')
+@click.option('--driver-id', 'driverId')
+@click.option('--driver-phone-number', 'driverPhoneNumber')
+@click.option('--user-phone-number', 'userPhoneNumber')
+@click.option('--min-discount-amount', 'mindiscountAmount', type=int)
+@click.option('--max-discount-amount', 'maxidiscountAmount', type=int)
+@click.option('--min-voucher-worth', 'minvoucherWorth', type=int)
+@click.option('--max-voucher-worth', 'maxivoucherWorth', type=int)
+@click.option('--status', type=click.IntRange(0, 4))
+@with_appcontext
+def export_vouchers_command(export_format, output, **filters):
+    """
+    Export the vouchers matching the filters of the voucher list
+    """
+    from voucher_backend.api_namespace.api import filter_vouchers
+
+    query = filter_vouchers(export_query(), filters)
+    with click.open_file(output, 'wb') as stream:
+        for chunk in export_vouchers(query, export_format):
+            stream.write(chunk)
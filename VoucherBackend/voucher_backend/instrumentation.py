@@ -0,0 +1,109 @@
+"""
+Request instrumentation: latency per route, and the number and time of the
+SQL statements each request runs. See metrics.py for /metrics, and
+query_profiler.py for the slow statements and query budgets.
+"""
+import time
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+
+from voucher_backend import query_profiler
+from voucher_backend.metrics import CONTENT_TYPE_LATEST, Histogram, render
+
+# Counts, not seconds
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+request_latency = Histogram(
+    'http_request_duration_seconds',
+    'Time to answer a request, per route',
+    labelnames=('method', 'route', 'status'),
+)
+request_sql_statements = Histogram(
+    'http_request_sql_statements',
+    'SQL statements run by a request, per route',
+    labelnames=('method', 'route'),
+    buckets=STATEMENT_BUCKETS,
+)
+request_sql_duration = Histogram(
+    'http_request_sql_duration_seconds',
+    'Time spent in SQL statements by a request, per route',
+    labelnames=('method', 'route'),
+)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    query_profiler.record_statement(conn, statement, parameters, executemany,
+                                    elapsed)
+    # Statements of the Celery worker or the CLI commands are not counted
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+        g.sql_duration += elapsed
+
+
+def _handle_error(exception_context):
+    # The statement failed, after_cursor_execute is not called. Its start
+    # must not stay on the connection for the next statements to pop
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_duration = 0.0
+    query_profiler.start_request()
+
+
+def _record_request(response):
+    if 'request_start' not in g:
+        return response
+
+    # The rule, not the path, to keep the pins out of the labels
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    response = query_profiler.check_request(route, response)
+    # The resources may answer with an http.client.HTTPStatus
+    status = int(response.status_code)
+    request_latency.labels(request.method, route, status).observe(
+        time.perf_counter() - g.request_start)
+    request_sql_statements.labels(request.method, route).observe(
+        g.sql_statements)
+    request_sql_duration.labels(request.method, route).observe(
+        g.sql_duration)
+    return response
+
+
+def metrics_view():
+    return Response(render(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def instrument_engine(engine):
+    """
+    Count the statements of an engine in the metrics and query budgets
+    """
+    if not event.contains(engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+
+
+def init_app(application, db):
+    """
+    Instrument the requests of the app and the statements of its engine,
+    and serve /metrics
+    """
+    instrument_engine(db.get_engine(application))
+
+    query_profiler.init_app(application)
+    application.before_request(_start_request)
+    application.after_request(_record_request)
+    application.add_url_rule('/metrics', 'metrics', metrics_view)
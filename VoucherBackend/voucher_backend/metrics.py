@@ -0,0 +1,53 @@
+"""
+Prometheus metrics of the service, exposed on /metrics.
+
+Every uwsgi worker has its own values. Point PROMETHEUS_MULTIPROC_DIR to an
+empty directory before the workers start (see docker/app/start_server.sh):
+the workers then keep their values in files there, and /metrics adds up the
+values of all the workers. Counters and histograms keep the values of the
+dead workers, the `livesum` gauges only count the live ones.
+"""
+import glob
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+__all__ = ['CONTENT_TYPE_LATEST', 'Counter', 'Gauge', 'Histogram', 'render']
+
+MULTIPROCESS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_dead_workers(path=MULTIPROCESS_DIR):
+    """
+    Drop the live gauges of the workers that exited, uwsgi has no hook
+    for it
+    """
+    for file in glob.glob(os.path.join(path, 'gauge_live*.db')):
+        pid = int(file.rsplit('_', 1)[1][:-len('.db')])
+        if not _is_alive(pid):
+            multiprocess.mark_process_dead(pid, path)
+
+
+def render():
+    """
+    The metrics in the Prometheus text format
+    """
+    if MULTIPROCESS_DIR:
+        remove_dead_workers()
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, MULTIPROCESS_DIR)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
@@ -6,25 +6,137 @@ from voucher_backend.db import db
 
 
 class VoucherModel(db.Model):
+    # On Postgres the table is partitioned by month of dateGenerated, see
+    # partitions.py: its primary key also holds dateGenerated, and the index
+    # of pin is not unique. A trigger registers the pins in voucher_pin,
+    # whose primary key keeps them unique across the partitions
     id = db.Column(db.Integer, primary_key=True)
     driverId = db.Column(db.String(250), nullable=False)
     driverPhoneNumber = db.Column(db.String(250), nullable=False)
-    pin = db.Column(db.String(250), nullable=False)
+    pin = db.Column(db.String(250), nullable=False, unique=True, index=True)
     amountBought = db.Column(db.Integer(), nullable=False)
     voucherWorth = db.Column(db.Integer(), nullable=False)
     discountAmount = db.Column(db.Integer(), nullable=True) 
     userPhoneNumber = db.Column(db.String(250), nullable=True)
-    # not used = 1, used = 2
+    # pending payment = 0, not used = 1, used = 2, cancelled = 3,
+    # reserved for redemption = 4
     status = db.Column(db.Integer, nullable=True)
-    dateGenerated = db.Column(db.DateTime, server_default=func.now())
+    dateGenerated = db.Column(db.DateTime, nullable=False,
+                              server_default=func.now())
     timeUsed = db.Column(db.DateTime, nullable=True)
 
+    # Match the filters of the hot queries, see query_plans.hot_queries
+    __table_args__ = (
+        db.Index('ix_voucher_model_driverId_id', 'driverId', 'id'),
+        db.Index('ix_voucher_model_driverPhoneNumber_id',
+                 'driverPhoneNumber', 'id'),
+        db.Index('ix_voucher_model_userPhoneNumber_id',
+                 'userPhoneNumber', 'id'),
+        db.Index('ix_voucher_model_dateGenerated', 'dateGenerated'),
+        # Unused vouchers are the few rows the hot paths care about
+        db.Index('ix_voucher_model_unused_id', 'id',
+                 postgresql_where=status == 1, sqlite_where=status == 1),
+    )
+
+
+class VoucherArchiveModel(db.Model):
+    """
+    Cold archive of the vouchers redeemed long ago, moved out of
+    voucher_model by partitions.archive_vouchers
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    driverId = db.Column(db.String(250), nullable=False)
+    driverPhoneNumber = db.Column(db.String(250), nullable=False)
+    # not unique, the pin of a legacy voucher may be issued again once it is
+    # archived
+    pin = db.Column(db.String(250), nullable=False, index=True)
+    amountBought = db.Column(db.Integer(), nullable=False)
+    voucherWorth = db.Column(db.Integer(), nullable=False)
+    discountAmount = db.Column(db.Integer(), nullable=True)
+    userPhoneNumber = db.Column(db.String(250), nullable=True)
+    status = db.Column(db.Integer, nullable=True)
+    dateGenerated = db.Column(db.DateTime, nullable=False)
+    timeUsed = db.Column(db.DateTime, nullable=True)
+    dateArchived = db.Column(db.DateTime, server_default=func.now())
+
+    __table_args__ = (
+        db.Index('ix_voucher_archive_model_driverId_id', 'driverId', 'id'),
+        db.Index('ix_voucher_archive_model_dateGenerated', 'dateGenerated'),
+    )
+
+
+class VoucherRollupModel(db.Model):
+    """
+    Vouchers issued and redeemed per UTC hour, kept up to date with the
+    vouchers by rollups.py. Each hour is spread over a few shards, so that
+    concurrent issuances do not wait on the same row
+    """
+    hour = db.Column(db.DateTime, primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # by hour of dateGenerated
+    issued = db.Column(db.Integer, nullable=False, default=0)
+    amountBought = db.Column(db.BigInteger, nullable=False, default=0)
+    voucherWorth = db.Column(db.BigInteger, nullable=False, default=0)
+    # by hour of timeUsed
+    redeemed = db.Column(db.Integer, nullable=False, default=0)
+
 
 class DiscountModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     discountPercent = db.Column(db.Float(), nullable=True) 
     timestamp = db.Column(db.DateTime, server_default=func.now())        
     updateTimeStamp = db.Column(db.DateTime, onupdate=func.now())
+    # bumped on every update, to invalidate the cached discounts
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+
+
+class WalletOperationModel(db.Model):
+    """
+    Outbox of the wallet calls, written in the same transaction as the
+    voucher they pay for and sent by the wallet worker
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    idempotencyKey = db.Column(db.String(36), nullable=False, unique=True)
+    # purchase_voucher or topup_wallet
+    operation = db.Column(db.String(50), nullable=False)
+    voucherId = db.Column(db.Integer, nullable=False, index=True)
+    # JSON list of the ids of all the vouchers a batch purchase pays for,
+    # voucherId being the first
+    voucherIds = db.Column(db.Text, nullable=True)
+    # auth_id of the driver the operation is sent on behalf of
+    authId = db.Column(db.String(250), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    phoneNumber = db.Column(db.String(250), nullable=True)
+    description = db.Column(db.String(250), nullable=False)
+    # in_flight while the API sends it, pending, succeeded, failed, or
+    # parked when the wallet kept failing
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # not sent again before, after a failed attempt
+    nextAttempt = db.Column(db.DateTime, nullable=True)
+    responseStatus = db.Column(db.Integer, nullable=True)
+    responseBody = db.Column(db.Text, nullable=True)
+    dateCreated = db.Column(db.DateTime, server_default=func.now())
+    dateProcessed = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # The worker only looks for pending operations
+        db.Index('ix_wallet_operation_model_pending_id', 'id',
+                 postgresql_where=status == 'pending',
+                 sqlite_where=status == 'pending'),
+        # and for the ones the API did not finish sending
+        db.Index('ix_wallet_operation_model_in_flight_dateCreated',
+                 'dateCreated',
+                 postgresql_where=status == 'in_flight',
+                 sqlite_where=status == 'in_flight'),
+    )
+
+
+class PinAllocatorModel(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # next position of the pin permutation that has not been leased
+    nextIndex = db.Column(db.BigInteger, nullable=False, default=0)
 
 
 def register_discount():
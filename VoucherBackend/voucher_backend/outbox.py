@@ -0,0 +1,278 @@
+"""
+Transactional outbox of the wallet calls.
+
+In outbox mode (WALLET_OUTBOX=1) the API writes the voucher change and a
+pending WalletOperationModel in one transaction and answers at once. The
+wallet worker (see tasks.py) claims the pending operations in batches,
+sends them with their idempotency key outside of any transaction, and
+applies or compensates the voucher change depending on the wallet answer,
+each in a short transaction of its own.
+
+The worker calls the wallet with WALLET_SERVICE_AUTHORIZATION on behalf
+of the driver, the tokens of the drivers are not stored. An operation the
+wallet did not answer, or answered with a 5xx, is sent again after
+OUTBOX_BACKOFF seconds, doubled at every attempt up to OUTBOX_MAX_BACKOFF.
+After OUTBOX_MAX_ATTEMPTS attempts the wallet may still have applied it:
+it is parked, its vouchers left as they are, until reconciled by hand.
+"""
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import or_
+
+from voucher_backend.db import db
+from voucher_backend.models import VoucherModel, WalletOperationModel
+from voucher_backend.redemption import NOT_USED, RESERVED, USED
+from voucher_backend.rollups import (CANCELLED, record_cancelled,
+                                     record_redeemed)
+from voucher_backend.voucher_cache import voucher_cache
+from voucher_backend.wallet import (WalletOutcomeUnknown, WalletUnavailable,
+                                    wallet_client)
+
+logger = logging.getLogger(__name__)
+
+WALLET_OUTBOX = os.environ.get('WALLET_OUTBOX', '0') == '1'
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 10))
+# Seconds before the second attempt, doubled at every attempt
+OUTBOX_BACKOFF = float(os.environ.get('OUTBOX_BACKOFF', 5))
+OUTBOX_MAX_BACKOFF = float(os.environ.get('OUTBOX_MAX_BACKOFF', 3600))
+# Seconds after which an operation the API was sending is assumed lost,
+# longer than any request
+WALLET_RECONCILE_AFTER = float(os.environ.get('WALLET_RECONCILE_AFTER', 300))
+
+PURCHASE_VOUCHER = 'purchase_voucher'
+TOPUP_WALLET = 'topup_wallet'
+
+
+def add_operation(operation, voucher, auth_id, amount, phone_number,
+                  description, idempotency_key=None, voucher_ids=None,
+                  status='pending'):
+    """
+    Add a wallet operation of the driver `auth_id` for `voucher` to the
+    session. It is committed with the voucher. `idempotency_key` is the
+    one of a call already sent, `voucher_ids` those of all the vouchers of
+    a batch purchase, `voucher` being the first. The API sends the
+    operations it adds `in_flight` itself
+    """
+    if voucher.id is None:
+        db.session.flush()
+    wallet_operation = WalletOperationModel(
+        idempotencyKey=idempotency_key or str(uuid4()),
+        operation=operation,
+        voucherId=voucher.id,
+        voucherIds=json.dumps(voucher_ids) if voucher_ids else None,
+        authId=auth_id,
+        amount=amount,
+        phoneNumber=phone_number,
+        description=description,
+        status=status,
+        # Counted as soon as it is sent
+        attempts=1 if status == 'in_flight' else 0,
+        dateCreated=datetime.utcnow(),
+    )
+    db.session.add(wallet_operation)
+    return wallet_operation
+
+
+def _send(wallet_operation):
+    if not wallet_client.service_authorization:
+        logger.error('WALLET_SERVICE_AUTHORIZATION is not set, cannot send '
+                     'the wallet operations')
+        raise WalletUnavailable('No service authorization')
+    send = {
+        PURCHASE_VOUCHER: wallet_client.purchase_voucher,
+        TOPUP_WALLET: wallet_client.topup_wallet,
+    }[wallet_operation.operation]
+    return send(wallet_client.service_authorization, wallet_operation.amount,
+                wallet_operation.phoneNumber, wallet_operation.description,
+                idempotency_key=wallet_operation.idempotencyKey,
+                on_behalf_of=wallet_operation.authId)
+
+
+def backoff(attempts):
+    """
+    Seconds to wait before sending again an operation tried `attempts`
+    times
+    """
+    return min(OUTBOX_MAX_BACKOFF, OUTBOX_BACKOFF * 2 ** (attempts - 1))
+
+
+def _apply(wallet_operation, succeeded):
+    """
+    Settle the vouchers of an operation, once the wallet answered
+    """
+    if wallet_operation.operation == PURCHASE_VOUCHER:
+        voucher_ids = [wallet_operation.voucherId]
+        if wallet_operation.voucherIds:
+            voucher_ids = json.loads(wallet_operation.voucherIds)
+        vouchers = VoucherModel.query.filter(
+            VoucherModel.id.in_(voucher_ids)).all()
+        if not succeeded:
+            # Counted in the rollups when issued, taken back with them
+            cancelled = defaultdict(list)
+            for voucher in vouchers:
+                if voucher.status != CANCELLED:
+                    cancelled[voucher.dateGenerated].append(voucher)
+            for moment, generated in cancelled.items():
+                record_cancelled(
+                    moment, [voucher.amountBought for voucher in generated],
+                    [voucher.voucherWorth for voucher in generated])
+        for voucher in vouchers:
+            # The voucher can be sold once paid for
+            voucher.status = NOT_USED if succeeded else CANCELLED
+        voucher_cache.invalidate(pins=[voucher.pin for voucher in vouchers],
+                                 ids=[voucher.id for voucher in vouchers])
+        return
+
+    voucher = VoucherModel.query.get(wallet_operation.voucherId)
+    if voucher is None:
+        return
+    if succeeded and voucher.status == RESERVED:
+        # Redeemed without the outbox, its top-up had no answer
+        voucher.status = USED
+        record_redeemed(voucher.timeUsed)
+    elif not succeeded:
+        # The rider was not topped up, the voucher can be used again
+        if voucher.status == USED and voucher.timeUsed is not None:
+            record_redeemed(voucher.timeUsed, -1)
+        voucher.status = NOT_USED
+        voucher.userPhoneNumber = None
+        voucher.timeUsed = None
+    voucher_cache.invalidate(pins=[voucher.pin], ids=[voucher.id])
+
+
+def record_attempt(wallet_operation, response):
+    """
+    Record the outcome of the attempt to send an operation in flight,
+    `response` being None if the wallet did not answer in time. Returns
+    whether the operation succeeded, None if its outcome is still unknown.
+    Its vouchers are not settled
+    """
+    now = datetime.utcnow()
+    if response is not None:
+        wallet_operation.responseStatus = response.status_code
+        wallet_operation.responseBody = response.text
+
+    if response is not None and response.status_code < 500:
+        succeeded = response.status_code == 201
+        wallet_operation.status = 'succeeded' if succeeded else 'failed'
+        wallet_operation.dateProcessed = now
+        return succeeded
+
+    if wallet_operation.attempts >= OUTBOX_MAX_ATTEMPTS:
+        # Not compensated, the wallet may have applied it
+        logger.error(f'Wallet operation {wallet_operation.idempotencyKey} '
+                     'parked after too many attempts, to reconcile')
+        wallet_operation.status = 'parked'
+        wallet_operation.dateProcessed = now
+    else:
+        wallet_operation.status = 'pending'
+        wallet_operation.nextAttempt = now + timedelta(
+            seconds=backoff(wallet_operation.attempts))
+    return None
+
+
+def _claim(batch_size, now):
+    """
+    Take a batch of the pending operations that are due, in flight until
+    their outcome is recorded, or handed back by reconcile_in_flight()
+    after WALLET_RECONCILE_AFTER seconds. Committed
+    """
+    wallet_operations = (
+        WalletOperationModel.query
+        .filter(WalletOperationModel.status == 'pending')
+        .filter(or_(WalletOperationModel.nextAttempt.is_(None),
+                    WalletOperationModel.nextAttempt <= now))
+        .order_by(WalletOperationModel.id)
+        .limit(batch_size)
+        # Concurrent workers take different operations
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    for wallet_operation in wallet_operations:
+        wallet_operation.status = 'in_flight'
+        wallet_operation.attempts += 1
+        wallet_operation.nextAttempt = now + timedelta(
+            seconds=WALLET_RECONCILE_AFTER)
+    db.session.flush()
+    # Not expired by the commit, they are sent with no transaction open
+    for wallet_operation in wallet_operations:
+        db.session.expunge(wallet_operation)
+    db.session.commit()
+    return wallet_operations
+
+
+def _release(wallet_operations):
+    """
+    Hand operations claimed but not sent back to the next drain
+    """
+    for wallet_operation in wallet_operations:
+        db.session.add(wallet_operation)
+        wallet_operation.status = 'pending'
+        wallet_operation.attempts -= 1
+        wallet_operation.nextAttempt = None
+    db.session.commit()
+
+
+def process_wallet_operation(wallet_operation):
+    """
+    Send one claimed operation, then record the outcome and settle its
+    vouchers in a transaction of their own. Raises WalletUnavailable,
+    recording nothing, if the wallet cannot be reached
+    """
+    try:
+        response = _send(wallet_operation)
+    except WalletOutcomeUnknown:
+        # Sent again with the same key
+        response = None
+    db.session.add(wallet_operation)
+    succeeded = record_attempt(wallet_operation, response)
+    if succeeded is not None:
+        _apply(wallet_operation, succeeded)
+    db.session.commit()
+
+
+def drain_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Send a batch of pending operations. Returns the number sent
+    """
+    wallet_operations = _claim(batch_size, datetime.utcnow())
+    for sent, wallet_operation in enumerate(wallet_operations):
+        try:
+            process_wallet_operation(wallet_operation)
+        except WalletUnavailable:
+            # Wait for the next drain, operations stay pending
+            logger.warning('Wallet unavailable, outbox drain stopped')
+            _release(wallet_operations[sent:])
+            return sent
+    return len(wallet_operations)
+
+
+def reconcile_in_flight(after=WALLET_RECONCILE_AFTER):
+    """
+    Hand the operations the API or a wallet worker never finished sending,
+    after a crash or a killed worker, to the wallet worker. Their vouchers
+    stay reserved until the wallet answers. Returns the number of
+    operations handed over
+    """
+    now = datetime.utcnow()
+    table = WalletOperationModel.__table__
+    handed_over = db.session.execute(
+        table.update()
+        .where(table.c.status == 'in_flight')
+        .where(table.c.dateCreated < now - timedelta(seconds=after))
+        # Claimed by a wallet worker until then
+        .where(or_(table.c.nextAttempt.is_(None),
+                   table.c.nextAttempt < now))
+        .values(status='pending', nextAttempt=None)
+    ).rowcount
+    db.session.commit()
+    if handed_over:
+        logger.warning(f'{handed_over} wallet operations left in flight, '
+                       'sent again')
+    return handed_over
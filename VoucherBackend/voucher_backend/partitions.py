@@ -0,0 +1,181 @@
+"""
+Monthly partitions of voucher_model and archival of the redeemed vouchers.
+
+On Postgres, voucher_model is partitioned by month of dateGenerated (see
+the migration e5c2a9f7b314). Each partition is named after its month,
+voucher_model_y2026m10, and a default partition takes the rows outside of
+them. The table partitioned by the migration became voucher_model_legacy,
+the partition of every month up to the migration. The partitions of the
+next VOUCHER_PARTITIONS_AHEAD months are created ahead by
+create_partitions(), a daily task of the Celery worker.
+A unique index of a partitioned table has to hold dateGenerated, the pins
+are kept unique by the primary key of voucher_pin instead, which a trigger
+of voucher_model fills and empties.
+
+archive_vouchers() moves the vouchers redeemed more than ARCHIVE_AFTER_DAYS
+days ago to voucher_archive_model, ARCHIVE_BATCH_SIZE at a time in their
+own transaction. The partitions, and their indexes, then mostly hold the
+vouchers still in use. On SQLite there are no partitions, the archival
+works the same.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, select
+
+from voucher_backend.db import db
+from voucher_backend.models import VoucherArchiveModel, VoucherModel
+from voucher_backend.redemption import USED
+from voucher_backend.voucher_cache import voucher_cache
+
+logger = logging.getLogger(__name__)
+
+VOUCHER_PARTITIONS_AHEAD = int(os.environ.get('VOUCHER_PARTITIONS_AHEAD', 3))
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 1000))
+
+PARTITIONED_QUERY = '''
+SELECT count(*) FROM pg_partitioned_table
+WHERE partrelid = to_regclass('voucher_model')
+'''
+# Upper bound of the legacy partition, FOR VALUES FROM (MINVALUE) TO (...)
+LEGACY_END_QUERY = '''
+SELECT CAST(substring(pg_get_expr(relpartbound, oid)
+                      FROM 'TO \\(''([^'']+)''\\)') AS timestamp)
+FROM pg_class WHERE oid = to_regclass('voucher_model_legacy')
+'''
+
+
+def month_start(moment):
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month):
+    return f'voucher_model_y{month:%Y}m{month:%m}'
+
+
+def is_partitioned(connection):
+    if connection.dialect.name != 'postgresql':
+        return False
+    return bool(connection.execute(PARTITIONED_QUERY).scalar())
+
+
+def create_partition(connection, month):
+    """
+    Create the partition of `month`. The vouchers of that month in the
+    default partition, which would stop its creation, are moved to it in
+    the same transaction
+    """
+    name = partition_name(month)
+    following = add_months(month, 1)
+    in_month = '"dateGenerated" >= %s AND "dateGenerated" < %s'
+    if connection.execute(
+            f'SELECT EXISTS (SELECT 1 FROM voucher_model_default '
+            f'WHERE {in_month})', month, following).scalar():
+        connection.execute(
+            'CREATE TEMPORARY TABLE voucher_model_moved AS '
+            f'SELECT * FROM voucher_model_default WHERE {in_month}',
+            month, following)
+        moved = connection.execute(
+            f'DELETE FROM voucher_model_default WHERE {in_month}',
+            month, following).rowcount
+    else:
+        moved = 0
+    connection.execute(
+        f'CREATE TABLE {name} PARTITION OF voucher_model '
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') "
+        f"TO ('{following:%Y-%m-%d}')")
+    if moved:
+        connection.execute(
+            'INSERT INTO voucher_model SELECT * FROM voucher_model_moved')
+        connection.execute('DROP TABLE voucher_model_moved')
+        logger.warning(f'Moved {moved} vouchers from the default partition '
+                       f'to {name}')
+    logger.info(f'Created the voucher partition {name}')
+    return name
+
+
+def create_partitions(months_ahead=VOUCHER_PARTITIONS_AHEAD, now=None):
+    """
+    Create the missing partitions from the current month to `months_ahead`
+    months later. Returns the names of the partitions created
+    """
+    created = []
+    with db.engine.begin() as connection:
+        if not is_partitioned(connection):
+            return created
+        legacy_end = connection.execute(LEGACY_END_QUERY).scalar()
+        month = month_start(now or datetime.utcnow())
+        for _ in range(months_ahead + 1):
+            name = partition_name(month)
+            # Created already, or held by the legacy partition
+            if not (connection.execute('SELECT to_regclass(%s)', name).scalar()
+                    or legacy_end is not None and month < legacy_end):
+                created.append(create_partition(connection, month))
+            month = add_months(month, 1)
+    return created
+
+
+def archive_batch(before, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move up to `batch_size` vouchers redeemed before `before` to the
+    archive, in one transaction. Returns the number of vouchers moved
+    """
+    table = VoucherModel.__table__
+    archive = VoucherArchiveModel.__table__
+    # A voucher redeemed before `before` was generated before it, which
+    # prunes the newer partitions
+    old = table.c.dateGenerated < before
+    batch = (
+        select([table.c.id, table.c.pin])
+        .where(table.c.status == USED)
+        # The redemptions of the first releases did not set timeUsed, the
+        # date the voucher was generated stands in
+        .where(or_(table.c.timeUsed < before, table.c.timeUsed.is_(None)))
+        .where(old)
+        .order_by(table.c.id)
+        .limit(batch_size)
+    )
+    if db.engine.dialect.name == 'postgresql':
+        # Leave the vouchers another archival is moving
+        batch = batch.with_for_update(skip_locked=True)
+    rows = db.session.execute(batch).fetchall()
+    if not rows:
+        db.session.rollback()
+        return 0
+
+    ids = [row.id for row in rows]
+    columns = [column.name for column in archive.c
+               if column.name in table.c]
+    moved = select([table.c[name] for name in columns]).where(
+        table.c.id.in_(ids)).where(old)
+    db.session.execute(archive.insert().from_select(columns, moved))
+    db.session.execute(
+        table.delete().where(table.c.id.in_(ids)).where(old))
+    voucher_cache.invalidate(pins=[row.pin for row in rows], ids=ids)
+    db.session.commit()
+    return len(ids)
+
+
+def archive_vouchers(after_days=ARCHIVE_AFTER_DAYS,
+                     batch_size=ARCHIVE_BATCH_SIZE, now=None):
+    """
+    Move the vouchers redeemed more than `after_days` days ago to the
+    archive, batch after batch. Returns the number of vouchers moved
+    """
+    before = (now or datetime.utcnow()) - timedelta(days=after_days)
+    total = 0
+    while True:
+        moved = archive_batch(before, batch_size)
+        total += moved
+        if moved < batch_size:
+            break
+    if total:
+        logger.info(f'Archived {total} vouchers redeemed before {before}')
+    return total
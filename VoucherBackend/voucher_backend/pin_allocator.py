@@ -0,0 +1,147 @@
+import logging
+import os
+import string
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+from voucher_backend.db import db
+from voucher_backend.models import (PinAllocatorModel, VoucherArchiveModel,
+                                    VoucherModel)
+
+logger = logging.getLogger(__name__)
+
+LETTERS = string.ascii_lowercase
+DIGITS = 10000
+# Two letters and four digits
+KEYSPACE = len(LETTERS) ** 2 * DIGITS
+
+# The keyspace is walked through the permutation index -> (A * index + C)
+# mod KEYSPACE. A is coprime with KEYSPACE (2^6 * 5^4 * 13^2), so every pin
+# comes up exactly once. Changing these values breaks pin uniqueness.
+PERMUTATION_A = 4477457
+PERMUTATION_C = 1299827
+
+PIN_BLOCK_SIZE = int(os.environ.get('PIN_BLOCK_SIZE', 1000))
+UTILISATION_WARNING = 0.8
+
+
+class PinSpaceExhausted(Exception):
+    pass
+
+
+def pin_at(index):
+    """
+    Return the pin at the given position of the keyspace permutation
+    """
+    key = (PERMUTATION_A * index + PERMUTATION_C) % KEYSPACE
+    letters, digits = divmod(key, DIGITS)
+    first, second = divmod(letters, len(LETTERS))
+    return f'{LETTERS[first]}{LETTERS[second]}{digits:04d}'
+
+
+class PinAllocator:
+    """
+    Hand out unique pins from blocks of the keyspace permutation.
+
+    Each process leases a block of positions through an atomic update of
+    the shared counter in PinAllocatorModel, so blocks never overlap
+    between workers or nodes, and issuing a pin from the block needs no
+    query at all.
+    """
+
+    def __init__(self, block_size=PIN_BLOCK_SIZE):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._pins = []
+        self._pid = None
+
+    def allocate(self):
+        return self.allocate_many(1)[0]
+
+    def allocate_many(self, count):
+        with self._lock:
+            # A forked worker must not reuse the block leased by its parent
+            if self._pid != os.getpid():
+                self._pins = []
+                self._pid = os.getpid()
+
+            pins = []
+            while len(pins) < count:
+                if not self._pins:
+                    self._pins = self._lease_block()
+                needed = count - len(pins)
+                pins.extend(self._pins[:needed])
+                del self._pins[:needed]
+            return pins
+
+    def _lease_block(self):
+        start = self._lease_range(self.block_size)
+        end = min(start + self.block_size, KEYSPACE)
+        pins = [pin_at(index) for index in range(start, end)]
+
+        # Pins issued before the allocator existed were random, skip them,
+        # archived or not
+        existing = (
+            db.session.query(VoucherModel.pin)
+            .filter(VoucherModel.pin.in_(pins))
+            .union_all(
+                db.session.query(VoucherArchiveModel.pin)
+                .filter(VoucherArchiveModel.pin.in_(pins))
+            )
+            .all()
+        )
+        existing = {pin for pin, in existing}
+        pins = [pin for pin in pins if pin not in existing]
+
+        utilisation = end / KEYSPACE
+        if utilisation >= UTILISATION_WARNING:
+            logger.warning(f'Pin keyspace is {utilisation:.1%} leased')
+        return pins or self._lease_block()
+
+    def _lease_range(self, size):
+        """
+        Reserve `size` positions of the permutation and return the first one
+        """
+        table = PinAllocatorModel.__table__
+        update = (
+            table.update()
+            .where(table.c.id == 1)
+            .values(nextIndex=table.c.nextIndex + size)
+        )
+        # Use its own transaction, so the lease is never rolled back
+        # with the request
+        try:
+            with db.engine.begin() as connection:
+                # The update locks the row until the transaction ends
+                if connection.execute(update).rowcount == 0:
+                    connection.execute(table.insert().values(id=1,
+                                                             nextIndex=size))
+                next_index = connection.execute(
+                    table.select().where(table.c.id == 1)
+                ).first()['nextIndex']
+        except IntegrityError:
+            # Another worker created the counter at the same time
+            return self._lease_range(size)
+
+        start = next_index - size
+        if start >= KEYSPACE:
+            raise PinSpaceExhausted('No pins left in the keyspace')
+        return start
+
+
+def keyspace_usage():
+    """
+    Report how much of the pin keyspace has been leased
+    """
+    allocator = PinAllocatorModel.query.get(1)
+    leased = min(allocator.nextIndex if allocator else 0, KEYSPACE)
+    return {
+        'keyspace': KEYSPACE,
+        'leased': leased,
+        'available': KEYSPACE - leased,
+        'utilisation': leased / KEYSPACE,
+    }
+
+
+pin_allocator = PinAllocator()
@@ -0,0 +1,186 @@
+"""
+Connection pool of the Postgres engine.
+
+Every uwsgi worker process has its own pool, sized from the worker model:
+one connection per thread, or DB_GREEN_POOL_SIZE in the gevent mode (see
+cooperative.py), and a small overflow for the export threads.
+With DB_MAX_CONNECTIONS, the share of the Postgres max_connections given to
+this service, the pools of all the workers stay within it.
+
+Connections are pinged before use and recycled, so a Postgres restart
+costs no failed request. Statements time out after DB_STATEMENT_TIMEOUT
+milliseconds.
+
+Behind PgBouncer in transaction pooling mode (DB_PGBOUNCER=1) nothing is
+set at the session level: the statement timeout is set at the start of each
+transaction instead of in the connection options, which PgBouncer refuses.
+psycopg2 never prepares statements on the server, so they need no change.
+"""
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+from voucher_backend.metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Default to the worker model
+DB_POOL_SIZE = os.environ.get('DB_POOL_SIZE')
+DB_MAX_OVERFLOW = os.environ.get('DB_MAX_OVERFLOW')
+# For all the workers, 0 for no limit
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 0))
+# Seconds to wait for a connection
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# Milliseconds, 0 for no timeout
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', '0') == '1'
+# Connections of each process in the gevent mode, where most of the
+# greenlets wait on the wallet, not on the database
+DB_GREEN_POOL_SIZE = int(os.environ.get('DB_GREEN_POOL_SIZE', 10))
+
+pool_checkout_wait = Histogram(
+    'db_pool_checkout_wait_seconds',
+    'Time waited for a connection of the pool',
+)
+pool_checkout_timeouts = Counter(
+    'db_pool_checkout_timeouts',
+    'Requests for a connection that timed out',
+)
+# Saturation is db_pool_checked_out / db_pool_capacity
+pool_checked_out = Gauge(
+    'db_pool_checked_out',
+    'Connections in use',
+    multiprocess_mode='livesum',
+)
+pool_capacity = Gauge(
+    'db_pool_capacity',
+    'Most connections the pools can open',
+    multiprocess_mode='livesum',
+)
+
+
+def worker_model():
+    """
+    Number of processes and of threads per process of the uwsgi server,
+    (1, 1) outside of uwsgi. In the gevent mode, the greenlets of a process
+    share DB_GREEN_POOL_SIZE connections
+    """
+    try:
+        import uwsgi
+    except ImportError:
+        return 1, 1
+    processes = int(uwsgi.opt.get('processes', 1))
+    threads = int(uwsgi.opt.get('threads', 1))
+    greenlets = int(uwsgi.opt.get('gevent', 0))
+    if greenlets:
+        threads = min(greenlets, DB_GREEN_POOL_SIZE)
+    return processes, threads
+
+
+def pool_sizes(processes, threads, pool_size=None, max_overflow=None,
+               max_connections=0):
+    """
+    Size and overflow of the pool of each worker process
+    """
+    pool_size = pool_size or threads
+    if max_overflow is None:
+        max_overflow = max(1, pool_size // 2)
+
+    if max_connections:
+        per_process = max(1, max_connections // processes)
+        if pool_size > per_process:
+            logger.warning(f'{processes} workers of {threads} threads need '
+                           f'more than {max_connections} connections, '
+                           f'pools limited to {per_process}')
+            pool_size = per_process
+        max_overflow = min(max_overflow, per_process - pool_size)
+    return pool_size, max_overflow
+
+
+class ManagedPool(QueuePool):
+    """
+    QueuePool recording the time waited for its connections
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Counted from the first checkout: the pool created in the uwsgi
+        # master is never used, its workers count their own
+        self._capacity_counted = False
+        self._capacity_lock = threading.Lock()
+
+    def _count_capacity(self, counted):
+        with self._capacity_lock:
+            if self._capacity_counted == counted:
+                return
+            self._capacity_counted = counted
+        capacity = self.size() + self._max_overflow
+        pool_capacity.inc(capacity if counted else -capacity)
+
+    def _do_get(self):
+        self._count_capacity(True)
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            pool_checkout_timeouts.inc()
+            raise
+        finally:
+            pool_checkout_wait.observe(time.perf_counter() - start)
+
+    def dispose(self):
+        super().dispose()
+        self._count_capacity(False)
+
+
+@event.listens_for(ManagedPool, 'checkout')
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_checked_out.inc()
+
+
+@event.listens_for(ManagedPool, 'checkin')
+def _checkin(dbapi_connection, connection_record):
+    pool_checked_out.dec()
+
+
+@event.listens_for(Engine, 'begin')
+def _set_transaction_timeout(conn):
+    if DB_PGBOUNCER and DB_STATEMENT_TIMEOUT and isinstance(
+            conn.engine.pool, ManagedPool):
+        # On the DBAPI connection, not to count in the query budgets
+        cursor = conn.connection.cursor()
+        cursor.execute(f'SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT}')
+        cursor.close()
+
+
+def engine_options():
+    """
+    Options of create_engine for Postgres
+    """
+    processes, threads = worker_model()
+    pool_size, max_overflow = pool_sizes(
+        processes, threads,
+        pool_size=int(DB_POOL_SIZE) if DB_POOL_SIZE else None,
+        max_overflow=int(DB_MAX_OVERFLOW) if DB_MAX_OVERFLOW else None,
+        max_connections=DB_MAX_CONNECTIONS,
+    )
+    options = {
+        'poolclass': ManagedPool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': True,
+    }
+    if DB_STATEMENT_TIMEOUT and not DB_PGBOUNCER:
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}',
+        }
+    return options
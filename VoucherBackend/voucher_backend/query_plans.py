@@ -0,0 +1,151 @@
+"""
+Check that the hot voucher queries are served by an index.
+
+Run it against a database with `flask query-plans`, adding `--seed N` to
+load N throwaway vouchers first so the planner sees a large table.
+"""
+import json
+import random
+import string
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import literal_column
+
+from voucher_backend.db import db
+from voucher_backend.models import VoucherModel
+
+SEED_DRIVER_ID = 'query-plan-seed'
+SEED_BATCH_SIZE = 10000
+TABLE = VoucherModel.__tablename__
+
+
+def hot_queries():
+    # The status is compared to a literal: psycopg2 interpolates parameters
+    # client side, so Postgres sees the constant and can use the partial
+    # index
+    unused = VoucherModel.status == literal_column('1')
+    since = datetime.utcnow() - timedelta(days=30)
+    return {
+        'voucher_by_pin': VoucherModel.query.filter(
+            VoucherModel.pin == 'ab1234'),
+        'vouchers_by_driver': VoucherModel.query.filter(
+            VoucherModel.driverId == 'driver').order_by(
+                VoucherModel.id).limit(100),
+        'vouchers_by_driver_phone': VoucherModel.query.filter(
+            VoucherModel.driverPhoneNumber == '08000000000').order_by(
+                VoucherModel.id).limit(100),
+        'vouchers_by_user_phone': VoucherModel.query.filter(
+            VoucherModel.userPhoneNumber == '08000000000').order_by(
+                VoucherModel.id).limit(100),
+        'unused_vouchers': VoucherModel.query.filter(unused).order_by(
+            VoucherModel.id).limit(100),
+        'vouchers_by_date': db.session.query(
+            db.func.count(VoucherModel.id)).filter(
+                VoucherModel.dateGenerated >= since),
+    }
+
+
+def explain(query):
+    """
+    Return the plan of a query as a list of lines
+    """
+    connection = db.session.connection()
+    compiled = query.statement.compile(dialect=connection.dialect)
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = [params[name] for name in compiled.positiontup]
+
+    if connection.dialect.name == 'postgresql':
+        rows = connection.execute('EXPLAIN ' + str(compiled), params)
+        return [row[0] for row in rows]
+
+    rows = connection.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+    return [row[-1] for row in rows]
+
+
+def is_sequential_scan(plan):
+    for line in plan:
+        # Postgres: "Seq Scan on voucher_model"
+        if f'Seq Scan on {TABLE}' in line:
+            return True
+        # SQLite: "SCAN voucher_model" (or "SCAN TABLE voucher_model")
+        # without an index
+        words = line.split()
+        if words[:1] == ['SCAN'] and TABLE in words and 'INDEX' not in words:
+            return True
+    return False
+
+
+def check_query_plans():
+    """
+    Explain every hot query. Returns a dict of query name to
+    {'plan': [...], 'sequentialScan': bool}
+    """
+    result = {}
+    for name, query in hot_queries().items():
+        plan = explain(query)
+        result[name] = {
+            'plan': plan,
+            'sequentialScan': is_sequential_scan(plan),
+        }
+    return result
+
+
+def seed_vouchers(number):
+    """
+    Insert `number` throwaway vouchers, spread over drivers, phones,
+    statuses and dates, then refresh the planner statistics
+    """
+    now = datetime.utcnow()
+    table = VoucherModel.__table__
+    for start in range(0, number, SEED_BATCH_SIZE):
+        rows = []
+        for index in range(start, min(start + SEED_BATCH_SIZE, number)):
+            rows.append({
+                'driverId': f'{SEED_DRIVER_ID}-{index % 1000}',
+                'driverPhoneNumber': f'seed{index % 5000}',
+                'userPhoneNumber': f'seed{index % 20000}',
+                # Pins outside the allocator keyspace: upper case letters
+                'pin': ''.join(random.choices(string.ascii_uppercase, k=4))
+                       + f'{index:08d}',
+                'amountBought': 800,
+                'voucherWorth': 1000,
+                # Most vouchers are used
+                'status': 1 if index % 50 == 0 else 2,
+                'dateGenerated': now - timedelta(minutes=index),
+            })
+        db.session.execute(table.insert(), rows)
+    db.session.commit()
+    db.session.execute(f'ANALYZE {TABLE}')
+    db.session.commit()
+
+
+def remove_seed_vouchers():
+    VoucherModel.query.filter(
+        VoucherModel.driverId.like(f'{SEED_DRIVER_ID}-%')).delete(
+            synchronize_session=False)
+    db.session.commit()
+
+
+@click.command('query-plans')
+@click.option('--seed', default=0, help='Vouchers to seed before checking')
+@with_appcontext
+def query_plans_command(seed):
+    """
+    Fail if a hot voucher query falls back to a sequential scan.
+    """
+    if seed:
+        seed_vouchers(seed)
+    try:
+        result = check_query_plans()
+    finally:
+        if seed:
+            remove_seed_vouchers()
+
+    click.echo(json.dumps(result, indent=2))
+    failed = [name for name, plan in result.items() if plan['sequentialScan']]
+    if failed:
+        raise click.ClickException(
+            f'Sequential scan on {TABLE}: {", ".join(failed)}')
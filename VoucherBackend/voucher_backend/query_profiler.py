@@ -0,0 +1,162 @@
+"""
+Profiling of the SQL statements, fed by the engine events of
+instrumentation.py.
+
+Statements slower than SLOW_QUERY_THRESHOLD seconds are logged with the
+shape of their parameters and their plan. Requests running the same
+statement more than REPEATED_STATEMENT_THRESHOLD times, the mark of an N+1
+pattern, are logged too.
+
+Resource methods declare how many statements they may run with
+@query_budget. In strict mode, the default when the app is testing,
+requests over their budget fail.
+"""
+import http.client
+import json
+import logging
+import os
+from collections import Counter as StatementCounter
+
+from flask import current_app, g, has_request_context, request
+
+from voucher_backend.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Seconds, a negative value turns the slow query log off
+SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.5))
+REPEATED_STATEMENT_THRESHOLD = int(
+    os.environ.get('REPEATED_STATEMENT_THRESHOLD', 10))
+# '1' or '0', strict when the app is testing if unset
+QUERY_BUDGET_STRICT = os.environ.get('QUERY_BUDGET_STRICT')
+
+slow_statements = Counter(
+    'sql_slow_statements',
+    'SQL statements slower than the slow query threshold',
+)
+repeated_statements = Counter(
+    'http_request_repeated_statements',
+    'Requests running the same SQL statement too many times, per route',
+    labelnames=('method', 'route'),
+)
+
+
+def query_budget(statements):
+    """
+    Declare the most statements a resource method may run
+    """
+    def decorator(function):
+        function.query_budget = statements
+        return function
+    return decorator
+
+
+def bind_shape(parameters, executemany=False):
+    """
+    Types of the parameters of a statement, without their values
+    """
+    if executemany:
+        return [len(parameters), bind_shape(parameters[0])] if parameters \
+            else [0]
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__
+                for name, value in parameters.items()}
+    return [type(value).__name__ for value in parameters or ()]
+
+
+def explain(connection, statement, parameters):
+    """
+    Plan of a statement, as a list of lines
+    """
+    dialect = connection.dialect.name
+    prefix = 'EXPLAIN ' if dialect == 'postgresql' else 'EXPLAIN QUERY PLAN '
+    # Straight on the DBAPI connection, not to trigger the events again
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    return [row[0] if dialect == 'postgresql' else row[-1] for row in rows]
+
+
+def record_statement(connection, statement, parameters, executemany,
+                     elapsed):
+    if 0 <= SLOW_QUERY_THRESHOLD <= elapsed:
+        slow_statements.inc()
+        plan = None
+        if not executemany:
+            try:
+                plan = explain(connection, statement, parameters)
+            except Exception as error:
+                plan = [f'Cannot explain: {error}']
+        shape = json.dumps(bind_shape(parameters, executemany))
+        plan = '\n'.join(plan or ())
+        logger.warning(f'Slow query ({elapsed:.3f}s): {statement}\n'
+                       f'Parameters: {shape}\nPlan:\n{plan}')
+
+    if has_request_context() and 'statement_counts' in g:
+        g.statement_counts[statement] += 1
+
+
+def start_request():
+    g.statement_counts = StatementCounter()
+
+
+def _budget():
+    """
+    The query budget of the resource method answering the request
+    """
+    view = current_app.view_functions.get(request.endpoint)
+    view_class = getattr(view, 'view_class', None)
+    method = getattr(view_class, request.method.lower(), None)
+    return getattr(method, 'query_budget', None)
+
+
+def _is_strict():
+    strict = current_app.config.get('QUERY_BUDGET_STRICT')
+    if strict is None:
+        return current_app.testing
+    return strict
+
+
+def check_request(route, response):
+    """
+    Flag the repeated statements of the request, and fail it if it went
+    over its budget in strict mode. Returns the response to send
+    """
+    if 'statement_counts' not in g:
+        return response
+
+    counts = g.statement_counts
+    for statement, count in counts.items():
+        if count > REPEATED_STATEMENT_THRESHOLD:
+            repeated_statements.labels(request.method, route).inc()
+            logger.warning(f'{request.method} {route} ran {count} times: '
+                           f'{statement}')
+
+    budget = _budget()
+    total = sum(counts.values())
+    if budget is None or total <= budget:
+        return response
+
+    message = (f'{request.method} {route} ran {total} SQL statements, '
+               f'its budget is {budget}')
+    if not _is_strict():
+        logger.warning(message)
+        return response
+
+    logger.error(message)
+    body = {
+        'status': 'error',
+        'message': message,
+    }
+    return current_app.response_class(
+        json.dumps(body), status=http.client.INTERNAL_SERVER_ERROR,
+        mimetype='application/json')
+
+
+def init_app(application):
+    if QUERY_BUDGET_STRICT is not None:
+        application.config.setdefault('QUERY_BUDGET_STRICT',
+                                      QUERY_BUDGET_STRICT == '1')
@@ -0,0 +1,81 @@
+"""
+Race free redemption of the vouchers.
+
+A voucher is claimed with a single conditional UPDATE, moving it from not
+used to reserved (or straight to used). Concurrent claims of the same pin
+are serialised by the row lock of the UPDATE, so exactly one of them
+matches the `status = 1` condition.
+"""
+from datetime import datetime
+
+from voucher_backend.db import db
+from voucher_backend.models import VoucherModel
+from voucher_backend.rollups import record_redeemed
+from voucher_backend.voucher_cache import voucher_cache
+
+NOT_USED = 1
+USED = 2
+# Claimed, waiting for the wallet to top the rider up
+RESERVED = 4
+
+
+def claim_voucher(pin, user_phone_number=None, status=RESERVED):
+    """
+    Move the unused voucher with `pin` to `status`. Returns the claimed row,
+    or None if there is no unused voucher with this pin
+    """
+    table = VoucherModel.__table__
+    values = {'status': status, 'timeUsed': datetime.utcnow()}
+    if user_phone_number:
+        values['userPhoneNumber'] = user_phone_number
+    update = (
+        table.update()
+        .where(table.c.pin == pin)
+        .where(table.c.status == NOT_USED)
+        .values(**values)
+    )
+
+    if db.engine.dialect.name == 'postgresql':
+        # One round trip on Postgres
+        voucher = db.session.execute(update.returning(*table.c)).first()
+    elif db.session.execute(update).rowcount == 0:
+        voucher = None
+    else:
+        voucher = db.session.execute(
+            table.select().where(table.c.pin == pin)).first()
+
+    if voucher is not None:
+        voucher_cache.invalidate(pins=[pin], ids=[voucher.id])
+        if status == USED:
+            record_redeemed(values['timeUsed'])
+    return voucher
+
+
+def confirm_voucher(voucher):
+    """
+    Mark a reserved voucher, the row returned by claim_voucher, as used
+    """
+    table = VoucherModel.__table__
+    result = db.session.execute(
+        table.update()
+        .where(table.c.id == voucher.id)
+        .where(table.c.status == RESERVED)
+        .values(status=USED)
+    )
+    voucher_cache.invalidate(pins=[voucher.pin], ids=[voucher.id])
+    if result.rowcount:
+        record_redeemed(voucher.timeUsed)
+
+
+def release_voucher(voucher):
+    """
+    Give a reserved voucher back, when the rider could not be topped up
+    """
+    table = VoucherModel.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.id == voucher.id)
+        .where(table.c.status == RESERVED)
+        .values(status=NOT_USED, timeUsed=None, userPhoneNumber=None)
+    )
+    voucher_cache.invalidate(pins=[voucher.pin], ids=[voucher.id])
@@ -0,0 +1,274 @@
+"""
+Routing of the read-only requests to a read replica.
+
+The replica is the `replica` bind of Flask-SQLAlchemy (DATABASE_REPLICA_URI,
+see db.py). The statements of the resource methods marked @read_only go to
+it, unless:
+
+- the client wrote in the last REPLICA_STICKY_SECONDS: it reads its writes
+  from the primary. The writes are shared between workers and nodes in
+  Redis when REDIS_URL is set.
+- the replica lags more than REPLICA_MAX_LAG seconds, checked every
+  REPLICA_CHECK_INTERVAL seconds.
+- the replica failed in the last REPLICA_RETRY_INTERVAL seconds. A read-only
+  request whose replica fails is run again on the primary.
+"""
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy.exc import DBAPIError
+
+from voucher_backend import instrumentation
+from voucher_backend.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND = 'replica'
+REDIS_URL = os.environ.get('REDIS_URL')
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 1))
+REPLICA_RETRY_INTERVAL = float(os.environ.get('REPLICA_RETRY_INTERVAL', 10))
+STICKY_KEY = 'voucher:replica:sticky:{}'
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# Seconds behind the primary, 0 when it replayed all it received
+LAG_QUERY = '''
+SELECT CASE
+    WHEN NOT pg_is_in_recovery()
+        OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(
+        EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+'''
+
+replica_reads = Counter(
+    'db_replica_reads',
+    'Read-only requests, per database answering them',
+    labelnames=('database', 'reason'),
+)
+
+
+class RedisStickyStore:
+    """
+    Share the recent writers between workers and nodes
+    """
+
+    def __init__(self, url, seconds=REPLICA_STICKY_SECONDS):
+        # Only imported when configured, it slows the start of the workers
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.seconds = seconds
+        self.errors = redis.RedisError
+
+    def mark(self, client_id):
+        self.client.set(STICKY_KEY.format(client_id), 1,
+                        px=int(self.seconds * 1000))
+
+    def is_sticky(self, client_id):
+        return bool(self.client.exists(STICKY_KEY.format(client_id)))
+
+
+class LocalStickyStore:
+    """
+    In-process stand-in for RedisStickyStore, for tests and development
+    """
+    errors = ()
+
+    def __init__(self, seconds=REPLICA_STICKY_SECONDS):
+        self.seconds = seconds
+        self._writes = {}
+        self._lock = threading.Lock()
+
+    def mark(self, client_id):
+        now = time.monotonic()
+        with self._lock:
+            self._writes = {key: until for key, until in self._writes.items()
+                            if until > now}
+            self._writes[client_id] = now + self.seconds
+
+    def is_sticky(self, client_id):
+        with self._lock:
+            return self._writes.get(client_id, 0) > time.monotonic()
+
+
+def replica_lag(engine):
+    """
+    Seconds the replica is behind the primary
+    """
+    if engine.dialect.name != 'postgresql':
+        return 0
+    # On the DBAPI connection, not to count in the query budgets
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(LAG_QUERY)
+        return float(cursor.fetchone()[0])
+    finally:
+        connection.close()
+
+
+class ReplicaRouter:
+    """
+    Choose the database of the read-only requests
+    """
+
+    def __init__(self, store=None, max_lag=REPLICA_MAX_LAG,
+                 check_interval=REPLICA_CHECK_INTERVAL,
+                 retry_interval=REPLICA_RETRY_INTERVAL):
+        self.store = store or LocalStickyStore()
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.reset()
+
+    def reset(self):
+        self._checked_at = None
+        self._usable = False
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def engine(self):
+        """
+        The replica engine of the app, None without replica
+        """
+        if REPLICA_BIND not in (current_app.config.get('SQLALCHEMY_BINDS')
+                                or {}):
+            return None
+        db = current_app.extensions['sqlalchemy'].db
+        engine = db.get_engine(current_app, bind=REPLICA_BIND)
+        instrumentation.instrument_engine(engine)
+        return engine
+
+    def is_usable(self, engine):
+        """
+        Whether the replica answers and keeps up, checked every
+        `check_interval` seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._failed_at is not None:
+                if now - self._failed_at < self.retry_interval:
+                    return False
+                self._failed_at = None
+            if self._checked_at is not None \
+                    and now - self._checked_at < self.check_interval:
+                return self._usable
+            self._checked_at = now
+
+        try:
+            lag = replica_lag(engine)
+        except Exception as error:
+            logger.warning(f'Cannot check the replica: {error}')
+            self.mark_failed()
+            return False
+        usable = lag <= self.max_lag
+        if not usable:
+            logger.warning(f'Replica {lag:.1f}s behind, reading from the '
+                           'primary')
+        self._usable = usable
+        return usable
+
+    def mark_failed(self):
+        with self._lock:
+            self._failed_at = time.monotonic()
+            self._usable = False
+
+    def is_sticky(self, client_id):
+        if client_id is None:
+            return False
+        try:
+            return self.store.is_sticky(client_id)
+        except self.store.errors:
+            logger.warning('Cannot read the recent writes, reading from the '
+                           'primary')
+            return True
+
+    def mark_write(self, client_id):
+        try:
+            self.store.mark(client_id)
+        except self.store.errors:
+            logger.error('Cannot record a write, the client may not read '
+                         'it from the replica')
+
+    def read_engine(self):
+        """
+        The replica engine when the statements of the request may read
+        from it, or None for the primary. Decided once per request
+        """
+        if not has_request_context() or not g.get('read_only'):
+            return None
+        if 'replica_engine' in g:
+            return g.replica_engine
+
+        engine = self.engine()
+        reason = None
+        if engine is None:
+            reason = 'no_replica'
+        elif self.is_sticky(g.get('auth_id')):
+            reason = 'sticky'
+        elif not self.is_usable(engine):
+            reason = 'unusable'
+        if reason is not None:
+            engine = None
+        g.replica_engine = engine
+        replica_reads.labels('primary' if engine is None else 'replica',
+                             reason or 'read_only').inc()
+        return engine
+
+
+def reads_from_replica():
+    """
+    Whether the statements of the current request read from the replica
+    """
+    return has_request_context() and g.get('replica_engine') is not None
+
+
+def read_only(method):
+    """
+    Let a resource method read from the replica. If the replica fails, the
+    method is run again on the primary
+    """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        try:
+            return method(*args, **kwargs)
+        except DBAPIError:
+            if g.get('replica_engine') is None:
+                raise
+            logger.exception('Replica failed, reading from the primary')
+            replica_router.mark_failed()
+            db = current_app.extensions['sqlalchemy'].db
+            db.session.rollback()
+            g.replica_engine = None
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def _start_request():
+    # The app context, and g, may outlive a request
+    for name in ('read_only', 'replica_engine', 'auth_id'):
+        g.pop(name, None)
+
+
+def _record_write(response):
+    if request.method in WRITE_METHODS and response.status_code < 400 \
+            and g.get('auth_id') is not None:
+        replica_router.mark_write(g.auth_id)
+    return response
+
+
+def init_app(application):
+    application.before_request(_start_request)
+    application.after_request(_record_write)
+
+
+replica_router = ReplicaRouter(RedisStickyStore(REDIS_URL)
+                               if REDIS_URL else None)
@@ -0,0 +1,170 @@
+"""
+Hourly rollups of the vouchers, read by the stats.
+
+VoucherRollupModel holds, per UTC hour, the number of vouchers issued with
+the sums of their amountBought and voucherWorth, and the number of
+vouchers redeemed, cancelled purchases left out. The code issuing,
+cancelling and redeeming vouchers updates them in its own transaction,
+with a single upsert on a random shard of the hour. The stats then add
+up O(hours) rollups instead of counting O(vouchers) rows, see stats.py.
+Hours rather than days answer the hourly stats, and the days of every
+timezone a whole number of hours away from UTC.
+
+rebuild_rollups(), also `flask rebuild-rollups`, recomputes the rollups of
+a range of hours from the live and archived vouchers, after vouchers were
+changed by hand. The migration creating the rollups fills them the same
+way.
+"""
+import logging
+import os
+import random
+from collections import defaultdict
+
+import click
+import pytz
+from flask.cli import with_appcontext
+from sqlalchemy import DateTime, bindparam, func, or_, text
+
+from voucher_backend.db import db
+from voucher_backend.models import (VoucherArchiveModel, VoucherModel,
+                                    VoucherRollupModel)
+from voucher_backend.stats import bucket_column, parse_bucket
+from voucher_backend.stats_cache import stats_cache
+
+logger = logging.getLogger(__name__)
+
+# Rows per hour, concurrent transactions update different ones
+ROLLUP_SHARDS = int(os.environ.get('ROLLUP_SHARDS', 8))
+# Status of the used vouchers, see redemption.py
+USED = 2
+# Status of the vouchers whose purchase the wallet refused, see outbox.py
+CANCELLED = 3
+
+# Postgres and SQLite (3.24 or later) share the syntax
+UPSERT = text('''
+INSERT INTO voucher_rollup_model
+    (hour, shard, issued, "amountBought", "voucherWorth", redeemed)
+VALUES (:hour, :shard, :issued, :amountBought, :voucherWorth, :redeemed)
+ON CONFLICT (hour, shard) DO UPDATE SET
+    issued = voucher_rollup_model.issued + excluded.issued,
+    "amountBought" = voucher_rollup_model."amountBought"
+        + excluded."amountBought",
+    "voucherWorth" = voucher_rollup_model."voucherWorth"
+        + excluded."voucherWorth",
+    redeemed = voucher_rollup_model.redeemed + excluded.redeemed
+''').bindparams(bindparam('hour', type_=DateTime()))
+
+
+def hour_start(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _add(moment, issued=0, amount_bought=0, voucher_worth=0, redeemed=0):
+    db.session.execute(UPSERT, {
+        'hour': hour_start(moment),
+        'shard': random.randrange(ROLLUP_SHARDS),
+        'issued': issued,
+        'amountBought': amount_bought,
+        'voucherWorth': voucher_worth,
+        'redeemed': redeemed,
+    })
+
+
+def record_issued(moment, amounts_bought, voucher_worths):
+    """
+    Count the vouchers generated at `moment`, given their amountBought and
+    voucherWorth
+    """
+    _add(moment, issued=len(amounts_bought),
+         amount_bought=sum(amounts_bought), voucher_worth=sum(voucher_worths))
+
+
+def record_cancelled(moment, amounts_bought, voucher_worths):
+    """
+    Take back the vouchers generated at `moment` whose purchase was
+    cancelled, given their amountBought and voucherWorth
+    """
+    _add(moment, issued=-len(amounts_bought),
+         amount_bought=-sum(amounts_bought),
+         voucher_worth=-sum(voucher_worths))
+
+
+def record_redeemed(moment, count=1):
+    """
+    Count `count` vouchers used at `moment`, a negative count takes them
+    back
+    """
+    _add(moment, redeemed=count)
+
+
+def _group_by_hour(column, aggregates, start, end, *filters):
+    hour = bucket_column(column, 'hour', pytz.utc, start)
+    query = db.session.query(hour, *aggregates).filter(column.isnot(None),
+                                                       *filters)
+    if start is not None:
+        query = query.filter(column >= start)
+    if end is not None:
+        query = query.filter(column < end)
+    return [(parse_bucket(moment), *values)
+            for moment, *values in query.group_by(hour)]
+
+
+def rebuild_rollups(start=None, end=None):
+    """
+    Recompute the rollups of the hours from `start` (included) to `end`
+    (excluded), rounded down to the hour, from the vouchers. All of them by
+    default. Returns the number of hours rolled up
+    """
+    start = start and hour_start(start)
+    end = end and hour_start(end)
+
+    rollups = defaultdict(lambda: [0, 0, 0, 0])
+    for model in (VoucherModel, VoucherArchiveModel):
+        for hour, issued, bought, worth in _group_by_hour(
+                model.dateGenerated,
+                (func.count(), func.sum(model.amountBought),
+                 func.sum(model.voucherWorth)),
+                start, end,
+                or_(model.status.is_(None), model.status != CANCELLED)):
+            rollup = rollups[hour]
+            rollup[0] += issued
+            rollup[1] += int(bought or 0)
+            rollup[2] += int(worth or 0)
+        for hour, redeemed in _group_by_hour(
+                model.timeUsed, (func.count(),), start, end,
+                model.status == USED):
+            rollups[hour][3] += redeemed
+
+    table = VoucherRollupModel.__table__
+    delete = table.delete()
+    if start is not None:
+        delete = delete.where(table.c.hour >= start)
+    if end is not None:
+        delete = delete.where(table.c.hour < end)
+    db.session.execute(delete)
+    if rollups:
+        db.session.execute(table.insert(), [
+            {'hour': hour, 'shard': 0, 'issued': issued,
+             'amountBought': bought, 'voucherWorth': worth,
+             'redeemed': redeemed}
+            for hour, (issued, bought, worth, redeemed) in rollups.items()
+        ])
+    db.session.commit()
+    # The cached stats of the closed ranges would never be refreshed
+    stats_cache.clear()
+    logger.info(f'Rolled up {len(rollups)} hours of vouchers')
+    return len(rollups)
+
+
+@click.command('rebuild-rollups')
+@click.option('--start', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='First day, the first voucher by default')
+@click.option('--end', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Day after the last, the last voucher by default')
+@with_appcontext
+def rebuild_rollups_command(start, end):
+    """
+    Recompute the hourly rollups of the stats from the vouchers
+    """
+    hours = rebuild_rollups(start, end)
+    click.echo(f'Rolled up {hours} hours')
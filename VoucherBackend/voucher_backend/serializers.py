@@ -0,0 +1,136 @@
+"""
+Compiled serialisation of the flask-restplus output models.
+
+`api.marshal` walks the fields of a model for every object, and wants ORM
+instances. A Serializer is compiled once from the model: it reads the row
+tuples of a select of just the columns the model needs, and writes their
+JSON directly. The JSON is byte for byte the one of `api.marshal` dumped by
+flask-restplus.
+"""
+import http.client
+import json
+import math
+from json.encoder import encode_basestring_ascii
+
+from flask import current_app, make_response
+from flask_restplus import fields
+from flask_restplus.representations import output_json
+
+NULL = 'null'
+
+
+def _encode_float(value):
+    value = float(value)
+    if math.isfinite(value):
+        return float.__repr__(value)
+    # NaN and Infinity
+    return json.dumps(value)
+
+
+# Field class: (format like the field, encode the formatted value as JSON)
+COMPILED_FIELDS = {
+    fields.Integer: (int, lambda value: str(int(value))),
+    fields.String: (str, lambda value: encode_basestring_ascii(str(value))),
+    fields.Float: (float, _encode_float),
+    fields.DateTime: (
+        lambda value: value.isoformat(),
+        lambda value: encode_basestring_ascii(value.isoformat()),
+    ),
+}
+
+
+class Serializer:
+    """
+    Serialise the rows of a table as a flask-restplus model.
+
+    Fetch the rows with a select of `columns`, in this order. Fields without
+    a column, like the `dateUsed` of the vouchers, are always null, as they
+    are with `api.marshal`.
+    """
+
+    def __init__(self, model, table):
+        self.model = model
+        columns = []
+        self._fields = []
+        for key, field in model.items():
+            if isinstance(field, type):
+                field = field()
+            if type(field) not in COMPILED_FIELDS or (
+                    isinstance(field, fields.DateTime)
+                    and field.dt_format != 'iso8601') or field.default:
+                raise ValueError(f'Cannot compile the field {key}')
+
+            format_value, encode_value = COMPILED_FIELDS[type(field)]
+            column = table.columns.get(field.attribute or key)
+            if column is None:
+                index = None
+            else:
+                index = len(columns)
+                columns.append(column)
+            self._fields.append((key, index, format_value, encode_value))
+
+        self.columns = tuple(columns)
+        self.encode = self._compile_encode()
+
+    def _compile_encode(self):
+        """
+        Generate the straight-line function writing the JSON of a row
+        """
+        template = '{' + ', '.join(
+            encode_basestring_ascii(key).replace('%', '%%') + ': %s'
+            for key, *_ in self._fields) + '}'
+        namespace = {'NULL': NULL, 'TEMPLATE': template}
+        values = []
+        for position, (_, index, _, encode_value) in enumerate(self._fields):
+            if index is None:
+                values.append('NULL')
+                continue
+            namespace[f'encode_{position}'] = encode_value
+            values.append(f'NULL if row[{index}] is None '
+                          f'else encode_{position}(row[{index}])')
+
+        source = ('def encode(row):\n'
+                  '    return TEMPLATE % (' + ', '.join(values) + ',)\n')
+        exec(source, namespace)
+        return namespace['encode']
+
+    def values(self, mapping):
+        """
+        Row tuple of a mapping with the column names as keys
+        """
+        return tuple(mapping.get(column.name) for column in self.columns)
+
+    def marshal(self, row):
+        """
+        Same dict as `api.marshal` of the ORM instance of the row
+        """
+        result = {}
+        for key, index, format_value, _ in self._fields:
+            value = None if index is None else row[index]
+            result[key] = None if value is None else format_value(value)
+        return result
+
+    def marshal_list(self, rows):
+        return [self.marshal(row) for row in rows]
+
+    def encode_list(self, rows):
+        """
+        JSON array of rows
+        """
+        encode = self.encode
+        return '[' + ', '.join([encode(row) for row in rows]) + ']'
+
+
+def json_response(encode, marshal, code=http.client.OK):
+    """
+    Response with the JSON written by `encode()`. When the app asks for
+    other JSON settings, indented in debug mode for instance, the data of
+    `marshal()` is dumped by flask-restplus instead
+    """
+    if current_app.debug or current_app.config.get('RESTPLUS_JSON'):
+        response = output_json(marshal(), code)
+    else:
+        # flask-restplus ends its JSON with a new line too
+        response = make_response(encode() + '\n', code)
+    response.headers['Content-Type'] = 'application/json'
+    return response
@@ -0,0 +1,136 @@
+"""
+Cold start of the app workers.
+
+uwsgi loads the app once in its master process and forks the workers from
+it (see docker/app/uwsgi.ini), also the workers it recycles after
+max-requests. preload() does there the work each worker would otherwise
+repeat on its first requests: the public key is parsed, the mappers are
+configured and swagger.json is rendered. Right after the fork, each worker
+opens its database connections and loads the discount.
+
+swagger.json is served from memory. It can be rendered at build time with
+`flask swagger --output swagger.json`, and read from SWAGGER_FILE.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+
+import click
+from flask import current_app, request
+from flask.cli import with_appcontext
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.pool import QueuePool
+
+from voucher_backend import config, cooperative
+from voucher_backend.discount_cache import discount_cache
+from voucher_backend.token_validation import load_public_key
+
+logger = logging.getLogger(__name__)
+
+SWAGGER_FILE = os.environ.get('SWAGGER_FILE')
+# '0' to start the workers cold, e.g. to debug the start up
+WARM_UP = os.environ.get('WARM_UP', '1') == '1'
+
+
+def render_swagger(application):
+    """
+    The swagger.json of the API, as bytes
+    """
+    with application.test_request_context():
+        schema = application.api.__schema__
+    if 'error' in schema:
+        raise RuntimeError(schema['error'])
+    return json.dumps(schema, sort_keys=True).encode('utf8')
+
+
+def cache_swagger(application, path=SWAGGER_FILE):
+    """
+    Serve swagger.json from memory, rendered now or read from `path`
+    """
+    if path:
+        with open(path, 'rb') as stream:
+            body = stream.read()
+        application.api._schema = json.loads(body)
+    else:
+        body = render_swagger(application)
+    etag = hashlib.sha1(body).hexdigest()
+
+    def swagger_view():
+        response = current_app.response_class(body,
+                                              mimetype='application/json')
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+    application.view_functions['specs'] = swagger_view
+
+
+def preload(application):
+    """
+    Warm what the workers share, before they are forked
+    """
+    start = time.perf_counter()
+    load_public_key(config.PUBLIC_KEY)
+    configure_mappers()
+    cache_swagger(application)
+    elapsed = time.perf_counter() - start
+    logger.info(f'App preloaded in {elapsed * 1000:.0f} ms')
+
+
+def warm_worker(application):
+    """
+    Open the database connections of a new worker and load the discount
+    """
+    start = time.perf_counter()
+    engine = application.db.get_engine(application)
+    # Never share connections opened before the fork
+    engine.dispose()
+    try:
+        size = engine.pool.size() if isinstance(engine.pool, QueuePool) \
+            else 1
+        connections = [engine.connect() for _ in range(size)]
+        for connection in connections:
+            connection.close()
+        with application.app_context():
+            discount_cache.get()
+    except Exception:
+        # The worker still starts, cold, when the database is down
+        logger.exception('Cannot warm up the worker')
+        return
+    elapsed = time.perf_counter() - start
+    logger.info(f'Worker {os.getpid()} warmed up in {elapsed * 1000:.0f} ms')
+
+
+def start(application):
+    """
+    Preload the app and warm its workers after the fork, when run by uwsgi.
+    Run by wsgi.py
+    """
+    if WARM_UP:
+        preload(application)
+    try:
+        import uwsgidecorators
+    except ImportError:
+        # Not forked
+        if WARM_UP:
+            warm_worker(application)
+        return
+
+    @uwsgidecorators.postfork
+    def start_worker():
+        cooperative.reinit()
+        if WARM_UP:
+            warm_worker(application)
+
+
+@click.command('swagger')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True),
+              default='-', help='File to write, standard output by default')
+@with_appcontext
+def swagger_command(output):
+    """
+    Render the swagger.json of the API, to be served from SWAGGER_FILE
+    """
+    with click.open_file(output, 'wb') as stream:
+        stream.write(render_swagger(current_app))
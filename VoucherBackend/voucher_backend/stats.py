@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import func, select, union_all
+
+from voucher_backend.db import db
+from voucher_backend.models import (VoucherArchiveModel, VoucherModel,
+                                    VoucherRollupModel)
+
+GRANULARITIES = ('hour', 'day', 'week', 'month')
+SQLITE_BUCKETS = {
+    'hour': ('%Y-%m-%d %H:00:00',),
+    'day': ('%Y-%m-%d 00:00:00',),
+    'week': ('%Y-%m-%d 00:00:00', 'weekday 0', '-6 days'),
+    'month': ('%Y-%m-01 00:00:00',),
+}
+
+
+def get_timezone(name):
+    """
+    Return the pytz timezone called `name`, or None if it does not exist
+    """
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        return None
+
+
+def bucket_start(moment, granularity):
+    """
+    Truncate a datetime to the start of its bucket
+    """
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    moment = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == 'week':
+        return moment - timedelta(days=moment.weekday())
+    if granularity == 'month':
+        return moment.replace(day=1)
+    return moment
+
+
+def next_bucket(moment, granularity):
+    if granularity == 'hour':
+        return moment + timedelta(hours=1)
+    if granularity == 'day':
+        return moment + timedelta(days=1)
+    if granularity == 'week':
+        return moment + timedelta(weeks=1)
+    if moment.month == 12:
+        return moment.replace(year=moment.year + 1, month=1)
+    return moment.replace(month=moment.month + 1)
+
+
+def to_utc(moment, timezone):
+    return timezone.localize(moment).astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def bucket_column(column, granularity, timezone, start):
+    """
+    SQL expression that truncates `column` (stored in UTC) to the start of
+    its bucket in `timezone`
+    """
+    if db.engine.dialect.name == 'postgresql':
+        local = func.timezone(timezone.zone, func.timezone('UTC', column))
+        return func.date_trunc(granularity, local)
+
+    # SQLite has no timezone database, use the offset at the range start
+    offset = timezone.utcoffset(start)
+    minutes = int(offset.total_seconds() // 60)
+    local = func.datetime(column, f'{minutes:+d} minutes')
+    format_, *modifiers = SQLITE_BUCKETS[granularity]
+    return func.strftime(format_, local, *modifiers)
+
+
+def parse_bucket(moment):
+    """
+    The naive datetime of a bucket returned by the database
+    """
+    if isinstance(moment, str):
+        moment = datetime.strptime(moment, '%Y-%m-%d %H:%M:%S')
+    return moment.replace(tzinfo=None)
+
+
+def _whole_hours(timezone, start, end):
+    # Whether the buckets in `timezone` are made of whole UTC hours
+    return all(timezone.utcoffset(moment).total_seconds() % 3600 == 0
+               for moment in (start, end))
+
+
+def count_vouchers(start, end, granularity='day', timezone=pytz.utc):
+    """
+    Count the vouchers generated between the local datetimes `start`
+    (included) and `end` (excluded), grouped per `granularity` bucket.
+
+    A single GROUP BY query is issued whatever the range, over the hourly
+    rollups (see rollups.py). Timezones with a fraction of an hour of
+    offset count the live and the archived vouchers instead. Buckets
+    without vouchers are filled with zero. Returns an OrderedDict of bucket
+    start to count.
+    """
+    utc_start, utc_end = to_utc(start, timezone), to_utc(end, timezone)
+    if _whole_hours(timezone, start, end):
+        column = VoucherRollupModel.hour
+        count = func.sum(VoucherRollupModel.issued)
+        source = VoucherRollupModel.__table__
+        filters = (column >= utc_start, column < utc_end)
+    else:
+        source = union_all(*(
+            select([model.dateGenerated])
+            .where(model.dateGenerated >= utc_start)
+            .where(model.dateGenerated < utc_end)
+            for model in (VoucherModel, VoucherArchiveModel)
+        )).alias('vouchers')
+        column = source.c.dateGenerated
+        count = func.count()
+        filters = ()
+    bucket = bucket_column(column, granularity, timezone, start)
+    rows = (
+        db.session.query(bucket, count)
+        .select_from(source)
+        .filter(*filters)
+        .group_by(bucket)
+        .all()
+    )
+
+    counts = {parse_bucket(moment): int(count) for moment, count in rows}
+
+    result = OrderedDict()
+    moment = bucket_start(start, granularity)
+    while moment < end:
+        result[moment] = counts.get(moment, 0)
+        moment = next_bucket(moment, granularity)
+    return result
+
+
+def total_vouchers():
+    """
+    Count all the vouchers ever generated
+    """
+    return int(db.session.query(
+        func.coalesce(func.sum(VoucherRollupModel.issued), 0)).scalar())
@@ -0,0 +1,306 @@
+"""
+Cache of the stats results.
+
+A dashboard opened in many browsers asks for the same stats at the same
+moment. The results are cached under their normalised parameters, in each
+worker and, when REDIS_URL is set, in Redis for all the workers and nodes:
+
+- ranges ended before the current hour do not change any more, they are
+  kept STATS_CLOSED_TTL seconds
+- open ranges are kept STATS_TTLS seconds, depending on their granularity
+- the total for STATS_TOTAL_TTL seconds
+
+A worker keeps its copy at most STATS_LOCAL_TTL seconds, so a rebuild of
+the rollups, which clears the shared cache, is seen by all.
+
+Missing results are computed once: the requests of a worker asking for the
+same result wait for the first one, and with Redis the workers wait for
+the one holding the lock of the result, up to STATS_WAIT_TIMEOUT seconds.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from voucher_backend.metrics import Counter
+from voucher_backend.stats import to_utc
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.environ.get('REDIS_URL')
+STATS_TTLS = {
+    'hour': float(os.environ.get('STATS_HOUR_TTL', 10)),
+    'day': float(os.environ.get('STATS_DAY_TTL', 60)),
+    'week': float(os.environ.get('STATS_WEEK_TTL', 300)),
+    'month': float(os.environ.get('STATS_MONTH_TTL', 900)),
+}
+STATS_CLOSED_TTL = float(os.environ.get('STATS_CLOSED_TTL', 30 * 24 * 3600))
+STATS_TOTAL_TTL = float(os.environ.get('STATS_TOTAL_TTL', 10))
+STATS_LOCAL_TTL = float(os.environ.get('STATS_LOCAL_TTL', 300))
+STATS_CACHE_SIZE = int(os.environ.get('STATS_CACHE_SIZE', 1000))
+# Seconds a worker computing a result holds its lock
+STATS_LOCK_TIMEOUT = float(os.environ.get('STATS_LOCK_TIMEOUT', 10))
+# Seconds the other workers wait for it before computing it themselves
+STATS_WAIT_TIMEOUT = float(os.environ.get('STATS_WAIT_TIMEOUT', 5))
+STATS_POLL_INTERVAL = 0.05
+CACHE_KEY = 'voucher:stats:{}'
+LOCK_KEY = 'voucher:stats:lock:{}'
+
+stats_cache_lookups = Counter(
+    'stats_cache_lookups',
+    'Lookups of stats results in the stats cache',
+    labelnames=('result',),
+)
+
+
+def stats_ttl(granularity, end, timezone):
+    """
+    Seconds to keep the stats of the range ending at the local datetime
+    `end` (excluded)
+    """
+    current_hour = datetime.utcnow().replace(minute=0, second=0,
+                                             microsecond=0)
+    if to_utc(end, timezone) <= current_hour:
+        return STATS_CLOSED_TTL
+    return STATS_TTLS[granularity]
+
+
+def make_key(name, *params):
+    """
+    Key of the result of the stats `name` for the normalised `params`
+    """
+    return ':'.join([name] + [
+        param.isoformat() if isinstance(param, datetime) else str(param)
+        for param in params
+    ])
+
+
+class RedisStatsStore:
+    """
+    Share the stats results, and who computes them, between workers and
+    nodes
+    """
+
+    def __init__(self, url):
+        # Only imported when configured, it slows the start of the workers
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.errors = redis.RedisError
+
+    def get(self, key):
+        data = self.client.get(CACHE_KEY.format(key))
+        return None if data is None else json.loads(data)
+
+    def set(self, key, value, seconds):
+        self.client.set(CACHE_KEY.format(key), json.dumps(value),
+                        px=int(seconds * 1000))
+
+    def lock(self, key, seconds):
+        return bool(self.client.set(LOCK_KEY.format(key), 1, nx=True,
+                                    px=int(seconds * 1000)))
+
+    def unlock(self, key):
+        self.client.delete(LOCK_KEY.format(key))
+
+    def is_locked(self, key):
+        return bool(self.client.exists(LOCK_KEY.format(key)))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(CACHE_KEY.format('*')))
+        if keys:
+            self.client.delete(*keys)
+
+
+class LocalStatsStore:
+    """
+    In-process stand-in for RedisStatsStore, for tests and development
+    """
+    errors = ()
+
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires_at = self._entries.get(key, (None, 0))
+            return value if expires_at > time.monotonic() else None
+
+    def set(self, key, value, seconds):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + seconds)
+
+    def lock(self, key, seconds):
+        now = time.monotonic()
+        with self._lock:
+            if self._locks.get(key, 0) > now:
+                return False
+            self._locks[key] = now + seconds
+            return True
+
+    def unlock(self, key):
+        with self._lock:
+            self._locks.pop(key, None)
+
+    def is_locked(self, key):
+        with self._lock:
+            return self._locks.get(key, 0) > time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _Flight:
+    """
+    A result being computed in this worker
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class StatsCache:
+    """
+    Results of the stats, computed once per key at a time
+    """
+
+    def __init__(self, store=None, maxsize=STATS_CACHE_SIZE,
+                 local_ttl=STATS_LOCAL_TTL, lock_timeout=STATS_LOCK_TIMEOUT,
+                 wait_timeout=STATS_WAIT_TIMEOUT):
+        self.store = store
+        self.maxsize = maxsize
+        self.local_ttl = local_ttl
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, ttl, compute):
+        """
+        The cached result for `key`, else the result of `compute()`, kept
+        `ttl` seconds
+        """
+        with self._lock:
+            value = self._get_local(key)
+            if value is not None:
+                stats_cache_lookups.labels('hit').inc()
+                return value
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            stats_cache_lookups.labels('coalesced').inc()
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self._get_shared(key, ttl, compute)
+            return flight.value
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None:
+                    self._set_local(key, flight.value, ttl)
+                del self._flights[key]
+            flight.done.set()
+
+    def _get_shared(self, key, ttl, compute):
+        if self.store is None:
+            stats_cache_lookups.labels('miss').inc()
+            return compute()
+
+        try:
+            value = self.store.get(key)
+            if value is not None:
+                stats_cache_lookups.labels('shared_hit').inc()
+                return value
+            locked = self.store.lock(key, self.lock_timeout)
+            if not locked:
+                value = self._wait(key)
+                if value is not None:
+                    stats_cache_lookups.labels('coalesced').inc()
+                    return value
+        except self.store.errors:
+            logger.warning('Cannot read the shared stats cache')
+            stats_cache_lookups.labels('miss').inc()
+            return compute()
+
+        stats_cache_lookups.labels('miss').inc()
+        try:
+            value = compute()
+            try:
+                self.store.set(key, value, ttl)
+            except self.store.errors:
+                logger.warning('Cannot write the shared stats cache')
+            return value
+        finally:
+            if locked:
+                try:
+                    self.store.unlock(key)
+                except self.store.errors:
+                    logger.warning('Cannot release the lock of '
+                                   f'{key}, it expires in '
+                                   f'{self.lock_timeout:.0f}s')
+
+    def _wait(self, key):
+        # The result of the worker holding the lock, or None if it took too
+        # long or failed
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(STATS_POLL_INTERVAL)
+            value = self.store.get(key)
+            if value is not None:
+                return value
+            if not self.store.is_locked(key):
+                return None
+        logger.warning(f'Waited {self.wait_timeout:.0f}s for {key}, '
+                       'computing it')
+        return None
+
+    def _get_local(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_local(self, key, value, ttl):
+        expires_at = time.monotonic() + min(ttl, self.local_ttl)
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Forget the results of this worker and the shared ones
+        """
+        with self._lock:
+            self._entries.clear()
+        if self.store is not None:
+            try:
+                self.store.clear()
+            except self.store.errors:
+                logger.error('Cannot clear the shared stats cache')
+
+
+stats_cache = StatsCache(RedisStatsStore(REDIS_URL) if REDIS_URL else None)
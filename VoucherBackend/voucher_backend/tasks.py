@@ -0,0 +1,101 @@
+"""
+Celery tasks. Start the wallet worker with
+
+    $ celery -A voucher_backend.tasks worker --beat
+"""
+import os
+
+from celery import Celery
+
+from voucher_backend.config import load_environment
+
+# The worker is an entry point, its settings are read at import
+load_environment()
+
+from voucher_backend import partitions  # noqa: E402
+from voucher_backend.outbox import (  # noqa: E402
+    OUTBOX_BATCH_SIZE, drain_outbox, reconcile_in_flight)
+
+CELERY_BROKER_URL = os.environ.get(
+    'CELERY_BROKER_URL',
+    os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+# Seconds between two drains of the wallet outbox
+OUTBOX_DRAIN_INTERVAL = float(os.environ.get('OUTBOX_DRAIN_INTERVAL', 2))
+# Seconds between two looks for the wallet operations left in flight
+RECONCILE_INTERVAL = float(os.environ.get('RECONCILE_INTERVAL', 60))
+# Seconds between two archivals of the redeemed vouchers
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', 3600))
+PARTITIONS_INTERVAL = 24 * 3600
+
+celery = Celery('voucher_backend', broker=CELERY_BROKER_URL)
+celery.conf.task_ignore_result = True
+celery.conf.beat_schedule = {
+    'drain-wallet-outbox': {
+        'task': 'voucher_backend.tasks.drain_wallet_outbox',
+        'schedule': OUTBOX_DRAIN_INTERVAL,
+        # A drain that waited longer than the interval is superseded
+        'options': {'expires': OUTBOX_DRAIN_INTERVAL},
+    },
+    'reconcile-wallet-operations': {
+        'task': 'voucher_backend.tasks.reconcile_wallet_operations',
+        'schedule': RECONCILE_INTERVAL,
+        'options': {'expires': RECONCILE_INTERVAL},
+    },
+    'create-voucher-partitions': {
+        'task': 'voucher_backend.tasks.create_voucher_partitions',
+        'schedule': PARTITIONS_INTERVAL,
+    },
+    'archive-redeemed-vouchers': {
+        'task': 'voucher_backend.tasks.archive_redeemed_vouchers',
+        'schedule': ARCHIVE_INTERVAL,
+        'options': {'expires': ARCHIVE_INTERVAL},
+    },
+}
+
+_application = None
+
+
+def get_application():
+    global _application
+    if _application is None:
+        from voucher_backend.app import create_app
+        _application = create_app()
+    return _application
+
+
+@celery.task
+def drain_wallet_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Send the pending wallet operations, batch after batch
+    """
+    with get_application().app_context():
+        while drain_outbox(batch_size) == batch_size:
+            pass
+
+
+@celery.task
+def reconcile_wallet_operations():
+    """
+    Send again the wallet operations left in flight by the API, to settle
+    their reserved vouchers
+    """
+    with get_application().app_context():
+        reconcile_in_flight()
+
+
+@celery.task
+def create_voucher_partitions():
+    """
+    Create the monthly partitions of the coming months
+    """
+    with get_application().app_context():
+        partitions.create_partitions()
+
+
+@celery.task
+def archive_redeemed_vouchers():
+    """
+    Move the vouchers redeemed long ago to the archive
+    """
+    with get_application().app_context():
+        partitions.archive_vouchers()
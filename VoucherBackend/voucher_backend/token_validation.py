@@ -1,17 +1,106 @@
+import hashlib
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 import jwt
-from parse import parse
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+from voucher_backend.metrics import Counter
 
 logger = logging.getLogger(__name__)
 
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+
+
+@lru_cache(maxsize=8)
+def load_public_key(public_key):
+    """
+    Parse a PEM public key once and reuse the key object afterwards
+    """
+    return load_pem_public_key(public_key.encode('utf8'), default_backend())
+
+
+token_cache_lookups = Counter(
+    'token_cache_lookups',
+    'Lookups of verified tokens in the token cache',
+    labelnames=('result',),
+)
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of verified token payloads.
+
+    Entries are keyed on a hash of the token and the public key used to
+    verify it, and expire at the token's `exp`.
+    """
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token, public_key):
+        return (public_key, hashlib.sha256(token.encode('utf8')).digest())
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, expiry = entry
+                if expiry > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    token_cache_lookups.labels('hit').inc()
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            token_cache_lookups.labels('miss').inc()
+            return None
+
+    def set(self, key, payload):
+        with self._lock:
+            self._entries[key] = (payload, payload['exp'])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+token_cache = TokenCache()
+
+
 def encode_token(payload, private_key):
     return jwt.encode(payload, private_key, algorithm='RS256')
 
 
 def decode_token(token, public_key):
-    return jwt.decode(token, public_key, algoritms='RS256')
+    if isinstance(public_key, str):
+        public_key = load_public_key(public_key)
+    return jwt.decode(token, public_key, algorithms=['RS256'])
 
 
 def generate_token_header(payload1, private_key):
@@ -35,32 +124,40 @@ def generate_token_header(payload1, private_key):
     return f'Bearer {token}'
 
 
-def validate_token_header(header, public_key):
+def validate_token_header(header, public_key, cache=token_cache):
     """
     Validate that a token header is correct
 
     If correct, it returns the payload, if not, it
-    returns None
+    returns None. Verified tokens are kept in `cache` until they expire,
+    pass cache=None to always verify the signature.
     """
     if not header:
         logger.info('No header')
         return None
 
     # Retrieve the Bearer token
-    parse_result = parse('Bearer {}', header)
-    if not parse_result:
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() != 'bearer' or not token:
         logger.info(f'Wrong format for header "{header}"')
         return None
-    token = parse_result[0]
+
+    if cache is not None:
+        cache_key = cache.key(token, public_key)
+        decoded_token = cache.get(cache_key)
+        if decoded_token is not None:
+            return dict(decoded_token)
+
     try:
         decoded_token = decode_token(token.encode('utf8'), public_key)
-    except jwt.exceptions.DecodeError:
-        logger.warning(f'Error decoding header "{header}". '
-                       'This may be key mismatch or wrong key')
-        return None
     except jwt.exceptions.ExpiredSignatureError:
         logger.error(f'Authentication header has expired')
         return None
+    except (jwt.exceptions.InvalidTokenError, ValueError):
+        # Bad signature, algorithm or claims, like a token not valid yet
+        logger.warning(f'Error decoding header "{header}". '
+                       'This may be key mismatch or wrong key')
+        return None
 
     # Check expiry is in the token
     if 'exp' not in decoded_token:
@@ -73,5 +170,7 @@ def validate_token_header(header, public_key):
         return None
 
     logger.info('Header successfully validated')
-    return decoded_token
+    if cache is not None:
+        cache.set(cache_key, decoded_token)
+    return dict(decoded_token)
 
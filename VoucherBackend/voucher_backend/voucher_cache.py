@@ -0,0 +1,266 @@
+"""
+Read-through cache of the voucher lookups by pin and by id.
+
+Rider apps poll a pin until it is redeemed, so those lookups are the most
+frequent requests. Their rows are kept:
+
+- in an LRU of each worker, for VOUCHER_LOCAL_TTL seconds
+- in Redis when REDIS_URL is set, shared by the workers and nodes, for
+  VOUCHER_CACHE_TTL seconds
+
+A row is cached under its pin and its id. Unknown pins and ids are cached
+too, for VOUCHER_NEGATIVE_TTL seconds, so polling a pin before it is
+issued stays cheap.
+
+The code changing a voucher (issuance, redemption, the outbox) calls
+invalidate(). The entries are dropped at once, and again after the commit
+of the change: a lookup running in between may have cached the old row.
+The other workers keep their local copy until it expires, which is why it
+is short lived when Redis is shared. A row read from the replica may be
+stale already, it is kept no longer than REPLICA_MAX_LAG seconds.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import event
+
+from voucher_backend import replica
+from voucher_backend.db import RoutingSession, db
+from voucher_backend.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.environ.get('REDIS_URL')
+VOUCHER_CACHE_SIZE = int(os.environ.get('VOUCHER_CACHE_SIZE', 10000))
+VOUCHER_CACHE_TTL = float(os.environ.get('VOUCHER_CACHE_TTL', 60))
+VOUCHER_LOCAL_TTL = float(os.environ.get(
+    'VOUCHER_LOCAL_TTL', 1 if REDIS_URL else 10))
+VOUCHER_NEGATIVE_TTL = float(os.environ.get('VOUCHER_NEGATIVE_TTL', 2))
+CACHE_KEY = 'voucher:cache:{}:{}'
+# Keys to drop once the session commits, per cache
+PENDING_KEYS = 'voucher_cache_keys'
+# Of the cached dates, naive UTC as the columns. Python 3.6 has no
+# datetime.fromisoformat
+SECONDS_FORMAT = '%Y-%m-%dT%H:%M:%S'
+DATETIME_FORMAT = SECONDS_FORMAT + '.%f'
+
+voucher_cache_lookups = Counter(
+    'voucher_cache_lookups',
+    'Lookups of vouchers by pin or id in the voucher cache',
+    labelnames=('tier', 'result'),
+)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    raise TypeError(f'Cannot cache {type(value).__name__}')
+
+
+def _decode_value(mapping):
+    if '$datetime' in mapping:
+        value = mapping['$datetime']
+        # isoformat() leaves the microseconds out when there are none
+        date_format = DATETIME_FORMAT if '.' in value else SECONDS_FORMAT
+        return datetime.strptime(value, date_format)
+    return mapping
+
+
+def encode_row(row):
+    """
+    JSON of a cached row, `null` for a voucher that does not exist
+    """
+    return json.dumps(None if row is None else list(row),
+                      default=_encode_value)
+
+
+def decode_row(data):
+    row = json.loads(data, object_hook=_decode_value)
+    return None if row is None else tuple(row)
+
+
+class RedisVoucherStore:
+    """
+    Share the cached rows between workers and nodes
+    """
+
+    def __init__(self, url):
+        # Only imported when configured, it slows the start of the workers
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.errors = redis.RedisError
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, data, seconds):
+        self.client.set(key, data, px=int(seconds * 1000))
+
+    def delete(self, keys):
+        self.client.delete(*keys)
+
+
+class LocalVoucherStore:
+    """
+    In-process stand-in for RedisVoucherStore, for tests and development
+    """
+    errors = ()
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data, expires_at = self._entries.get(key, (None, 0))
+            return data if expires_at > time.monotonic() else None
+
+    def set(self, key, data, seconds):
+        with self._lock:
+            self._entries[key] = (data, time.monotonic() + seconds)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class VoucherCache:
+    """
+    LRU of voucher rows by pin and by id, in front of an optional shared
+    store
+    """
+
+    def __init__(self, store=None, maxsize=VOUCHER_CACHE_SIZE,
+                 ttl=VOUCHER_CACHE_TTL, local_ttl=VOUCHER_LOCAL_TTL,
+                 negative_ttl=VOUCHER_NEGATIVE_TTL):
+        self.store = store
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_by_pin(self, pin, load):
+        """
+        The row of the voucher with `pin`, or None if there is none.
+        `load` reads it from the database on a miss
+        """
+        return self._get(CACHE_KEY.format('pin', pin), load)
+
+    def get_by_id(self, voucher_id, load):
+        return self._get(CACHE_KEY.format('id', voucher_id), load)
+
+    def _get(self, key, load):
+        found, row = self._get_local(key)
+        if found:
+            voucher_cache_lookups.labels('local', _result(row)).inc()
+            return row
+
+        if self.store is not None:
+            try:
+                data = self.store.get(key)
+            except self.store.errors:
+                logger.warning('Cannot read the shared voucher cache')
+                data = None
+            if data is not None:
+                row = decode_row(data)
+                self._set_local([key], row, self.local_ttl if row else
+                                min(self.local_ttl, self.negative_ttl))
+                voucher_cache_lookups.labels('shared', _result(row)).inc()
+                return row
+
+        voucher_cache_lookups.labels('database', 'miss').inc()
+        row = load()
+        if row is None:
+            self._fill([key], None, self.negative_ttl)
+            return None
+        # Cached under both keys, a rider may poll either
+        keys = {key, CACHE_KEY.format('pin', row.pin),
+                CACHE_KEY.format('id', row.id)}
+        row = tuple(row)
+        self._fill(keys, row, self.ttl)
+        return row
+
+    def _fill(self, keys, row, ttl):
+        if replica.reads_from_replica():
+            ttl = min(ttl, replica.REPLICA_MAX_LAG)
+        self._set_local(keys, row, min(ttl, self.local_ttl))
+        if self.store is None:
+            return
+        data = encode_row(row)
+        try:
+            for key in keys:
+                self.store.set(key, data, ttl)
+        except self.store.errors:
+            logger.warning('Cannot write the shared voucher cache')
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            row, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, row
+
+    def _set_local(self, keys, row, seconds):
+        expires_at = time.monotonic() + seconds
+        with self._lock:
+            for key in keys:
+                self._entries[key] = (row, expires_at)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, pins=(), ids=()):
+        """
+        Drop the vouchers with `pins` and `ids`, now and once the session
+        commits
+        """
+        keys = [CACHE_KEY.format('pin', pin) for pin in pins]
+        keys += [CACHE_KEY.format('id', voucher_id) for voucher_id in ids]
+        self.drop(keys)
+        pending = db.session.info.setdefault(PENDING_KEYS, {})
+        pending.setdefault(self, set()).update(keys)
+
+    def drop(self, keys):
+        if not keys:
+            return
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+        if self.store is not None:
+            try:
+                self.store.delete(keys)
+            except self.store.errors:
+                logger.error('Cannot drop vouchers from the shared cache, '
+                             f'they expire in {self.ttl:.0f}s')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _result(row):
+    return 'negative' if row is None else 'hit'
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _drop_committed(session):
+    for cache, keys in session.info.pop(PENDING_KEYS, {}).items():
+        cache.drop(list(keys))
+
+
+voucher_cache = VoucherCache(RedisVoucherStore(REDIS_URL)
+                             if REDIS_URL else None)
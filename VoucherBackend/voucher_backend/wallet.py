@@ -0,0 +1,222 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError
+from urllib3.util.retry import Retry
+
+from voucher_backend import cooperative
+from voucher_backend.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+WALLET_SERVICE = os.environ.get('WALLET_SERVICE')
+# Authorization header of the calls sent by the wallet worker on behalf of
+# a driver, whose token is not kept
+WALLET_SERVICE_AUTHORIZATION = os.environ.get('WALLET_SERVICE_AUTHORIZATION')
+WALLET_CONNECT_TIMEOUT = float(os.environ.get('WALLET_CONNECT_TIMEOUT', 2))
+WALLET_READ_TIMEOUT = float(os.environ.get('WALLET_READ_TIMEOUT', 10))
+WALLET_RETRIES = int(os.environ.get('WALLET_RETRIES', 2))
+# Keep-alive connections, one per request in flight in the gevent mode
+WALLET_POOL_SIZE = int(os.environ.get(
+    'WALLET_POOL_SIZE',
+    cooperative.GEVENT_CORES if cooperative.is_cooperative() else 10))
+WALLET_FAILURE_THRESHOLD = int(os.environ.get('WALLET_FAILURE_THRESHOLD', 5))
+WALLET_RESET_TIMEOUT = float(os.environ.get('WALLET_RESET_TIMEOUT', 30))
+
+wallet_latency = Histogram(
+    'wallet_request_duration_seconds',
+    'Latency of the calls to the wallet service',
+    labelnames=('operation', 'status'),
+)
+
+
+class WalletUnavailable(Exception):
+    """
+    The request never reached the wallet: it cannot have been applied
+    """
+
+
+class WalletOutcomeUnknown(Exception):
+    """
+    The request was sent, but no answer came back: the wallet may have
+    applied it or not. Send it again with the same idempotency key to know
+    """
+
+
+def was_sent(error):
+    """
+    Whether the request failing with the requests exception `error` may
+    have reached the wallet. Only failures to connect prove it did not
+    """
+    if isinstance(error, requests.ConnectionError) and error.args:
+        reason = error.args[0]
+        if isinstance(reason, MaxRetryError):
+            reason = reason.reason
+        # Raised for refused connections too
+        return not isinstance(reason, ConnectTimeoutError)
+    return True
+
+
+class CircuitBreaker:
+    """
+    Fail fast once the wallet keeps failing.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls are refused for `reset_timeout` seconds. Then a single trial call
+    is let through: its success closes the circuit, its failure opens it
+    again.
+    """
+
+    def __init__(self, failure_threshold=WALLET_FAILURE_THRESHOLD,
+                 reset_timeout=WALLET_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.error('Wallet circuit opened')
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class WalletClient:
+    """
+    Client of the wallet service.
+
+    Every worker process keeps its own keep-alive session. Only connection
+    failures are retried, as the wallet calls are not idempotent.
+    """
+
+    def __init__(self, base_url=WALLET_SERVICE,
+                 connect_timeout=WALLET_CONNECT_TIMEOUT,
+                 read_timeout=WALLET_READ_TIMEOUT, retries=WALLET_RETRIES,
+                 pool_size=WALLET_POOL_SIZE, breaker=None,
+                 service_authorization=WALLET_SERVICE_AUTHORIZATION):
+        self.base_url = base_url
+        self.service_authorization = service_authorization
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        # Sockets must not be shared with the parent of a forked worker
+        if self._pid != os.getpid():
+            retry = Retry(total=self.retries, connect=self.retries, read=0,
+                          status=0, backoff_factor=0.1)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.pool_size,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+            self._pid = os.getpid()
+        return self._session
+
+    def post(self, operation, path, authorization, data,
+             idempotency_key=None, on_behalf_of=None):
+        """
+        Post form data to the wallet. Returns the response. Raises
+        WalletUnavailable if the wallet cannot be reached, and
+        WalletOutcomeUnknown if it did not answer in time. `on_behalf_of`
+        is the auth_id of the driver of a call sent with the service
+        authorization
+        """
+        headers = {'Authorization': authorization}
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+        if on_behalf_of:
+            headers['X-On-Behalf-Of'] = on_behalf_of
+
+        if not self.breaker.allow():
+            wallet_latency.labels(operation, 'rejected').observe(0)
+            raise WalletUnavailable('The wallet circuit is open')
+
+        start = time.perf_counter()
+        try:
+            response = self.session.post(
+                self.base_url + path,
+                headers=headers,
+                data=data,
+                timeout=self.timeout,
+            )
+        except requests.RequestException as error:
+            wallet_latency.labels(operation, 'error').observe(
+                time.perf_counter() - start)
+            self.breaker.record_failure()
+            logger.warning(f'Wallet {operation} failed: {error}')
+            if was_sent(error):
+                raise WalletOutcomeUnknown(str(error)) from error
+            raise WalletUnavailable(str(error)) from error
+
+        wallet_latency.labels(operation, response.status_code).observe(
+            time.perf_counter() - start)
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def purchase_voucher(self, authorization, amount, phone_number,
+                         description='Voucher Purchase By Driver',
+                         idempotency_key=None, on_behalf_of=None):
+        data = {
+            'amount': amount,
+            'phoneNo': phone_number,
+            'desc': description,
+        }
+        return self.post('purchase_voucher', 'api/purchaseVoucher/',
+                         authorization, data, idempotency_key, on_behalf_of)
+
+    def topup_wallet(self, authorization, amount, phone_number,
+                     description='Voucher Purchase By Rider',
+                     idempotency_key=None, on_behalf_of=None):
+        data = {
+            'amount': amount,
+            'phoneNo': phone_number,
+            'desc': description,
+        }
+        return self.post('topup_wallet', 'api/topupwallet/', authorization,
+                         data, idempotency_key, on_behalf_of)
+
+
+wallet_client = WalletClient()
@@ -0,0 +1,66 @@
+"""
+Local HTTP server standing in for the wallet service
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server has its own from Python 3.7
+    daemon_threads = True
+
+
+class WalletStub:
+    """
+    Answer every POST with `status` and `body`, after `latency` seconds.
+    The received requests are kept in `requests` as (path, form data), and
+    their headers in `headers`
+    """
+
+    def __init__(self, status=201, body=None, latency=0):
+        self.status = status
+        self.body = body or {'status': 'success'}
+        self.latency = latency
+        self.requests = []
+        self.headers = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # The headers and the body are written apart, Nagle would hold
+            # the body until the client's delayed ACK, 40 ms later
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                form = parse_qs(self.rfile.read(length).decode('utf8'))
+                stub.requests.append(
+                    (self.path, {key: value[0] for key, value in form.items()}))
+                stub.headers.append(dict(self.headers))
+                time.sleep(stub.latency)
+
+                body = json.dumps(stub.body).encode('utf8')
+                self.send_response(stub.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
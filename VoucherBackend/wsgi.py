@@ -1,3 +1,14 @@
-from voucher_backend.app import create_app
+from voucher_backend import cooperative
+
+# Before anything else is imported
+cooperative.patch()
+
+from voucher_backend.config import load_environment  # noqa: E402
+
+load_environment()
+
+from voucher_backend import startup  # noqa: E402
+from voucher_backend.app import create_app  # noqa: E402
 
 application = create_app(port=8000)
+startup.start(application)
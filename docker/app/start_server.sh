@@ -8,6 +8,12 @@ python ./load_data.py
 echo Done Initializing
 
 
+# Every uWSGI worker keeps its metrics in this directory, /metrics adds
+# them up. It must be emptied before the workers start
+export PROMETHEUS_MULTIPROC_DIR=/tmp/metrics
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 _term() {
   echo "Caught SIGTERM signal! Sending graceful stop to uWSGI through the master-fifo"
   # See details in the uwsgi.ini file and
@@ -18,7 +24,14 @@ _term() {
 
 trap _term SIGTERM
 
-uwsgi --ini /opt/uwsgi/uwsgi.ini &
+# WORKER_MODE=gevent serves GEVENT_CORES requests at once in every worker,
+# see voucher_backend/cooperative.py
+UWSGI_MODE=""
+if [ "$WORKER_MODE" = "gevent" ]; then
+  UWSGI_MODE="--gevent ${GEVENT_CORES:-100}"
+fi
+
+uwsgi --ini /opt/uwsgi/uwsgi.ini $UWSGI_MODE &
 
 # We need to wait to properly catch the signal, that's why uWSGI is started
 # in the background. $! is the PID of uWSGI